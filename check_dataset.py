@@ -0,0 +1,61 @@
+import argparse
+import json
+import os
+import time
+from collections import Counter
+
+from data.dataset import make_dataset
+from data.image_index import ImageIndex, inspect_image, sanitize_copies
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dirs', required=True, type=str, nargs='+', help='dataset directories to check, e.g. the full_color_dir and flat_color_dir')
+parser.add_argument('--index_dir', type=str, default='checkpoints/dataset_index', help='where the per-file reports are cached')
+parser.add_argument('--n_cpu', type=int, default=8, help='number of processes inspecting and sanitising images')
+parser.add_argument('--sanitize_dir', type=str, default='', help='write RGB copies of the fixable files under <sanitize_dir>/<dir name>/, disabled if empty')
+parser.add_argument('--background', type=str, default='white', help='colour transparent pixels are composited onto: white, random or r,g,b')
+parser.add_argument('--report', type=str, default='', help='also write the files with problems to this JSON file')
+
+
+if __name__ == '__main__':
+    opt = parser.parse_args()
+    print(opt)
+
+    report = {}
+    jobs = []
+    for root in opt.dirs:
+        start = time.time()
+        index = ImageIndex(root, opt.index_dir, probe=inspect_image, workers=opt.n_cpu)
+        paths = make_dataset(root, stop=float('inf'))
+        probed = len(index.update(paths))
+        found = index.problems(paths)
+        print('%s: %d images, %d inspected (%.1fs), %d with problems' % (root, len(paths), probed,
+                                                                         time.time() - start, len(found)))
+        for issue, count in sorted(Counter(i for issues in found.values() for i in issues).items()):
+            print('    %-16s %d' % (issue, count))
+        modes = Counter(index.get(p)['mode'] for p in paths if index.get(p)['ok'])
+        print('    modes: %s' % ', '.join('%s %d' % item for item in modes.most_common()))
+
+        for path, issues in found.items():
+            entry = {'problems': issues, 'error': index.get(path)['error']}
+            if opt.sanitize_dir != '' and 'unreadable' not in issues:
+                out_root = os.path.join(opt.sanitize_dir, os.path.basename(os.path.normpath(root)))
+                entry['sanitized'] = index.sanitized_path(path, out_root)
+                jobs.append((path, entry['sanitized'], opt.background))
+            report[path] = entry
+
+    if len(jobs) > 0:
+        written = sanitize_copies(jobs, opt.n_cpu)
+        print('sanitised copies: %d written, %d up to date, under %s' % (written, len(jobs) - written, opt.sanitize_dir))
+
+    for path, entry in sorted(report.items()):
+        if 'unreadable' in entry['problems']:
+            print('unreadable: %s (%s)' % (path, entry['error']))
+    if opt.report != '':
+        with open(opt.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('report written to', opt.report)
+
+"""
+python check_dataset.py --dirs examples/train/full_color examples/train/flat_color
+python check_dataset.py --dirs examples/train/flat_color --sanitize_dir examples/train/sanitized --background random
+"""
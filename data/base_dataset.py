@@ -4,6 +4,8 @@ It also includes common transformation functions (e.g., get_transform, __scale_w
 """
 import random
 import numpy as np
+import torch
+import torch.nn.functional as F
 import torch.utils.data as data
 from PIL import Image
 import torchvision.transforms as transforms
@@ -77,6 +79,42 @@ def get_params(opt, size):
     return {'crop_pos': (x, y), 'flip': flip}
 
 
+def get_bucket_params(opt, size, target):
+    """Like get_params, for a rectangular (h, w) crop from an aspect-ratio bucket.
+
+    The image is scaled to cover the target with the load_size/crop_size margin of the square
+    pipeline, keeping its own aspect ratio, so the crop neither distorts nor needs margins.
+    """
+    w, h = size
+    th, tw = target
+    scale = max(th / h, tw / w) * opt.load_size / opt.crop_size
+    new_w = max(tw, int(round(w * scale)))
+    new_h = max(th, int(round(h * scale)))
+
+    x = random.randint(0, new_w - tw)
+    y = random.randint(0, new_h - th)
+
+    flip = random.random() > 0.5
+
+    return {'load_size': (new_w, new_h), 'crop_pos': (x, y), 'crop_size': (tw, th), 'flip': flip}
+
+
+def get_bucket_transform(opt, params, grayscale=False, method=Image.BICUBIC):
+    """get_transform for the params of get_bucket_params; the result is exactly the target size."""
+    new_w, new_h = params['load_size']
+    x, y = params['crop_pos']
+    tw, th = params['crop_size']
+    transform_list = []
+    if grayscale:
+        transform_list.append(transforms.Grayscale(1))
+    transform_list.append(transforms.Resize((new_h, new_w), method))
+    transform_list.append(transforms.Lambda(lambda img: img.crop((x, y, x + tw, y + th))))
+    if not opt.no_flip and params['flip']:
+        transform_list.append(transforms.Lambda(lambda img: __flip(img, params['flip'])))
+    transform_list += [transforms.ToTensor()]
+    return transforms.Compose(transform_list)
+
+
 def get_transform(opt, params=None, grayscale=False, method=Image.BICUBIC, convert=True, norm=True):
     transform_list = []
     if grayscale:
@@ -110,6 +148,56 @@ def get_transform(opt, params=None, grayscale=False, method=Image.BICUBIC, conve
     return transforms.Compose(transform_list)
 
 
+def map_to_tensor(array):
+    """H x W uint8/uint16 map (e.g. a MapStore view) to a 1 x H x W float tensor in [0, 1].
+
+    torch.from_numpy shares the memory of the map; the conversion to float is the only copy.
+    torch has no uint16, so 16-bit maps are read as int16 and wrapped back into [0, 65535].
+    """
+    if array.dtype == np.uint16:
+        return torch.from_numpy(array.view(np.int16)).float().remainder_(65536).div_(65535).unsqueeze(0)
+    return torch.from_numpy(array).float().div_(255).unsqueeze(0)
+
+
+def transform_map(x, opt, params):
+    """The resize/crop/flip of get_transform(opt, params) (or get_bucket_transform) applied to a 1 x H x W float map tensor."""
+    oh, ow = x.size()[1:]
+    size = None
+    if 'crop_size' in params:
+        size = params['load_size'][::-1]
+    elif 'resize' in opt.preprocess:
+        size = (opt.load_size, opt.load_size)
+    elif 'scale_width' in opt.preprocess and ow != opt.load_size:
+        size = (int(opt.load_size * oh / ow), opt.load_size)
+    elif opt.preprocess == 'none':
+        size = (int(round(oh / 4) * 4), int(round(ow / 4) * 4))
+    if size is not None and size != (oh, ow):
+        x = F.interpolate(x.unsqueeze(0), size=size, mode='bicubic', align_corners=False, antialias=True)[0]
+        x = x.clamp_(0, 1)
+
+    if 'crop_size' in params:
+        x1, y1 = params['crop_pos']
+        tw, th = params['crop_size']
+        x = x[:, y1:y1 + th, x1:x1 + tw]
+    elif 'crop' in opt.preprocess:
+        h, w = x.size()[1:]
+        x1, y1 = params['crop_pos']
+        t = opt.crop_size
+        if w > t and h > t:
+            x = x[:, y1:y1 + t, x1:x1 + t]
+        elif w > t or h > t:
+            # Same white margins as __crop/add_margin.
+            crop = x[:, :, x1:x1 + t] if w > t else x[:, y1:y1 + t, :]
+            out = x.new_ones((x.size()[0], t, t))
+            top, left = ((t - h) // 2, 0) if w > t else (0, (t - w) // 2)
+            out[:, top:top + crop.size()[1], left:left + crop.size()[2]] = crop
+            x = out
+
+    if not opt.no_flip and params['flip']:
+        x = x.flip(-1)
+    return x
+
+
 def __make_power_2(img, base, method=Image.BICUBIC):
     ow, oh = img.size
     h = int(round(oh / base) * base)
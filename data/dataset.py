@@ -2,6 +2,7 @@
 Define the dataset class
 """
 
+import copy
 import os
 
 import cv2
@@ -10,7 +11,8 @@ from torch.utils.data import Dataset
 from torchvision import transforms
 from PIL import Image
 
-from data.base_dataset import get_params, get_transform
+from data.base_dataset import get_bucket_params, get_bucket_transform, get_params, get_transform, map_to_tensor, \
+    transform_map
 
 IMG_EXTENSIONS = [".jpg", ".JPG", ".jpeg", ".JPEG", ".png", ".PNG"]
 
@@ -42,7 +44,8 @@ def make_dataset(dir, stop=10000):
 
 
 class UnpairedDepthDataset(Dataset):
-    def __init__(self, root, root2, opt, transform=None, mode="train", midas=False, depthroot="", sketchroot=""):
+    def __init__(self, root, root2, opt, transform=None, mode="train", midas=False, depthroot="", sketchroot="",
+                 sketch_store="", depth_store=""):
         self.root = root
         self.mode = mode
         self.midas = midas
@@ -50,6 +53,19 @@ class UnpairedDepthDataset(Dataset):
         all_img = make_dataset(self.root)
 
         self.depth_maps = 0
+        self.map_store = None
+        store_path = sketch_store if sketch_store != "" else (depth_store if midas else "")
+        if store_path != "":
+            # Maps from make_sketch_targets.py or ingest_maps.py are found through the store's manifest;
+            # depth_maps then holds store slots instead of file names.
+            from data.map_store import MapStore
+            self.map_store = MapStore(store_path)
+            self.map_channels = 1 if sketch_store != "" else 3
+            slots = [self.map_store.lookup(path) for path in all_img]
+            all_img = [path for path, slot in zip(all_img, slots) if slot is not None]
+            self.depth_maps = [slot for slot in slots if slot is not None]
+            print(f"Found {len(all_img)} images with maps in {store_path}.")
+            sketchroot = ""
         self.sketchroot = sketchroot
         depthroot = sketchroot
 
@@ -107,33 +123,64 @@ class UnpairedDepthDataset(Dataset):
             self.min_length = len(self.data)
 
     def __getitem__(self, index):
+        # AspectBucketBatchSampler passes (index, (h, w)): crop to that rectangle instead of the square.
+        target = None
+        if isinstance(index, tuple):
+            index, target = index
+        return self.view(self.decode(index), index, target)
+
+    def decode(self, index):
+        """The decoded images of item index, before any random transform."""
         img_path = self.data[index]
+        decoded = {"path": img_path, "r": Image.open(img_path).convert("RGB"), "depth": 0}
+
+        if self.midas and self.map_store is None:
+            img_depth = cv2.imread(self.depth_maps[index])
+            decoded["depth"] = Image.fromarray(img_depth.astype(np.uint8)).convert("RGB")
+
+        if self.sketchroot != "":
+            img_depth = cv2.imread(self.depth_maps[index])
+            decoded["depth"] = Image.fromarray(img_depth.astype(np.uint8)).convert("L")
+
+        if self.map_store is not None:
+            decoded["depth"] = self.map_store.get(self.depth_maps[index])
+
+        if self.mode == "train":
+            B_mode = "L"
+            if self.opt.output_nc == 3:
+                B_mode = "RGB"
+            decoded["line"] = Image.open(self.img2[index]).convert(B_mode)
+        return decoded
+
+    def view(self, decoded, index, target=None):
+        """One random crop/flip of decoded images, of the (h, w) target if given; views of the same decode are independent."""
+        img_path = decoded["path"]
 
         basename = os.path.basename(img_path)
         base = basename.split(".")[0]
 
-        img_r = Image.open(img_path).convert("RGB")
-        transform_params = get_params(self.opt, img_r.size)
-        A_transform = get_transform(self.opt, transform_params, grayscale=(self.opt.input_nc == 1), norm=False)
-        B_transform = get_transform(self.opt, transform_params, grayscale=(self.opt.output_nc == 1), norm=False)
+        img_r = decoded["r"]
+        if target is not None:
+            # The unpaired flat-colour image gets its own crop of the same rectangle.
+            transform_params = get_bucket_params(self.opt, img_r.size, target)
+            A_transform = get_bucket_transform(self.opt, transform_params, grayscale=(self.opt.input_nc == 1))
+            B_params = get_bucket_params(self.opt, decoded["line"].size, target)
+            B_transform = get_bucket_transform(self.opt, B_params, grayscale=(self.opt.output_nc == 1))
+        else:
+            transform_params = get_params(self.opt, img_r.size)
+            A_transform = get_transform(self.opt, transform_params, grayscale=(self.opt.input_nc == 1), norm=False)
+            B_transform = get_transform(self.opt, transform_params, grayscale=(self.opt.output_nc == 1), norm=False)
 
         if self.mode != "train":
             A_transform = self.transform
 
         img_r = A_transform(img_r)
 
-        B_mode = "L"
-        if self.opt.output_nc == 3:
-            B_mode = "RGB"
-
         img_depth = 0
-        if self.midas:
-            img_depth = cv2.imread(self.depth_maps[index])
-            img_depth = A_transform(Image.fromarray(img_depth.astype(np.uint8)).convert("RGB"))
-
-        if self.sketchroot != "":
-            img_depth = cv2.imread(self.depth_maps[index])
-            img_depth = A_transform(Image.fromarray(img_depth.astype(np.uint8)).convert("L"))
+        if self.map_store is not None:
+            img_depth = self.load_map(decoded["depth"], transform_params, A_transform)
+        elif isinstance(decoded["depth"], Image.Image):
+            img_depth = A_transform(decoded["depth"])
 
         img_normals = 0
         label = 0
@@ -141,11 +188,66 @@ class UnpairedDepthDataset(Dataset):
         input_dict = {"r": img_r, "depth": img_depth, "path": img_path, "index": index, "name": base, "label": label}
 
         if self.mode == "train":
-            cur_path = self.img2[index]
-            cur_img = B_transform(Image.open(cur_path).convert(B_mode))
-            input_dict["line"] = cur_img
+            input_dict["line"] = B_transform(decoded["line"])
 
         return input_dict
 
+    def load_map(self, array, params, transform):
+        """Map from the store (an H x W view) as a tensor with the same geometry as the image transformed by params.
+
+        In training the memory-mapped map goes straight into a tensor and is resized, cropped and
+        flipped there, instead of the decode, BGR-to-RGB/L conversions and PIL round trip of the
+        image files. Other modes use the caller's PIL transforms on an 8-bit copy.
+        """
+        channels = self.map_channels if self.opt.input_nc == 3 else 1
+        if self.mode != "train":
+            if array.dtype == np.uint16:
+                array = (array >> 8).astype(np.uint8)
+            return transform(Image.fromarray(array, mode="L").convert("RGB" if channels == 3 else "L"))
+        x = transform_map(map_to_tensor(array), self.opt, params)
+        return x.expand(channels, -1, -1)
+
+    def exclude(self, bad, replace=None):
+        """Drop the items whose image or flat-colour image is in bad, and load the paths in replace from their replacements."""
+        replace = replace or {}
+        keep = [i for i in range(self.min_length)
+                if self.data[i] not in bad and (self.mode != "train" or self.img2[i] not in bad)]
+        self.data = [replace.get(self.data[i], self.data[i]) for i in keep]
+        if isinstance(self.depth_maps, list) and len(self.depth_maps) > 0:
+            self.depth_maps = [self.depth_maps[i] for i in keep]
+        if self.mode == "train":
+            self.img2 = [replace.get(self.img2[i], self.img2[i]) for i in keep]
+        self.min_length = len(keep)
+
+    def subset(self, indices):
+        """Keep only the given items, e.g. the inputs that still need to be processed."""
+        self.data = [self.data[i] for i in indices]
+        if isinstance(self.depth_maps, list) and len(self.depth_maps) > 0:
+            self.depth_maps = [self.depth_maps[i] for i in indices]
+        self.min_length = len(self.data)
+
+    def from_paths(self, paths):
+        """Copy of this (test mode) dataset over other image paths, e.g. files that arrived in a watched directory."""
+        dataset = copy.copy(self)
+        dataset.data = list(paths)
+        dataset.depth_maps = 0
+        dataset.min_length = len(dataset.data)
+        return dataset
+
     def __len__(self):
         return self.min_length
+
+
+class ImageListDataset(Dataset):
+    """Transformed images of a list of (key, path) pairs, e.g. the manifest slots that need new maps."""
+    def __init__(self, items, transform, mode="RGB"):
+        self.items = list(items)
+        self.transform = transforms.Compose(transform)
+        self.mode = mode
+
+    def __getitem__(self, index):
+        key, path = self.items[index]
+        return {"r": self.transform(Image.open(path).convert(self.mode)), "key": key, "path": path}
+
+    def __len__(self):
+        return len(self.items)
@@ -0,0 +1,192 @@
+"""Cached per-file facts about the images of a dataset directory.
+
+An ImageIndex keeps, for every image under a root, its file size and mtime together with what a
+probe read from the file: read_header only the pixel size, inspect_image whether the file fully
+decodes, its mode, size and transparency. Entries whose file size and mtime are unchanged are
+reused, so reopening the index of a large directory only stats the files; new and changed files
+are probed by a process pool.
+
+sanitize() writes a training-ready RGB copy of a readable image that has a problem().
+"""
+import hashlib
+import json
+import os
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+from data.dataset import make_dataset
+
+# Modes that convert("RGB") turns into the right colours.
+RGB_SAFE_MODES = ("1", "L", "P", "RGB", "RGBA", "LA", "PA", "RGBX")
+
+
+def index_path(root, cache_dir, probe_name="read_header"):
+    """Cache file of the index of root; the name is derived from the absolute path of root and the probe."""
+    key = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "%s_%s_%s.json" % (os.path.basename(os.path.normpath(root)), key, probe_name))
+
+
+def read_header(path):
+    with Image.open(path) as img:
+        return {"width": img.size[0], "height": img.size[1]}
+
+
+def inspect_image(path):
+    """Whether path fully decodes, and its format, mode, size and transparency; never raises."""
+    facts = {"ok": False, "format": "", "mode": "", "width": 0, "height": 0, "alpha": False, "transparent": False,
+             "error": ""}
+    try:
+        with Image.open(path) as img:
+            facts.update(format=img.format or "", mode=img.mode, width=img.size[0], height=img.size[1])
+            # load() decodes every pixel, which is what catches truncated files.
+            img.load()
+            facts["alpha"] = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+            if facts["alpha"]:
+                facts["transparent"] = img.convert("RGBA").getextrema()[3][0] < 255
+        facts["ok"] = True
+    except Exception as e:
+        facts["error"] = "%s: %s" % (type(e).__name__, e)
+    return facts
+
+
+def problems(facts):
+    """What keeps an inspected image from loading correctly with convert('RGB'); empty if nothing."""
+    if not facts["ok"]:
+        return ["unreadable"]
+    found = []
+    if facts["mode"] not in RGB_SAFE_MODES:
+        found.append("mode %s" % facts["mode"])
+    if facts["transparent"]:
+        found.append("transparent")
+    return found
+
+
+def sanitize(path, out_path, background="white"):
+    """Write an RGB PNG of path: alpha composited onto background ('white', 'random' per file or 'r,g,b'), CMYK and 16-bit/float modes converted."""
+    with Image.open(path) as img:
+        img.load()
+        if img.mode in ("I", "I;16", "I;16B", "I;16L", "F"):
+            a = np.asarray(img, dtype=np.float32)
+            scale = 65535.0 if img.mode.startswith("I;16") else max(float(a.max()), 1.0)
+            img = Image.fromarray((np.clip(a / scale, 0, 1) * 255 + 0.5).astype(np.uint8), mode="L")
+        if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+            if background == "random":
+                # Seeded by the file name, so a rewritten copy gets the same background.
+                rng = np.random.RandomState(zlib.crc32(os.path.basename(path).encode()))
+                colour = tuple(int(c) for c in rng.randint(0, 256, 3))
+            elif background == "white":
+                colour = (255, 255, 255)
+            else:
+                colour = tuple(int(c) for c in background.split(","))
+            rgba = img.convert("RGBA")
+            img = Image.alpha_composite(Image.new("RGBA", rgba.size, colour + (255,)), rgba)
+        img = img.convert("RGB")
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp = out_path + ".tmp.png"
+    img.save(tmp)
+    os.replace(tmp, out_path)
+    return out_path
+
+
+def _sanitize_job(args):
+    path, out_path, background = args
+    # Copies newer than their source are kept, so rerunning only redoes changed files.
+    if os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(path):
+        return False
+    sanitize(path, out_path, background)
+    return True
+
+
+def sanitize_copies(jobs, workers=0):
+    """Run sanitize over (path, out_path, background) jobs in a process pool; returns how many were (re)written."""
+    if workers > 1 and len(jobs) > 1:
+        with Pool(workers) as pool:
+            return sum(pool.imap_unordered(_sanitize_job, jobs, chunksize=4))
+    return sum(_sanitize_job(job) for job in jobs)
+
+
+class ImageIndex():
+    """Facts about the images under root, cached in cache_dir.
+
+    Parameters:
+        root (str)      -- dataset directory
+        cache_dir (str) -- where the index is kept
+        probe           -- module-level function path -> dict of facts, run for new or changed files
+        workers (int)   -- processes probing files, 0 to probe in this process
+    """
+    def __init__(self, root, cache_dir="checkpoints/dataset_index", probe=read_header, workers=0):
+        self.root = root
+        self.path = index_path(root, cache_dir, probe.__name__)
+        self.probe = probe
+        self.workers = workers
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def relpath(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+
+    def stale(self, paths):
+        """The paths whose entry is missing or was made from a different version of the file."""
+        stale = []
+        for path in paths:
+            entry = self.entries.get(self.relpath(path))
+            st = os.stat(path)
+            if entry is None or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime:
+                stale.append(path)
+        return stale
+
+    def update(self, paths=None):
+        """Probe new and changed files (every image under root by default) and save the index."""
+        if paths is None:
+            paths = make_dataset(self.root, stop=float("inf"))
+        stale = self.stale(dict.fromkeys(paths))
+        if self.workers > 1 and len(stale) > 1:
+            with Pool(self.workers) as pool:
+                for k, (path, facts) in enumerate(zip(stale, pool.imap(self.probe, stale, chunksize=16))):
+                    self.record(path, facts)
+                    if (k + 1) % 1000 == 0:
+                        print("probed %d of %d files of %s" % (k + 1, len(stale), self.root))
+        else:
+            for path in stale:
+                self.record(path, self.probe(path))
+        if len(stale) > 0:
+            self.save()
+        return stale
+
+    def record(self, path, facts):
+        st = os.stat(path)
+        self.entries[self.relpath(path)] = dict(facts, size=st.st_size, mtime=st.st_mtime)
+
+    def get(self, path):
+        return self.entries.get(self.relpath(path))
+
+    def sizes(self, paths):
+        """PIL (w, h) sizes of paths, probing any that are not indexed yet."""
+        self.update(paths)
+        return [(self.get(path)["width"], self.get(path)["height"]) for path in paths]
+
+    def problems(self, paths):
+        """{path: problems} of the given paths that have any (needs an inspect_image index)."""
+        self.update(paths)
+        found = {}
+        for path in dict.fromkeys(paths):
+            issues = problems(self.get(path))
+            if len(issues) > 0:
+                found[path] = issues
+        return found
+
+    def sanitized_path(self, path, out_root):
+        """Where the sanitised copy of path goes under out_root: same relative path, .png."""
+        return os.path.join(out_root, os.path.splitext(self.relpath(path))[0] + ".png")
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
@@ -0,0 +1,56 @@
+"""Append-only manifest of the images under a dataset root.
+
+Every image gets a slot number the first time it is seen and keeps it, so stores of per-image
+data (sketch targets, depth maps) can be indexed directly by slot and stay valid when images are
+added. Images that disappear keep their slot but are no longer listed by `present()`.
+"""
+import json
+import os
+
+from data.dataset import make_dataset
+
+
+class Manifest():
+    """Slots of the images under root, kept in the JSON file at path; root defaults to the saved one."""
+    def __init__(self, root, path):
+        self.path = path
+        self.names = []
+        self.saved_root = None
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.names = saved["names"]
+            self.saved_root = saved["root"]
+        self.root = root if root is not None else self.saved_root
+        self.slots = {name: slot for slot, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def relpath(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+
+    def update(self):
+        """Scan root and give new images the next free slots; returns the (slot, path) pairs of all present images."""
+        present = []
+        for path in sorted(make_dataset(self.root, stop=float("inf"))):
+            name = self.relpath(path)
+            if name not in self.slots:
+                self.slots[name] = len(self.names)
+                self.names.append(name)
+            present.append((self.slots[name], path))
+        return present
+
+    def slot(self, path):
+        """Slot of an image given by its path (absolute or relative to the working directory), or None."""
+        return self.slots.get(self.relpath(path))
+
+    def present(self):
+        return [(slot, os.path.join(self.root, name)) for slot, name in enumerate(self.names)
+                if os.path.exists(os.path.join(self.root, name))]
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"root": os.path.abspath(self.root), "names": self.names}, f)
+        os.replace(tmp, self.path)
@@ -0,0 +1,214 @@
+"""Packed store of single-channel per-image maps (sketch targets, depth maps).
+
+A store is a directory holding:
+    manifest.json -- the data.manifest.Manifest of the image root; an image's slot is its row
+    index.npy     -- one row per slot: where its map lives in maps.bin, its shape and bit depth,
+                     and the size/mtime/hash of the source image it was computed from
+    maps.bin      -- the raw maps, appended one after the other
+
+Maps are read through a memory map, so a map costs no decode and no copy until it is used.
+Writes only append to maps.bin and the index is replaced atomically on flush(), so an
+interrupted run loses at most the maps written since the last flush and simply continues;
+the bytes of replaced or lost maps are reclaimed by compact().
+
+compact() first writes the new maps.bin and index.npy next to the old ones as
+maps.compacted.bin and index.compacted.npy; the index is written last and its presence commits
+the compaction. Opening a store finishes a committed compaction that was interrupted while the
+files were swapped and discards an uncommitted one, so the index always matches the data.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from data.manifest import Manifest
+
+INDEX_DTYPE = np.dtype([("offset", "<i8"), ("height", "<i4"), ("width", "<i4"), ("bits", "u1"),
+                        ("src_size", "<i8"), ("src_mtime", "<f8"), ("src_hash", "S32")])
+MAP_DTYPES = {8: np.uint8, 16: np.uint16}
+
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest().encode()
+
+
+class MapStore():
+    """Maps of the images under image_root, addressed by manifest slot.
+
+    Parameters:
+        root (str)       -- store directory
+        image_root (str) -- directory of the source images; may be omitted when opening an existing store
+        writable (bool)  -- open for put(); a store has at most one writer at a time
+    """
+    def __init__(self, root, image_root=None, writable=False):
+        self.root = root
+        self.writable = writable
+        manifest_path = os.path.join(root, "manifest.json")
+        if image_root is None:
+            if not os.path.exists(manifest_path):
+                raise FileNotFoundError("%s is not a map store" % root)
+            image_root = Manifest(None, manifest_path).saved_root
+        if writable:
+            os.makedirs(root, exist_ok=True)
+        self.manifest = Manifest(image_root, manifest_path)
+        self.index_path = os.path.join(root, "index.npy")
+        self.data_path = os.path.join(root, "maps.bin")
+        self._recover()
+        self.index = np.load(self.index_path) if os.path.exists(self.index_path) else np.zeros(0, INDEX_DTYPE)
+        self.index = self._grown(self.index, len(self.manifest))
+        self._data = None
+        self._file = None
+
+    def _recover(self):
+        """Finish or discard a compact() that did not complete."""
+        new_data = os.path.join(self.root, "maps.compacted.bin")
+        new_index = os.path.join(self.root, "index.compacted.npy")
+        try:
+            if os.path.exists(new_index):
+                if os.path.exists(new_data):
+                    os.replace(new_data, self.data_path)
+                os.replace(new_index, self.index_path)
+            elif os.path.exists(new_data):
+                os.remove(new_data)
+        except FileNotFoundError:
+            # Another process opening the store finished the recovery first.
+            pass
+
+    @staticmethod
+    def _grown(index, n):
+        if len(index) >= n:
+            return index
+        grown = np.zeros(n, INDEX_DTYPE)
+        grown["offset"] = -1
+        grown[:len(index)] = index
+        return grown
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # DataLoader workers open their own memory map instead of receiving a copy of the data.
+        state = dict(self.__dict__)
+        state["_data"] = None
+        state["_file"] = None
+        return state
+
+    def has(self, slot):
+        return slot is not None and slot < len(self.index) and self.index[slot]["offset"] >= 0
+
+    def update_manifest(self):
+        """Add new images under the image root; returns the (slot, path) pairs of all present images."""
+        present = self.manifest.update()
+        self.index = self._grown(self.index, len(self.manifest))
+        return present
+
+    def up_to_date(self, slot, path, use_hash=False):
+        """Whether the map of slot was computed from the current contents of path.
+
+        Size and mtime decide; with use_hash a file whose mtime changed but whose contents hash to
+        the stored value (e.g. after a copy) is accepted and its recorded mtime refreshed.
+        """
+        if not self.has(slot):
+            return False
+        row = self.index[slot]
+        st = os.stat(path)
+        if row["src_size"] == st.st_size and row["src_mtime"] == st.st_mtime:
+            return True
+        if use_hash and row["src_size"] == st.st_size and row["src_hash"] == file_hash(path):
+            self.index["src_mtime"][slot] = st.st_mtime
+            return True
+        return False
+
+    def put(self, slot, array, path, use_hash=False):
+        """Append the H x W uint8/uint16 map of slot, computed from the image at path."""
+        if not self.writable:
+            raise IOError("%s was not opened for writing" % self.root)
+        array = np.ascontiguousarray(array)
+        bits = {np.dtype(np.uint8): 8, np.dtype(np.uint16): 16}.get(array.dtype)
+        if array.ndim != 2 or bits is None:
+            raise ValueError("maps must be H x W uint8 or uint16, got %s %s" % (array.dtype, array.shape))
+        if self._file is None:
+            self._file = open(self.data_path, "ab")
+        offset = self._file.seek(0, os.SEEK_END)
+        self._file.write(array.astype("<u%d" % (bits // 8), copy=False).tobytes())
+        st = os.stat(path)
+        self.index[slot] = (offset, array.shape[0], array.shape[1], bits, st.st_size, st.st_mtime,
+                            file_hash(path) if use_hash else b"")
+
+    def flush(self):
+        """Make everything put so far durable: data first, then the index that points at it."""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self.manifest.save()
+        tmp = self.index_path + ".tmp.npy"
+        np.save(tmp, self.index)
+        os.replace(tmp, self.index_path)
+        self._data = None
+
+    def close(self):
+        if self.writable:
+            self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def get(self, slot):
+        """H x W view of the map of slot into the memory-mapped data; no bytes are copied."""
+        if not self.has(slot):
+            raise KeyError("no map for slot %s in %s" % (slot, self.root))
+        row = self.index[slot]
+        dtype = np.dtype(MAP_DTYPES[int(row["bits"])]).newbyteorder("<")
+        count = int(row["height"]) * int(row["width"])
+        start = int(row["offset"])
+        end = start + count * dtype.itemsize
+        # Reopened when the map was appended after the memory map was created. Copy-on-write keeps
+        # the views writable, which torch.from_numpy wants, without ever touching the file.
+        if self._data is None or end > len(self._data):
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode="c")
+        return self._data[start:end].view(dtype).reshape(int(row["height"]), int(row["width"]))
+
+    def lookup(self, path):
+        """Slot of the image at path if the store has a map for it, else None."""
+        slot = self.manifest.slot(path)
+        return slot if self.has(slot) else None
+
+    def compact(self):
+        """Rewrite maps.bin with only the maps the index points at, in slot order.
+
+        The old maps.bin and index.npy stay in place until the new index is durable, so an
+        interruption at any point leaves a consistent store (see _recover).
+        """
+        self.close()
+        new_data = os.path.join(self.root, "maps.compacted.bin")
+        new_index = os.path.join(self.root, "index.compacted.npy")
+        index = self.index.copy()
+        with open(new_data + ".tmp", "wb") as f:
+            for slot in range(len(self.index)):
+                if self.has(slot):
+                    data = self.get(slot).tobytes()
+                    index["offset"][slot] = f.tell()
+                    f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(new_data + ".tmp", new_data)
+        with open(new_index + ".tmp", "wb") as f:
+            np.save(f, index)
+            f.flush()
+            os.fsync(f.fileno())
+        # Commit point: from here on the compacted files replace the old ones, also after a crash.
+        os.replace(new_index + ".tmp", new_index)
+        self._data = None
+        os.replace(new_data, self.data_path)
+        os.replace(new_index, self.index_path)
+        self.index = index
+
+    def stats(self):
+        live = self.index[self.index["offset"] >= 0]
+        used = int((live["height"].astype(np.int64) * live["width"] * (live["bits"] // 8)).sum())
+        total = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        return {"slots": len(self.index), "maps": len(live), "bytes": used, "dead_bytes": total - used}
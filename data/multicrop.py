@@ -0,0 +1,106 @@
+"""Several random views per decoded image.
+
+Training keeps one random crop of every decoded image, so with large sources most of the loader
+time goes into decoding. MultiCropDataset decodes each image once per epoch and yields up to k
+independent crop/flip views of it as separate samples. The views pass through a shuffle buffer,
+so a batch mixes views of many images instead of holding k near-copies of one.
+
+The number of views per decode is chosen by a ViewScheduler from the measured decode and view
+times: cheap decodes get a single view (full diversity), expensive ones are amortised over more.
+"""
+import math
+import random
+import time
+
+from torch.utils.data import get_worker_info, IterableDataset
+
+
+class ViewScheduler():
+    """Views to take from the next decoded image.
+
+    With k views per decode, decoding takes t_decode / (t_decode + k * t_view) of the loader time.
+    The scheduler picks the smallest k that keeps this share at or below decode_share, clamped to
+    [1, max_views]; with adaptive=False it always returns max_views.
+
+    Parameters:
+        max_views (int)      -- most views taken from one decode
+        decode_share (float) -- target fraction of loader time spent decoding
+        adaptive (bool)      -- choose k from the measured times
+        momentum (float)     -- smoothing of the measured times
+    """
+    def __init__(self, max_views, decode_share=0.5, adaptive=True, momentum=0.9):
+        self.max_views = max(1, max_views)
+        self.decode_share = decode_share
+        self.adaptive = adaptive
+        self.momentum = momentum
+        self.t_decode = None
+        self.t_view = None
+
+    def _average(self, old, new):
+        return new if old is None else self.momentum * old + (1 - self.momentum) * new
+
+    def record_decode(self, seconds):
+        self.t_decode = self._average(self.t_decode, seconds)
+
+    def record_view(self, seconds):
+        self.t_view = self._average(self.t_view, seconds)
+
+    def views(self):
+        if not self.adaptive:
+            return self.max_views
+        if self.t_decode is None or not self.t_view:
+            # Nothing measured yet: take every view, which also yields the first view timing.
+            return self.max_views
+        k = math.ceil(self.t_decode * (1 - self.decode_share) / (self.decode_share * self.t_view))
+        return min(self.max_views, max(1, k))
+
+
+class MultiCropDataset(IterableDataset):
+    """Iterate over views of a dataset with decode(index) and view(decoded, index) methods.
+
+    Every epoch each DataLoader worker decodes its share of a random permutation of the items.
+    len() assumes max_views views per image, so with an adaptive scheduler it is an upper bound on
+    the views of an epoch and step counts must not be derived from it.
+
+    Parameters:
+        dataset              -- e.g. UnpairedDepthDataset in train mode
+        views (int)          -- most views per decoded image
+        shuffle_buffer (int) -- views held back and drawn from at random
+        adaptive (bool)      -- let a ViewScheduler choose the views per decode
+        decode_share (float) -- see ViewScheduler
+    """
+    def __init__(self, dataset, views=4, shuffle_buffer=256, adaptive=True, decode_share=0.5):
+        self.dataset = dataset
+        self.views = views
+        self.shuffle_buffer = max(1, shuffle_buffer)
+        self.adaptive = adaptive
+        self.decode_share = decode_share
+
+    def __len__(self):
+        return len(self.dataset) * self.views
+
+    def __iter__(self):
+        # The permutation is shared by the workers, which take disjoint slices of it. DataLoader draws
+        # a new base seed every epoch and gives worker i the seed base + i.
+        worker = get_worker_info()
+        seed = worker.seed - worker.id if worker is not None else random.getrandbits(32)
+        order = list(range(len(self.dataset)))
+        random.Random(seed).shuffle(order)
+        if worker is not None:
+            order = order[worker.id::worker.num_workers]
+
+        scheduler = ViewScheduler(self.views, self.decode_share, self.adaptive)
+        buffer = []
+        for index in order:
+            start = time.time()
+            decoded = self.dataset.decode(index)
+            scheduler.record_decode(time.time() - start)
+            for _ in range(scheduler.views()):
+                start = time.time()
+                buffer.append(self.dataset.view(decoded, index))
+                scheduler.record_view(time.time() - start)
+                if len(buffer) >= self.shuffle_buffer:
+                    yield buffer.pop(random.randrange(len(buffer)))
+        random.shuffle(buffer)
+        for item in buffer:
+            yield item
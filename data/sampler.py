@@ -0,0 +1,150 @@
+"""Batch samplers and collation for images of different sizes.
+
+Images are grouped into buckets of equal (rounded) size, so a batch only needs the few pixels of
+padding that bring its members up to the bucket size, and every output can be cropped back to the
+size of its own input.
+
+For training, AspectBucketBatchSampler groups images by aspect ratio instead and has every image
+cropped to its bucket's rectangle, so batches are uniform and contain no padding at all.
+"""
+import math
+import random
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torch.utils.data import default_collate, Sampler
+
+
+def resized_size(size, target=0):
+    """(h, w) of an image with PIL size (w, h) after transforms.Resize(target); 0 keeps it unchanged."""
+    w, h = size
+    if target <= 0:
+        return h, w
+    if w <= h:
+        return int(target * h / w), target
+    return target, int(target * w / h)
+
+
+def load_sizes(paths, target=0):
+    """Sizes of the images after resizing, read from the file headers without decoding the pixels."""
+    sizes = []
+    for path in paths:
+        with Image.open(path) as img:
+            sizes.append(resized_size(img.size, target))
+    return sizes
+
+
+def _round_up(n, step):
+    return -(-n // step) * step
+
+
+class SizeBucketBatchSampler(Sampler):
+    """Yield batches of dataset indices whose images fall in the same size bucket.
+
+    Parameters:
+        sizes (list)      -- (h, w) of every dataset item as the network will see it
+        batch_size (int)  -- maximum number of images per batch
+        step (int)        -- bucket granularity; sizes are rounded up to a multiple of it (at least 4)
+        shuffle (bool)    -- shuffle within buckets and the order of the batches every epoch
+        drop_last (bool)  -- drop the incomplete last batch of every bucket
+    """
+    def __init__(self, sizes, batch_size, step=4, shuffle=False, drop_last=False):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        step = max(4, step // 4 * 4)
+        self.buckets = OrderedDict()
+        for index, (h, w) in enumerate(sizes):
+            self.buckets.setdefault((_round_up(h, step), _round_up(w, step)), []).append(index)
+
+    def batches(self):
+        batches = []
+        for indices in self.buckets.values():
+            if self.shuffle:
+                indices = random.sample(indices, len(indices))
+            for k in range(0, len(indices), self.batch_size):
+                chunk = indices[k:k + self.batch_size]
+                if len(chunk) == self.batch_size or not self.drop_last:
+                    batches.append(chunk)
+        if self.shuffle:
+            random.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
+
+
+def aspect_buckets(area, count=7, max_ratio=3.0, multiple=4):
+    """(h, w) of count buckets of about area pixels, aspect ratios w/h spread geometrically over [1/max_ratio, max_ratio]."""
+    buckets = []
+    for k in range(count):
+        ratio = max_ratio ** ((2.0 * k / (count - 1) - 1) if count > 1 else 0)
+        h = max(multiple, int(round(math.sqrt(area / ratio) / multiple)) * multiple)
+        w = max(multiple, int(round(math.sqrt(area * ratio) / multiple)) * multiple)
+        if (h, w) not in buckets:
+            buckets.append((h, w))
+    return buckets
+
+
+class AspectBucketBatchSampler(SizeBucketBatchSampler):
+    """Yield batches of (index, (h, w)) whose images all have the aspect-ratio bucket (h, w).
+
+    The dataset crops item index to exactly (h, w) (UnpairedDepthDataset accepts such pairs), so
+    every batch is a uniform rectangle close to the shape of its images.
+
+    Parameters:
+        sizes (list)      -- PIL (w, h) of every dataset item, e.g. from data.image_index.ImageIndex
+        batch_size (int)  -- images per batch
+        buckets (list)    -- (h, w) of the buckets, see aspect_buckets
+        shuffle (bool)    -- shuffle within buckets and the order of the batches every epoch
+        drop_last (bool)  -- drop the incomplete last batch of every bucket
+    """
+    def __init__(self, sizes, batch_size, buckets, shuffle=True, drop_last=True):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        log_ratios = [math.log(w / h) for h, w in buckets]
+        self.buckets = OrderedDict((bucket, []) for bucket in buckets)
+        for index, (w, h) in enumerate(sizes):
+            r = math.log(w / h)
+            nearest = min(range(len(buckets)), key=lambda k: abs(log_ratios[k] - r))
+            self.buckets[buckets[nearest]].append(index)
+
+    def __iter__(self):
+        shapes = {}
+        for bucket, indices in self.buckets.items():
+            shapes.update((index, bucket) for index in indices)
+        return iter([[(index, shapes[index]) for index in batch] for batch in self.batches()])
+
+    def counts(self):
+        return OrderedDict(("%dx%d" % bucket, len(indices)) for bucket, indices in self.buckets.items())
+
+
+def pad_collate(batch, multiple=4, keys=("r", "depth")):
+    """Collate items of different sizes by replicate-padding the image tensors to a common size.
+
+    The padded size is the largest size in the batch rounded up to `multiple`; the original (h, w)
+    of every item is returned under 'size' so its output can be cropped back.
+    """
+    sizes = [tuple(item["r"].size()[1:]) for item in batch]
+    h = _round_up(max(s[0] for s in sizes), multiple)
+    w = _round_up(max(s[1] for s in sizes), multiple)
+    padded = []
+    for item in batch:
+        item = dict(item)
+        for key in keys:
+            x = item.get(key)
+            if isinstance(x, torch.Tensor) and x.dim() == 3:
+                pad_h, pad_w = h - x.size()[1], w - x.size()[2]
+                if pad_h > 0 or pad_w > 0:
+                    x = F.pad(x.unsqueeze(0), (0, pad_w, 0, pad_h), mode="replicate").squeeze(0)
+                item[key] = x
+        padded.append(item)
+    out = default_collate(padded)
+    out["size"] = torch.tensor(sizes)
+    return out
@@ -0,0 +1,137 @@
+import argparse
+import glob
+import json
+import os
+
+import torch
+
+from models.model import Generator
+from data.dataset import make_dataset
+from utils.evaluation import checkpoint_label, CheckpointPrefetcher, run_checkpoint, sort_checkpoints, TestSet
+from utils.fid import InceptionFeatures, manifest_key, reference_statistics, score
+from utils.image_writer import ImageWriter
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--name', required=True, type=str, help='name of the experiment whose checkpoints are evaluated')
+parser.add_argument('--checkpoints_dir', type=str, default='checkpoints', help='Where the model checkpoints are saved')
+parser.add_argument('--checkpoints', type=str, nargs='*', default=[], help='netG_A checkpoints or globs, defaults to every netG_A_*.pth of the experiment')
+parser.add_argument('--dataroot', required=True, type=str, help='directory of test images')
+parser.add_argument('--reference_dir', type=str, default='', help='flat-colour references matched to the test images by file name, for PSNR/SSIM')
+parser.add_argument('--results_dir', type=str, default='results', help='where the report and outputs are written')
+parser.add_argument('--input_nc', type=int, default=3, help='number of channels of input data')
+parser.add_argument('--output_nc', type=int, default=3, help='number of channels of output data')
+parser.add_argument('--n_blocks', type=int, default=3, help='number of resnet blocks for generator')
+parser.add_argument('--size', type=int, default=256, help='shorter side the test images are resized to, 0 to keep their size')
+parser.add_argument('--batchSize', type=int, default=8, help='size of the batches')
+parser.add_argument('--how_many', type=int, default=1000, help='number of test images')
+parser.add_argument('--save_outputs', type=int, default=0, help='also write every output to <results_dir>/<name>/sweep/<epoch>')
+parser.add_argument('--writer_workers', type=int, default=4, help='threads encoding the saved outputs')
+parser.add_argument('--fid', type=int, default=1, help='compute FID and KID against the flat-colour reference set')
+parser.add_argument('--fid_reference_dir', type=str, default='', help='flat-colour reference set for FID/KID (need not be paired), defaults to --reference_dir')
+parser.add_argument('--fid_batch', type=int, default=64, help='images per Inception forward pass')
+parser.add_argument('--stats_cache', type=str, default='checkpoints/fid_stats', help='where reference features and statistics are cached')
+parser.add_argument('--kid_subsets', type=int, default=100, help='number of random subsets KID is averaged over')
+parser.add_argument('--kid_subset_size', type=int, default=1000, help='size of the KID subsets')
+parser.add_argument('--force', type=int, default=0, help='re-evaluate checkpoints that already have scores for this test set')
+
+opt = parser.parse_args()
+print(opt)
+
+device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+patterns = opt.checkpoints
+if len(patterns) == 0:
+    patterns = [os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_*.pth')]
+paths = sort_checkpoints([p for pattern in patterns for p in glob.glob(pattern)])
+if len(paths) == 0:
+    raise SystemExit('no checkpoints match %s' % ' '.join(patterns))
+
+output_dir = os.path.join(opt.results_dir, opt.name)
+os.makedirs(output_dir, exist_ok=True)
+if opt.fid_reference_dir == '':
+    opt.fid_reference_dir = opt.reference_dir
+if opt.fid_reference_dir == '':
+    opt.fid = 0
+
+# Scores are kept per checkpoint file and evaluation setup, so only new or changed checkpoints are run.
+setup = manifest_key(opt.dataroot, make_dataset(opt.dataroot, stop=opt.how_many), size=opt.size,
+                     input_nc=opt.input_nc, output_nc=opt.output_nc, n_blocks=opt.n_blocks,
+                     reference_dir=opt.reference_dir, fid_reference_dir=opt.fid_reference_dir if opt.fid == 1 else '',
+                     kid_subsets=opt.kid_subsets, kid_subset_size=opt.kid_subset_size)
+scores_path = os.path.join(output_dir, 'sweep_scores.json')
+scores = {}
+if os.path.exists(scores_path):
+    with open(scores_path) as f:
+        scores = json.load(f)
+
+
+def checkpoint_key(path):
+    st = os.stat(path)
+    return '%s:%d:%d:%s' % (os.path.abspath(path), st.st_size, int(st.st_mtime), setup)
+
+
+todo = [p for p in paths if opt.force == 1 or opt.save_outputs == 1 or checkpoint_key(p) not in scores]
+print('%d of %d checkpoints already evaluated' % (len(paths) - len(todo), len(paths)))
+
+# The test set is decoded and resized once; every checkpoint runs over the same in-memory batches.
+if len(todo) > 0:
+    test_set = TestSet(opt.dataroot, size=opt.size, input_nc=opt.input_nc, reference_dir=opt.reference_dir,
+                       output_nc=opt.output_nc, batch_size=opt.batchSize, max_images=opt.how_many)
+    print('%d test images (%d with references)' % (len(test_set), test_set.with_reference))
+
+extractor = None
+reference = None
+if opt.fid == 1 and len(todo) > 0:
+    extractor = InceptionFeatures(device, batch_size=opt.fid_batch)
+    reference = reference_statistics(extractor, opt.fid_reference_dir, opt.stats_cache, size=opt.size,
+                                     output_nc=opt.output_nc)
+
+writer = ImageWriter('png', workers=opt.writer_workers) if opt.save_outputs == 1 else None
+
+net_G = Generator(opt.input_nc, opt.output_nc, opt.n_blocks)
+net_G.to(device)
+net_G.eval()
+
+for path, state in CheckpointPrefetcher(todo):
+    epoch = checkpoint_label(path)
+    net_G.load_state_dict(state)
+    out_dir = ''
+    if writer is not None:
+        out_dir = os.path.join(output_dir, 'sweep', epoch)
+        os.makedirs(out_dir, exist_ok=True)
+    metrics = run_checkpoint(net_G, test_set, device, writer=writer, out_dir=out_dir,
+                             on_output=extractor.add if extractor is not None else None)
+    if extractor is not None:
+        metrics.update(score(extractor.finish(), reference, opt.kid_subsets, opt.kid_subset_size))
+    metrics.update({'epoch': epoch, 'checkpoint': path})
+    scores[checkpoint_key(path)] = metrics
+    with open(scores_path, 'w') as f:
+        json.dump(scores, f, indent=2)
+    print('epoch %s: %.4fs per image%s%s' % (epoch, metrics['seconds_per_image'],
+          ', PSNR %.2f dB, SSIM %.4f' % (metrics['psnr'], metrics['ssim']) if 'psnr' in metrics else '',
+          ', FID %.2f, KID %.4f' % (metrics['fid'], metrics['kid']) if 'fid' in metrics else ''))
+
+if writer is not None:
+    writer.close()
+
+report = [scores[checkpoint_key(p)] for p in paths]
+
+report_path = os.path.join(output_dir, 'sweep_report.json')
+with open(report_path, 'w') as f:
+    json.dump(report, f, indent=2)
+
+columns = [c for c in ['psnr', 'ssim', 'fid', 'kid'] if any(c in m for m in report)]
+print('\n%-12s' % 'epoch' + ''.join('%10s' % c for c in columns))
+for m in report:
+    print('%-12s' % m['epoch'] + ''.join('%10.4f' % m[c] if c in m else '%10s' % '-' for c in columns))
+if 'fid' in columns:
+    print('best FID: epoch %s' % min(report, key=lambda m: m.get('fid', float('inf')))['epoch'])
+if 'psnr' in columns:
+    print('best PSNR: epoch %s' % max(report, key=lambda m: m.get('psnr', float('-inf')))['epoch'])
+print('report written to', report_path)
+
+"""
+python evaluate.py --name exp8 --dataroot examples/test --reference_dir examples/test_flat
+python evaluate.py --name exp8 --dataroot examples/test --checkpoints "checkpoints/exp8/netG_A_1*.pth"
+python evaluate.py --name exp8 --dataroot examples/test --fid_reference_dir examples/train/trainB
+"""
@@ -0,0 +1,85 @@
+import argparse
+import os
+import sys
+
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+from data.dataset import make_dataset
+from models.model import Generator, GeometryPredictor, GlobalGenerator2, InceptionV3
+from models.onnx_backend import check_parity, export_onnx, onnx_path, OnnxModule
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--name', required=True, type=str, help='name of the experiment to export')
+parser.add_argument('--checkpoints_dir', type=str, default='checkpoints', help='Where the model checkpoints are saved')
+parser.add_argument('--which_epoch', type=str, default='latest', help='which epoch to load from')
+parser.add_argument('--input_nc', type=int, default=3, help='number of channels of input data')
+parser.add_argument('--output_nc', type=int, default=3, help='number of channels of output data')
+parser.add_argument('--n_blocks', type=int, default=3, help='number of resnet blocks for generator')
+parser.add_argument('--size', type=int, default=256, help='size of the example input used for tracing')
+parser.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+
+parser.add_argument('--predict_depth', type=int, default=0, help='also export InceptionV3 + GlobalGenerator2 geometry')
+parser.add_argument('--geom_name', type=str, default='feats2Geom', help='name of the geometry predictor')
+parser.add_argument('--geom_nc', type=int, default=3, help='number of channels of geometry data')
+parser.add_argument('--num_classes', type=int, default=55, help='number of classes for inception')
+
+parser.add_argument('--check_parity', type=int, default=1, help='compare ONNX Runtime against PyTorch after export')
+parser.add_argument('--parity_dir', type=str, default='', help='images for the parity check, random inputs if empty')
+parser.add_argument('--parity_count', type=int, default=8, help='number of parity images')
+parser.add_argument('--atol', type=float, default=1e-3, help='largest allowed absolute difference')
+parser.add_argument('--ort_threads', type=int, default=0, help='ONNX Runtime intra-op threads, 0 for all cores')
+
+opt = parser.parse_args()
+print(opt)
+
+
+def parity_inputs():
+    if opt.parity_dir != '':
+        transform = transforms.Compose([transforms.Resize(int(opt.size), Image.BICUBIC), transforms.ToTensor()])
+        mode = 'L' if opt.input_nc == 1 else 'RGB'
+        return [transform(Image.open(path).convert(mode)).unsqueeze(0)
+                for path in make_dataset(opt.parity_dir, stop=opt.parity_count)]
+    # Several batch sizes and non-square shapes exercise the dynamic axes.
+    shapes = [(1, 256, 256), (2, 320, 448), (1, 512, 384)]
+    return [torch.rand(n, opt.input_nc, h, w) for n, h, w in shapes]
+
+
+def export_and_check(net, example, path, inputs):
+    export_onnx(net, example, path, opset=opt.opset)
+    print('exported', path)
+    if opt.check_parity == 1:
+        max_diff, ok = check_parity(net, OnnxModule(path, threads=opt.ort_threads), inputs, atol=opt.atol)
+        print('parity %s: max abs diff %.2e (%s)' % (os.path.basename(path), max_diff, 'ok' if ok else 'FAILED'))
+        return ok
+    return True
+
+
+example = torch.rand(1, opt.input_nc, opt.size, opt.size)
+inputs = parity_inputs()
+
+net_G = Generator(opt.input_nc, opt.output_nc, opt.n_blocks)
+net_G.load_state_dict(torch.load(os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch),
+                                 map_location='cpu'))
+ok = export_and_check(net_G, example, onnx_path(opt.checkpoints_dir, opt.name, opt.which_epoch), inputs)
+
+if opt.predict_depth == 1:
+    netGeom = GlobalGenerator2(768, opt.geom_nc, n_downsampling=1, n_UPsampling=3)
+    netGeom.load_state_dict(torch.load(os.path.join(opt.checkpoints_dir, opt.geom_name, 'feats2depth.pth'),
+                                       map_location='cpu'))
+    net_recog = InceptionV3(opt.num_classes, False, use_aux=True, pretrain=True, freeze=True, every_feat=True)
+    geom_head = GeometryPredictor(net_recog, netGeom).eval()
+    # The geometry network reads generated images, so check it on the generator outputs.
+    with torch.no_grad():
+        geom_inputs = [net_G(img) for img in inputs]
+        geom_example = net_G(torch.rand(1, opt.input_nc, opt.size, opt.size))
+    ok = export_and_check(geom_head, geom_example,
+                          onnx_path(opt.checkpoints_dir, opt.name, opt.which_epoch, net='geometry'), geom_inputs) and ok
+
+sys.exit(0 if ok else 1)
+
+"""
+python export_onnx.py --name exp8 --parity_dir examples/test
+python test.py --name exp8 --dataroot examples/test --backend onnx --ort_threads 8
+"""
@@ -0,0 +1,94 @@
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+from data.dataset import make_dataset
+from data.map_store import MapStore
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--maps_dir', required=True, type=str, help='directory of depth or sketch maps named after their images, e.g. examples/train/depthmaps')
+parser.add_argument('--dataroot', required=True, type=str, help='directory of the images the maps belong to')
+parser.add_argument('--store', required=True, type=str, help='map store the maps are packed into')
+parser.add_argument('--bits', type=int, default=0, help='8 or 16 bits per pixel, 0 keeps the bit depth of each file (16 for MiDaS/LeRes PNGs)')
+parser.add_argument('--n_cpu', type=int, default=8, help='number of processes decoding maps')
+parser.add_argument('--hash', type=int, default=0, help='record content hashes, so files whose mtime changed but whose contents did not are skipped')
+parser.add_argument('--force', type=int, default=0, help='re-ingest every map')
+parser.add_argument('--flush_every', type=int, default=1000, help='maps between index flushes; an interrupted run resumes from the last flush')
+parser.add_argument('--compact', type=int, default=0, help='reclaim the space of replaced maps at the end')
+
+
+def read_map(args):
+    """Decode a map file to H x W uint8/uint16; colour maps are reduced to their grey level."""
+    path, bits = args
+    array = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if array is None:
+        return None
+    if array.ndim == 3:
+        array = array[:, :, :3]
+        # Depth maps saved as colour images repeat one grey value in every channel.
+        if not ((array[:, :, 0] == array[:, :, 1]).all() and (array[:, :, 1] == array[:, :, 2]).all()):
+            array = cv2.cvtColor(array, cv2.COLOR_BGR2GRAY)
+        else:
+            array = array[:, :, 0]
+    if array.dtype not in (np.uint8, np.uint16):
+        # Float maps (PFM, EXR) are normalised to the full 16-bit range.
+        array = array.astype(np.float64)
+        lo, hi = array.min(), array.max()
+        array = ((array - lo) / max(hi - lo, 1e-12) * 65535 + 0.5).astype(np.uint16)
+    if bits == 8 and array.dtype == np.uint16:
+        array = (array >> 8).astype(np.uint8)
+    elif bits == 16 and array.dtype == np.uint8:
+        array = array.astype(np.uint16) * 257
+    return np.ascontiguousarray(array)
+
+
+if __name__ == '__main__':
+    opt = parser.parse_args()
+    print(opt)
+
+    store = MapStore(opt.store, opt.dataroot, writable=True)
+    # Maps are paired with images the way UnpairedDepthDataset pairs them: by file name, ignoring the extension.
+    slots = {os.path.splitext(os.path.basename(path))[0]: slot for slot, path in store.update_manifest()}
+    pairs = []
+    unmatched = 0
+    for path in make_dataset(opt.maps_dir, stop=float('inf')):
+        slot = slots.get(os.path.splitext(os.path.basename(path))[0])
+        if slot is None:
+            unmatched += 1
+        else:
+            pairs.append((slot, path))
+    todo = [(slot, path) for slot, path in pairs
+            if opt.force == 1 or not store.up_to_date(slot, path, use_hash=opt.hash == 1)]
+    print('%d maps (%d without an image), %d up to date, %d to ingest' % (len(pairs) + unmatched, unmatched,
+                                                                          len(pairs) - len(todo), len(todo)))
+
+    start = time.time()
+    failed = []
+    with Pool(opt.n_cpu) as pool:
+        arrays = pool.imap(read_map, [(path, opt.bits) for _, path in todo], chunksize=16)
+        for i, ((slot, path), array) in enumerate(zip(todo, arrays)):
+            if array is None:
+                failed.append(path)
+            else:
+                store.put(slot, array, path, use_hash=opt.hash == 1)
+            if (i + 1) % opt.flush_every == 0:
+                store.flush()
+            sys.stdout.write('\rIngested %d of %d maps (%.1f maps/s)' % (i + 1, len(todo), (i + 1) / (time.time() - start)))
+
+    sys.stdout.write('\n')
+    store.close()
+    if opt.compact == 1:
+        store.compact()
+    for path in failed:
+        print('could not decode', path)
+    print(store.stats())
+
+"""
+python ingest_maps.py --maps_dir examples/train/depthmaps --dataroot examples/train/full_color --store examples/train/depth_store
+python train.py --name exp11 --full_color_dir examples/train/full_color --midas 1 --depth_store examples/train/depth_store ...
+"""
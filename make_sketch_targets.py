@@ -0,0 +1,83 @@
+import argparse
+import sys
+import time
+
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from data.dataset import ImageListDataset
+from data.map_store import MapStore
+from data.sampler import load_sizes, pad_collate, SizeBucketBatchSampler
+from utils.compile import crop_to_input
+from utils.pipeline import Head, InferencePipeline, load_generator
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--name', type=str, default='anime_style', help='experiment of the sketch generator')
+parser.add_argument('--checkpoints_dir', type=str, default='checkpoints', help='Where the model checkpoints are saved')
+parser.add_argument('--which_epoch', type=str, default='latest', help='which epoch to load from')
+parser.add_argument('--dataroot', required=True, type=str, help='directory of the full colour training images')
+parser.add_argument('--store', required=True, type=str, help='map store the sketch targets are written to')
+parser.add_argument('--input_nc', type=int, default=3, help='number of channels of input data')
+parser.add_argument('--n_blocks', type=int, default=3, help='number of resnet blocks for generator')
+parser.add_argument('--size', type=int, default=256, help='shorter side the images are resized to before sketching, 0 to keep their size')
+parser.add_argument('--batchSize', type=int, default=8, help='size of the batches')
+parser.add_argument('--n_cpu', type=int, default=8, help='number of processes decoding images')
+parser.add_argument('--device', type=str, default='', help='cuda or cpu, defaults to cuda when available')
+parser.add_argument('--hash', type=int, default=0, help='record content hashes, so files whose mtime changed but whose contents did not are skipped')
+parser.add_argument('--force', type=int, default=0, help='regenerate every target')
+parser.add_argument('--flush_every', type=int, default=50, help='batches between index flushes; an interrupted run resumes from the last flush')
+parser.add_argument('--compact', type=int, default=0, help='reclaim the space of replaced targets at the end')
+
+opt = parser.parse_args()
+print(opt)
+
+device = torch.device(opt.device if opt.device != '' else ('cuda' if torch.cuda.is_available() else 'cpu'))
+
+store = MapStore(opt.store, opt.dataroot, writable=True)
+present = store.update_manifest()
+todo = [(slot, path) for slot, path in present
+        if opt.force == 1 or not store.up_to_date(slot, path, use_hash=opt.hash == 1)]
+print('%d images, %d targets up to date, %d to generate' % (len(present), len(present) - len(todo), len(todo)))
+if len(todo) == 0:
+    store.close()
+    sys.exit(0)
+
+net_G = load_generator('%s/%s/netG_A_%s.pth' % (opt.checkpoints_dir, opt.name, opt.which_epoch),
+                       opt.input_nc, 1, opt.n_blocks, device)
+pipeline = InferencePipeline([Head('sketch', net_G)])
+
+transform = [transforms.ToTensor()]
+if opt.size > 0:
+    transform = [transforms.Resize(int(opt.size), Image.BICUBIC)] + transform
+dataset = ImageListDataset(todo, transform, mode='L' if opt.input_nc == 1 else 'RGB')
+batch_sampler = SizeBucketBatchSampler(load_sizes([path for _, path in todo], opt.size), opt.batchSize)
+dataloader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=opt.n_cpu, collate_fn=pad_collate)
+
+start = time.time()
+done = 0
+with torch.no_grad():
+    for i, batch in enumerate(dataloader):
+        img = batch['r'].to(device)
+        sketch = pipeline.run(img)['sketch']
+        # Same rounding as the PNGs test_sketch.py writes.
+        sketch = sketch.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8).cpu()
+        for j, (slot, path) in enumerate(zip(batch['key'].tolist(), batch['path'])):
+            store.put(slot, crop_to_input(sketch[j:j + 1], img, batch['size'][j].tolist())[0, 0].numpy(), path,
+                      use_hash=opt.hash == 1)
+        done += len(batch['path'])
+        if (i + 1) % opt.flush_every == 0:
+            store.flush()
+        sys.stdout.write('\rGenerated %d of %d targets (%.1f images/s)' % (done, len(todo), done / (time.time() - start)))
+
+sys.stdout.write('\n')
+store.close()
+if opt.compact == 1:
+    store.compact()
+print(store.stats())
+
+"""
+python make_sketch_targets.py --dataroot examples/train/full_color --store examples/train/sketch_targets
+python train.py --name exp11 --full_color_dir examples/train/full_color --sketch_store examples/train/sketch_targets ...
+"""
@@ -222,6 +222,33 @@ class InceptionV3(nn.Module):  # avg pool
         else:
             self.model_ft.eval()
 
+    def geom_features(self, x):
+        """Run the network only as far as Mixed_6b, the features read by the geometry network (every_feat)."""
+        x = self.model_ft.Conv2d_1a_3x3(x)
+        x = self.model_ft.Conv2d_2a_3x3(x)
+        x = self.model_ft.Conv2d_2b_3x3(x)
+        x = F.max_pool2d(x, kernel_size=3, stride=2)
+        x = self.model_ft.Conv2d_3b_1x1(x)
+        x = self.model_ft.Conv2d_4a_3x3(x)
+        x = F.max_pool2d(x, kernel_size=3, stride=2)
+        x = self.model_ft.Mixed_5b(x)
+        x = self.model_ft.Mixed_5c(x)
+        x = self.model_ft.Mixed_5d(x)
+        x = self.model_ft.Mixed_6a(x)
+        # N x 768 x 17 x 17
+        return self.model_ft.Mixed_6b(x)
+
+    def pool_features(self, x):
+        """2048-d average-pooled Mixed_7c activations (the 'pool3' features used for FID and KID)."""
+        x = self.geom_features(x)
+        x = self.model_ft.Mixed_6c(x)
+        x = self.model_ft.Mixed_6d(x)
+        x = self.model_ft.Mixed_6e(x)
+        x = self.model_ft.Mixed_7a(x)
+        x = self.model_ft.Mixed_7b(x)
+        x = self.model_ft.Mixed_7c(x)
+        return torch.flatten(F.adaptive_avg_pool2d(x, (1, 1)), 1)
+
     def forward(self, x, cond=None, catch_gates=False):
         # N x 3 x 299 x 299
         x = self.model_ft.Conv2d_1a_3x3(x)
@@ -293,3 +320,17 @@ class InceptionV3(nn.Module):  # avg pool
             return x, feat21
 
         return x, aux
+
+
+class GeometryPredictor(nn.Module):
+    """Depth geometry of an image: truncated InceptionV3 features followed by the feats2depth network."""
+    def __init__(self, net_recog, net_geom):
+        super(GeometryPredictor, self).__init__()
+        self.net_recog = net_recog
+        self.net_geom = net_geom
+
+    def forward(self, x):
+        if x.size()[1] == 1:
+            x = x.repeat(1, 3, 1, 1)
+        geom = self.net_geom(self.net_recog.geom_features(x))
+        return (geom + 1) / 2.0  ###[-1, 1] ---> [0, 1]
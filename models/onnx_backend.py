@@ -0,0 +1,65 @@
+"""ONNX export of the inference networks and an ONNX Runtime backend for test.py.
+
+Graphs are exported with dynamic batch, height and width axes, so one file serves every image size.
+`OnnxModule` runs a graph on the CPU execution provider behind the same tensor-in/tensor-out call as
+the PyTorch networks, so the rest of the inference code does not care which backend it talks to.
+"""
+import os
+
+import numpy as np
+import torch
+
+
+def onnx_path(checkpoints_dir, name, which_epoch, net="netG_A"):
+    return os.path.join(checkpoints_dir, name, "%s_%s.onnx" % (net, which_epoch))
+
+
+def export_onnx(net, example, path, opset=17):
+    """Export net to path with dynamic N/H/W axes on its single image input and output."""
+    dynamic_axes = {"input": {0: "batch", 2: "height", 3: "width"},
+                    "output": {0: "batch", 2: "height", 3: "width"}}
+    net.eval()
+    with torch.no_grad():
+        torch.onnx.export(net, (example,), path, input_names=["input"], output_names=["output"],
+                          dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True)
+    return path
+
+
+class OnnxModule():
+    """ONNX Runtime session with the calling convention of a PyTorch network.
+
+    Parameters:
+        path (str)           -- exported .onnx graph
+        threads (int)        -- intra-op threads, 0 lets ONNX Runtime use every physical core
+        inter_threads (int)  -- inter-op threads for independent graph branches, 0 for the default
+    """
+    def __init__(self, path, threads=0, inter_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        if inter_threads > 0:
+            options.inter_op_num_threads = inter_threads
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.path = path
+
+    def __call__(self, x):
+        x = np.ascontiguousarray(x.detach().cpu().float().numpy())
+        return torch.from_numpy(self.session.run(None, {self.input_name: x})[0])
+
+    def eval(self):
+        return self
+
+
+def check_parity(net, session, images, atol=1e-3):
+    """Compare PyTorch and ONNX Runtime outputs; returns the largest absolute difference over images."""
+    max_diff = 0.0
+    with torch.no_grad():
+        for img in images:
+            diff = torch.max(torch.abs(net(img).cpu() - session(img))).item()
+            max_diff = max(max_diff, diff)
+    return max_diff, max_diff <= atol
@@ -0,0 +1,62 @@
+"""Post-training static int8 quantisation of the Generator for CPU inference.
+
+The Generator is traced with FX graph mode quantisation, which inserts observers, and after calibration
+replaces convolutions, transposed convolutions, instance norms, the residual adds and the output sigmoid
+with their quantized kernels. The result is stored as a TorchScript artifact next to the fp32
+checkpoint, so test.py can load it without the model definition.
+
+Nothing is fused. FX only fuses a conv directly followed by a ReLU (or a BatchNorm), and every conv of
+the Generator is followed by an InstanceNorm2d. InstanceNorm cannot be folded into the conv weights
+because its statistics are computed per image at run time, and there is no quantized
+conv+InstanceNorm or InstanceNorm+ReLU kernel. So each conv, norm and ReLU stays a separate int8
+op; the ReLU on a quantized tensor is only a clamp.
+"""
+import copy
+import os
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+
+def quantized_path(checkpoints_dir, name, which_epoch):
+    return os.path.join(checkpoints_dir, name, "netG_A_%s_int8.pt" % which_epoch)
+
+
+def prepare_generator(net, example, engine="x86", float_norm=False):
+    """Return an observed copy of net ready for calibration.
+
+    Parameters:
+        net (Generator)         -- fp32 generator in eval mode
+        example (tensor)        -- example input batch used to trace the graph
+        engine (str)            -- quantized engine, x86/fbgemm for servers, qnnpack for ARM
+        float_norm (bool)       -- keep InstanceNorm2d in fp32 if its quantized kernel is not accurate enough
+    """
+    torch.backends.quantized.engine = engine
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+    if float_norm:
+        qconfig_mapping.set_object_type(nn.InstanceNorm2d, None)
+    net = copy.deepcopy(net).cpu().eval()
+    return prepare_fx(net, qconfig_mapping, example_inputs=(example,))
+
+
+def calibrate(prepared, images):
+    """Run calibration batches through the observed model to collect activation ranges."""
+    with torch.no_grad():
+        for img in images:
+            prepared(img)
+    return prepared
+
+
+def convert_generator(prepared, example):
+    """Convert a calibrated model to int8 and trace it to a TorchScript module."""
+    quantized = convert_fx(prepared)
+    with torch.no_grad():
+        return torch.jit.trace(quantized, example)
+
+
+def load_quantized(path):
+    net = torch.jit.load(path, map_location="cpu")
+    net.eval()
+    return net
@@ -0,0 +1,111 @@
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+from data.dataset import make_dataset
+from utils.palette import composite_alpha, parse_background, reduce_palette
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_dir', required=True, type=str, help='directory of unprocessed flat-colour images, e.g. examples/train/unprocessed_flat_color')
+parser.add_argument('--output_dir', required=True, type=str, help='where the prepared images are written, mirroring the input tree; never the input directory')
+parser.add_argument('--colors', type=int, default=250, help='palette size, 0 to only composite transparency')
+parser.add_argument('--method', type=str, default='median_cut', help='palette construction [median_cut | kmeans]')
+parser.add_argument('--kmeans_iters', type=int, default=8, help='k-means refinement iterations of the median-cut palette')
+parser.add_argument('--background', type=str, default='random', help='colour transparent pixels are composited onto: white, random (per image, reproducible) or r,g,b')
+parser.add_argument('--n_cpu', type=int, default=8, help='number of worker processes')
+parser.add_argument('--force', type=int, default=0, help='redo images whose output is up to date')
+
+
+def up_to_date(path, out_path, stamp):
+    """Whether out_path exists, is newer than path and was made with the settings in stamp."""
+    if not os.path.exists(out_path) or os.path.getmtime(out_path) < os.path.getmtime(path):
+        return False
+    try:
+        with Image.open(out_path) as img:
+            return img.text.get('prepare') == stamp
+    except Exception:
+        return False
+
+
+def prepare(args):
+    """Prepare one image; returns (path, megapixels, error)."""
+    path, out_path, opt, stamp = args
+    try:
+        with Image.open(path) as img:
+            img.load()
+            if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+                # Random backgrounds are seeded by the file name, so reruns give identical outputs.
+                rng = np.random.RandomState(zlib.crc32(os.path.basename(path).encode()))
+                rgb = composite_alpha(np.asarray(img.convert('RGBA')), parse_background(opt['background'], rng))
+            else:
+                rgb = np.asarray(img.convert('RGB'))
+        if opt['colors'] > 0:
+            rgb = reduce_palette(rgb, opt['colors'], opt['method'], opt['kmeans_iters'])
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        tmp = out_path + '.tmp.png'
+        # The settings travel with every output, which makes each file individually up to date or not.
+        info = PngInfo()
+        info.add_text('prepare', stamp)
+        Image.fromarray(rgb, mode='RGB').save(tmp, pnginfo=info)
+        os.replace(tmp, out_path)
+        return path, rgb.shape[0] * rgb.shape[1] / 1e6, ''
+    except Exception as e:
+        return path, 0.0, '%s: %s' % (type(e).__name__, e)
+
+
+if __name__ == '__main__':
+    opt = parser.parse_args()
+    print(opt)
+    if os.path.abspath(opt.input_dir) == os.path.abspath(opt.output_dir):
+        raise SystemExit('--output_dir must differ from --input_dir')
+
+    settings = {'colors': opt.colors, 'method': opt.method, 'kmeans_iters': opt.kmeans_iters,
+                'background': opt.background}
+    stamp = json.dumps(settings, sort_keys=True)
+
+    jobs = []
+    paths = make_dataset(opt.input_dir, stop=float('inf'))
+    for path in paths:
+        out_path = os.path.join(opt.output_dir, os.path.splitext(os.path.relpath(path, opt.input_dir))[0] + '.png')
+        # Outputs are replaced atomically, so an existing output is complete and an interrupted run resumes.
+        if opt.force == 0 and up_to_date(path, out_path, stamp):
+            continue
+        jobs.append((path, out_path, settings, stamp))
+    print('%d images, %d up to date, %d to prepare' % (len(paths), len(paths) - len(jobs), len(jobs)))
+
+    start = time.time()
+    last = 0.0
+    megapixels = 0.0
+    failed = []
+    with Pool(opt.n_cpu) as pool:
+        for done, (path, mp, error) in enumerate(pool.imap_unordered(prepare, jobs, chunksize=2), 1):
+            megapixels += mp
+            if error != '':
+                failed.append((path, error))
+            elapsed = time.time() - start
+            if elapsed - last >= 1.0 or done == len(jobs):
+                last = elapsed
+                rate = done / max(elapsed, 1e-9)
+                sys.stdout.write('\r%d/%d images, %.1f images/s, %.1f MPix/s, %d failed, ETA %ds   '
+                                 % (done, len(jobs), rate, megapixels / max(elapsed, 1e-9), len(failed),
+                                    (len(jobs) - done) / max(rate, 1e-9)))
+                sys.stdout.flush()
+
+    sys.stdout.write('\n')
+    for path, error in failed:
+        print('failed: %s (%s)' % (path, error))
+    print('prepared %d images (%.1f MPix) in %.1fs into %s' % (len(jobs) - len(failed), megapixels,
+                                                               time.time() - start, opt.output_dir))
+
+"""
+python prepare_flat_colour.py --input_dir examples/train/unprocessed_flat_color --output_dir examples/train/flat_color
+python prepare_flat_colour.py --input_dir examples/train/unprocessed_flat_color --output_dir examples/train/flat_color_km --method kmeans
+"""
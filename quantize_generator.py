@@ -0,0 +1,83 @@
+import argparse
+import os
+import time
+
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+from data.dataset import make_dataset
+from models.model import Generator
+from models.quantize import calibrate, convert_generator, prepare_generator, quantized_path
+from utils.metrics import psnr, ssim
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--name', required=True, type=str, help='name of the experiment whose netG_A is quantised')
+parser.add_argument('--checkpoints_dir', type=str, default='checkpoints', help='Where the model checkpoints are saved')
+parser.add_argument('--which_epoch', type=str, default='latest', help='which epoch to load from')
+parser.add_argument('--input_nc', type=int, default=3, help='number of channels of input data')
+parser.add_argument('--output_nc', type=int, default=3, help='number of channels of output data')
+parser.add_argument('--n_blocks', type=int, default=3, help='number of resnet blocks for generator')
+parser.add_argument('--size', type=int, default=256, help='images are resized so their shorter side has this size')
+
+parser.add_argument('--calib_dir', required=True, type=str, help='directory of sample images used for calibration')
+parser.add_argument('--calib_count', type=int, default=64, help='number of calibration images')
+parser.add_argument('--eval_dir', type=str, default='', help='images for the accuracy check, defaults to calib_dir')
+parser.add_argument('--eval_count', type=int, default=32, help='number of images for the accuracy check')
+parser.add_argument('--engine', type=str, default='x86', help='quantized engine [x86 | fbgemm | qnnpack]')
+parser.add_argument('--float_norm', type=int, default=0, help='keep InstanceNorm2d layers in fp32')
+parser.add_argument('--output', type=str, default='', help='artifact path, defaults to netG_A_<which_epoch>_int8.pt')
+
+opt = parser.parse_args()
+print(opt)
+
+
+def load_images(root, count):
+    transform = transforms.Compose([transforms.Resize(int(opt.size), Image.BICUBIC), transforms.ToTensor()])
+    mode = 'L' if opt.input_nc == 1 else 'RGB'
+    return [transform(Image.open(path).convert(mode)).unsqueeze(0) for path in make_dataset(root, stop=count)]
+
+
+def timed(net, images):
+    outputs = []
+    start = time.time()
+    with torch.no_grad():
+        for img in images:
+            outputs.append(net(img))
+    return outputs, (time.time() - start) / max(len(images), 1)
+
+
+net_G = Generator(opt.input_nc, opt.output_nc, opt.n_blocks)
+fp32_path = os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch)
+net_G.load_state_dict(torch.load(fp32_path, map_location='cpu'))
+net_G.eval()
+print('loaded', fp32_path)
+
+calib_images = load_images(opt.calib_dir, opt.calib_count)
+print('Calibrating on %d images' % len(calib_images))
+prepared = prepare_generator(net_G, calib_images[0], engine=opt.engine, float_norm=opt.float_norm == 1)
+calibrate(prepared, calib_images)
+net_int8 = convert_generator(prepared, calib_images[0])
+
+output = opt.output if opt.output != '' else quantized_path(opt.checkpoints_dir, opt.name, opt.which_epoch)
+torch.jit.save(net_int8, output)
+print('saved', output)
+
+# Accuracy and speed of the int8 model against the fp32 output on the same images.
+eval_images = load_images(opt.eval_dir if opt.eval_dir != '' else opt.calib_dir, opt.eval_count)
+out_fp32, time_fp32 = timed(net_G, eval_images)
+out_int8, time_int8 = timed(net_int8, eval_images)
+psnrs = torch.cat([psnr(a, b) for a, b in zip(out_int8, out_fp32)])
+ssims = torch.cat([ssim(a, b) for a, b in zip(out_int8, out_fp32)])
+
+size_fp32 = os.path.getsize(fp32_path) / 2 ** 20
+size_int8 = os.path.getsize(output) / 2 ** 20
+print('int8 vs fp32 over %d images: PSNR %.2f dB (min %.2f), SSIM %.4f (min %.4f)' %
+      (len(eval_images), psnrs.mean(), psnrs.min(), ssims.mean(), ssims.min()))
+print('latency per image: fp32 %.3fs, int8 %.3fs (%.2fx)' % (time_fp32, time_int8, time_fp32 / max(time_int8, 1e-9)))
+print('weights: fp32 %.1f MB, int8 %.1f MB' % (size_fp32, size_int8))
+
+"""
+python quantize_generator.py --name exp8 --calib_dir examples/test
+python test.py --name exp8 --dataroot examples/test --quantized 1
+"""
@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import torch
+
+from data.dataset import make_dataset
+from models.model import Generator
+from models.onnx_backend import onnx_path, OnnxModule
+from models.quantize import load_quantized, quantized_path
+from utils.incremental import LineageCache, receptive_radius
+from utils.tiling import is_eager_float
+from utils.server import http_request, MicroBatchServer
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--name', required=True, type=str, help='name of the experiment to serve')
+parser.add_argument('--checkpoints_dir', type=str, default='checkpoints', help='Where the model checkpoints are saved')
+parser.add_argument('--which_epoch', type=str, default='latest', help='which epoch to load from')
+parser.add_argument('--input_nc', type=int, default=3, help='number of channels of input data')
+parser.add_argument('--output_nc', type=int, default=3, help='number of channels of output data')
+parser.add_argument('--n_blocks', type=int, default=3, help='number of resnet blocks for generator')
+parser.add_argument('--size', type=int, default=256, help='shorter side uploads are resized to, 0 to keep their size')
+parser.add_argument('--backend', type=str, default='torch', help='inference backend [torch | onnx]')
+parser.add_argument('--quantized', type=int, default=0, help='serve the int8 artifact written by quantize_generator.py')
+parser.add_argument('--ort_threads', type=int, default=0, help='ONNX Runtime intra-op threads, 0 for all cores')
+
+parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+parser.add_argument('--port', type=int, default=8008, help='port to listen on')
+parser.add_argument('--max_batch', type=int, default=8, help='largest micro-batch')
+parser.add_argument('--max_wait_ms', type=float, default=10, help='how long the first queued request waits for the batch to fill')
+parser.add_argument('--workers', type=int, default=4, help='threads for decoding uploads and encoding results')
+parser.add_argument('--lineages', type=int, default=16, help='image lineages kept for incremental ?lineage= conversions, 0 to disable; only with the eager torch backend')
+parser.add_argument('--lineage_tile', type=int, default=128, help='tile size at which resubmitted images are compared and recomputed')
+parser.add_argument('--lineage_threshold', type=float, default=2.0, help='largest per-pixel difference (0-255) of a tile treated as unchanged')
+parser.add_argument('--max_upload_mb', type=float, default=32, help='largest accepted upload, larger requests get 413')
+parser.add_argument('--check_dir', type=str, default='', help='send the images in this directory concurrently over loopback, print the metrics and exit')
+
+opt = parser.parse_args()
+print(opt)
+
+# The checkpoint is loaded once for the lifetime of the server.
+device = torch.device('cuda') if torch.cuda.is_available() and opt.backend == 'torch' and opt.quantized == 0 \
+    else torch.device('cpu')
+if opt.backend == 'onnx':
+    net_G = OnnxModule(onnx_path(opt.checkpoints_dir, opt.name, opt.which_epoch), threads=opt.ort_threads)
+elif opt.quantized == 1:
+    net_G = load_quantized(quantized_path(opt.checkpoints_dir, opt.name, opt.which_epoch))
+else:
+    net_G = Generator(opt.input_nc, opt.output_nc, opt.n_blocks)
+    net_G.load_state_dict(torch.load(os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch),
+                                     map_location=device))
+    net_G.to(device)
+net_G.eval()
+
+# Resubmissions of a lineage only recompute the tiles within the receptive field of their edits.
+lineages = None
+if opt.lineages > 0 and not is_eager_float(net_G):
+    # The receptive-field probe and the frozen InstanceNorm statistics need an eager float network.
+    print('incremental conversion disabled: the %s backend is not an eager float network'
+          % ('int8' if opt.quantized == 1 else opt.backend))
+elif opt.lineages > 0:
+    halo = receptive_radius(net_G, opt.input_nc, device)
+    lineages = LineageCache(net_G, max_lineages=opt.lineages, tile=opt.lineage_tile, halo=halo,
+                            threshold=opt.lineage_threshold / 255.0)
+    print('incremental conversion: %dpx tiles with a %dpx halo' % (opt.lineage_tile, halo))
+
+server = MicroBatchServer(net_G, device, size=opt.size, input_nc=opt.input_nc, max_batch=opt.max_batch,
+                          max_wait=opt.max_wait_ms / 1000.0, workers=opt.workers,
+                          info={'name': opt.name, 'epoch': opt.which_epoch, 'backend': opt.backend},
+                          lineages=lineages, max_upload=int(opt.max_upload_mb * 2 ** 20))
+
+
+async def loopback_check():
+    task = asyncio.ensure_future(server.serve(opt.host, opt.port))
+    await asyncio.sleep(0.5)
+    status, _, body = await http_request(opt.host, opt.port, 'GET', '/health')
+    print('health', status, body.decode())
+
+    uploads = []
+    for path in make_dataset(opt.check_dir):
+        with open(path, 'rb') as f:
+            uploads.append(f.read())
+    start = time.time()
+    results = await asyncio.gather(*[http_request(opt.host, opt.port, 'POST', '/convert', body=data,
+                                                  headers={'Content-Type': 'application/octet-stream'})
+                                     for data in uploads])
+    elapsed = time.time() - start
+    ok = sum(1 for status, _, _ in results if status == 200)
+    print('%d/%d conversions succeeded in %.2fs (%.1f images/s)' % (ok, len(uploads), elapsed,
+                                                                    len(uploads) / max(elapsed, 1e-9)))
+
+    status, _, body = await http_request(opt.host, opt.port, 'GET', '/metrics')
+    print('metrics', json.dumps(json.loads(body.decode()), indent=2))
+    task.cancel()
+
+
+if opt.check_dir != '':
+    asyncio.run(loopback_check())
+else:
+    asyncio.run(server.serve(opt.host, opt.port))
+
+"""
+python serve.py --name exp8 --port 8008
+curl --data-binary @examples/test/image.png "http://127.0.0.1:8008/convert?format=webp" -o out.webp
+curl --data-binary @canvas_v2.png "http://127.0.0.1:8008/convert?lineage=canvas" -o canvas_v2_out.png
+python serve.py --name exp8 --check_dir examples/test
+"""
@@ -3,168 +3,382 @@
 import argparse
 import sys
 import os
+import time
 
 import torchvision.transforms as transforms
-from torchvision.utils import save_image
-from torch.utils.data import DataLoader
-from torch.autograd import Variable
 import torch
 
-from models.model import Generator, GlobalGenerator2, InceptionV3
+from models.model import Generator
+from models.onnx_backend import onnx_path, OnnxModule
+from models.quantize import load_quantized, quantized_path
 from data.dataset import UnpairedDepthDataset
+from data.image_index import inspect_image
 from PIL import Image
 from utils.utils import channel2width
+from utils.compile import compile_net, crop_to_input, set_compile_cache
+from utils.memory_format import convert_net
+from utils.tiling import activation_bytes_per_pixel, is_eager_float, plan_tiles, tiled_forward
+from utils.guided_filter import guided_forward
+from utils.incremental import IncrementalForward, receptive_radius
+from utils.metrics import psnr, ssim
+from utils.result_cache import ResultCache
+from utils.image_writer import EXTENSIONS, ImageWriter
+from utils.shards import ShardWriter
+from utils.watch import DirectoryWatcher, ProcessedJournal
+from utils.pipeline import add_inference_options, geometry_path, Head, InferencePipeline, load_generator, \
+    load_geometry, make_loader, padded_batches
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--name', required=True, type=str, help='name of this experiment')
-parser.add_argument('--checkpoints_dir', type=str, default='checkpoints', help='Where the model checkpoints are saved')
-parser.add_argument('--results_dir', type=str, default='results', help='where to save result images')
-parser.add_argument('--geom_name', type=str, default='feats2Geom', help='name of the geometry predictor')
-parser.add_argument('--batchSize', type=int, default=1, help='size of the batches')
-parser.add_argument('--dataroot', type=str, default='', help='root directory of the dataset')
-parser.add_argument('--depthroot', type=str, default='', help='dataset of corresponding ground truth depth maps')
-
-parser.add_argument('--input_nc', type=int, default=3, help='number of channels of input data')
-parser.add_argument('--output_nc', type=int, default=3, help='number of channels of output data')
-parser.add_argument('--geom_nc', type=int, default=3, help='number of channels of geometry data')
-parser.add_argument('--every_feat', type=int, default=1, help='use transfer features for the geometry loss')
-parser.add_argument('--num_classes', type=int, default=55, help='number of classes for inception')
-parser.add_argument('--midas', type=int, default=0, help='use midas depth map')
-
-parser.add_argument('--ngf', type=int, default=64, help='# of gen filters in first conv layer')
-parser.add_argument('--n_blocks', type=int, default=3, help='number of resnet blocks for generator')
-parser.add_argument('--size', type=int, default=256, help='size of the data (squared assumed)')
-parser.add_argument('--cuda', action='store_true', help='use GPU computation', default=True)
-parser.add_argument('--n_cpu', type=int, default=8, help='number of cpu threads to use during batch generation')
-parser.add_argument('--which_epoch', type=str, default='latest', help='which epoch to load from')
-parser.add_argument('--aspect_ratio', type=float, default=1.0, help='The ratio width/height. The final height of the load image will be crop_size/aspect_ratio')
-
-parser.add_argument('--mode', type=str, default='test', help='train, val, test, etc')
-parser.add_argument('--load_size', type=int, default=256, help='scale images to this size')
-parser.add_argument('--crop_size', type=int, default=256, help='then crop to this size')
-parser.add_argument('--max_dataset_size', type=int, default=float("inf"), help='Maximum number of samples allowed per dataset. If the dataset directory contains more than max_dataset_size, only a subset is loaded.')
-parser.add_argument('--preprocess', type=str, default='resize_and_crop', help='scaling and cropping of images at load time [resize_and_crop | crop | scale_width | scale_width_and_crop | none]')
-parser.add_argument('--no_flip', action='store_true', help='if specified, do not flip the images for data augmentation')
-parser.add_argument('--norm', type=str, default='instance', help='instance normalization or batch normalization')
-
-parser.add_argument('--predict_depth', type=int, default=0, help='run geometry prediction on the generated images')
-parser.add_argument('--save_input', type=int, default=0, help='save input image')
-parser.add_argument('--reconstruct', type=int, default=0, help='get reconstruction')
-parser.add_argument('--how_many', type=int, default=100, help='number of images to test')
+add_inference_options(parser)
+parser.add_argument('--geom_source', type=str, default='out', help='what the geometry is predicted from [out | sketch]')
+parser.add_argument('--sketch_name', type=str, default='', help='experiment whose netG_A produces sketches of the inputs in the same pass (_sketch outputs), empty to disable')
+parser.add_argument('--sketch_epoch', type=str, default='latest', help='which epoch of the sketch generator to load')
+parser.add_argument('--sketch_nc', type=int, default=1, help='number of channels of the sketches')
+parser.add_argument('--quantized', type=int, default=0, help='run the int8 netG_A artifact written by quantize_generator.py (CPU only)')
+parser.add_argument('--quantized_path', type=str, default='', help='int8 artifact path, defaults to netG_A_<which_epoch>_int8.pt')
+parser.add_argument('--backend', type=str, default='torch', help='inference backend [torch | onnx], onnx runs the graphs written by export_onnx.py')
+parser.add_argument('--ort_threads', type=int, default=0, help='ONNX Runtime intra-op threads, 0 for all cores')
+parser.add_argument('--ort_inter_threads', type=int, default=0, help='ONNX Runtime inter-op threads, 0 for the default')
+parser.add_argument('--tile_size', type=int, default=0, help='run at full resolution in overlapping tiles of this size, 0 to resize to --size instead')
+parser.add_argument('--tile_overlap', type=int, default=32, help='overlap between neighbouring tiles, blended with windowed weights')
+parser.add_argument('--tile_batch', type=int, default=4, help='number of tiles per forward pass')
+parser.add_argument('--tile_memory_mb', type=int, default=0, help='peak activation memory budget for the tiles, overrides --tile_batch when > 0')
+parser.add_argument('--tile_global_norm', type=int, default=1, help='normalise all tiles with InstanceNorm statistics from one low-res pass of the whole image')
+parser.add_argument('--norm_stats_size', type=int, default=512, help='shorter side of the low-res pass used for the tile statistics')
+parser.add_argument('--guided_size', type=int, default=0, help='run netG_A with this shorter side and guided-upsample the output to the full-res input, 0 to disable')
+parser.add_argument('--guided_radius', type=int, default=4, help='guided filter radius in low-res pixels')
+parser.add_argument('--guided_eps', type=float, default=1e-3, help='guided filter regularisation, larger values smooth more')
+parser.add_argument('--cache_dir', type=str, default='', help='content-addressed result cache; inputs converted before with the same checkpoint and options are copied from it')
+parser.add_argument('--cache_size_mb', type=int, default=10240, help='size cap of the result cache, least recently used entries are evicted')
+parser.add_argument('--guided_report', type=int, default=0, help='also run full-resolution inference and report speed and PSNR/SSIM of the guided output')
+parser.add_argument('--output_format', type=str, default='png', choices=sorted(EXTENSIONS), help='format of the result files [%s]' % ' | '.join(EXTENSIONS))
+parser.add_argument('--png_level', type=int, default=6, help='zlib level of the png results, 1 is much faster to write')
+parser.add_argument('--palette', type=int, default=0, help='write png results as palette images of at most this many colours, 0 to disable')
+parser.add_argument('--writer_processes', type=int, default=0, help='encode the results in worker processes instead of threads')
+parser.add_argument('--sequence', type=int, default=0, help='treat the inputs as frames of a sequence in file name order and re-run netG_A only on tiles that changed since the previous frame')
+parser.add_argument('--sequence_tile', type=int, default=128, help='tile size for the frame differences of --sequence')
+parser.add_argument('--sequence_threshold', type=float, default=2.0, help='largest per-pixel difference (0-255) of a tile treated as unchanged')
+parser.add_argument('--sequence_max_changed', type=float, default=0.5, help='run the whole frame when more than this fraction of tiles changed')
+parser.add_argument('--keyframe_interval', type=int, default=0, help='run the whole frame at least every this many frames, 0 to disable')
+parser.add_argument('--watch', type=int, default=0, help='keep running and convert new or modified images in --dataroot as they arrive')
+parser.add_argument('--watch_interval', type=float, default=2.0, help='seconds between scans of --dataroot in watch mode (inotify wakes it earlier when available)')
+parser.add_argument('--watch_settle', type=float, default=1.0, help='only pick up files not modified for this many seconds')
+parser.add_argument('--journal', type=str, default='', help='processed-state journal of watch mode, defaults to <results_dir>/<name>/processed.journal')
 
 opt = parser.parse_args()
 print(opt)
 
+# Options that change the written results and therefore take part in the result cache key. Batch size and
+# bucketing decide the padding that enters the InstanceNorm statistics, and the tile memory budget can
+# shrink the tiles.
+CACHE_OPTIONS = ['input_nc', 'output_nc', 'geom_nc', 'n_blocks', 'size', 'every_feat', 'predict_depth', 'reconstruct',
+                 'save_input', 'backend', 'quantized', 'compile_bucket', 'tile_size', 'tile_overlap', 'tile_global_norm',
+                 'norm_stats_size', 'guided_size', 'guided_radius', 'guided_eps', 'output_format', 'palette', 'sequence',
+                 'sequence_tile', 'sequence_threshold', 'sequence_max_changed', 'keyframe_interval', 'geom_source',
+                 'sketch_nc', 'batchSize', 'bucket_step', 'tile_batch', 'tile_memory_mb', 'channels_last', 'compile']
+
 opt.no_flip = True
 
 if torch.cuda.is_available() and not opt.cuda:
     print("WARNING: You have a CUDA device, so you should probably run with --cuda")
 
-device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+# Quantized kernels and the ONNX Runtime backend only run on the CPU, so the whole pipeline stays there.
+if opt.backend == 'onnx':
+    opt.quantized = 0
+torch_G = opt.quantized == 0 and opt.backend == 'torch'
+device = torch.device("cuda") if torch.cuda.is_available() and torch_G else torch.device("cpu")
 
 with torch.no_grad():
     # Networks
 
     net_G = 0
-    net_G = Generator(opt.input_nc, opt.output_nc, opt.n_blocks)
-    net_G.to(device)
+    checkpoints = [os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch)]
+    if opt.backend == 'onnx':
+        net_G = OnnxModule(onnx_path(opt.checkpoints_dir, opt.name, opt.which_epoch), threads=opt.ort_threads,
+                           inter_threads=opt.ort_inter_threads)
+        print('loaded', net_G.path)
+        checkpoints = [net_G.path]
+    elif opt.quantized == 1:
+        quantized_G = opt.quantized_path
+        if quantized_G == '':
+            quantized_G = quantized_path(opt.checkpoints_dir, opt.name, opt.which_epoch)
+        net_G = load_quantized(quantized_G)
+        print('loaded', quantized_G)
+        checkpoints = [quantized_G]
+    else:
+        net_G = Generator(opt.input_nc, opt.output_nc, opt.n_blocks)
+        net_G.to(device)
 
     # OPTIONAL
     net_GB = 0
     if opt.reconstruct == 1:
-        net_GB = Generator(opt.output_nc, opt.input_nc, opt.n_blocks)
-        net_GB.to(device)
-        net_GB.load_state_dict(torch.load(os.path.join(opt.checkpoints_dir, opt.name, 'netG_B_%s.pth' % opt.which_epoch)))
-        net_GB.eval()
+        net_GB = load_generator(os.path.join(opt.checkpoints_dir, opt.name, 'netG_B_%s.pth' % opt.which_epoch),
+                                opt.output_nc, opt.input_nc, opt.n_blocks, device)
+        checkpoints.append(os.path.join(opt.checkpoints_dir, opt.name, 'netG_B_%s.pth' % opt.which_epoch))
 
     # OPTIONAL
-    netGeom = 0
-    if opt.predict_depth == 1:
-        usename = opt.name
-        if (len(opt.geom_name) > 0) and (os.path.exists(os.path.join(opt.checkpoints_dir, opt.geom_name))):
-            usename = opt.geom_name
-        # myname = os.path.join(opt.checkpoints_dir, usename, 'netGeom_%s.pth' % opt.which_epoch)
-        myname = os.path.join(opt.checkpoints_dir, usename, "feats2depth.pth")
-        netGeom = GlobalGenerator2(768, opt.geom_nc, n_downsampling=1, n_UPsampling=3)
+    net_S = 0
+    if opt.sketch_name != '':
+        sketch_path = os.path.join(opt.checkpoints_dir, opt.sketch_name, 'netG_A_%s.pth' % opt.sketch_epoch)
+        net_S = load_generator(sketch_path, opt.input_nc, opt.sketch_nc, opt.n_blocks, device)
+        checkpoints.append(sketch_path)
+    elif opt.geom_source == 'sketch':
+        opt.geom_source = 'out'
 
-        if torch.cuda.is_available():
-            netGeom.load_state_dict(torch.load(myname))
-        else:
-            netGeom.load_state_dict(torch.load(myname, map_location=torch.device("cpu")))
-        netGeom.to(device)
-        netGeom.eval()
-
-        numclasses = opt.num_classes
-        ### load pretrained inception
-        net_recog = InceptionV3(opt.num_classes, False, use_aux=True, pretrain=True, freeze=True, every_feat=opt.every_feat==1)
-        net_recog.to(device)
-        net_recog.eval()
+    # OPTIONAL
+    geom_head = 0
+    if opt.predict_depth == 1 and opt.backend == 'onnx':
+        geom_head = OnnxModule(onnx_path(opt.checkpoints_dir, opt.name, opt.which_epoch, net='geometry'),
+                               threads=opt.ort_threads, inter_threads=opt.ort_inter_threads)
+        checkpoints.append(geom_head.path)
+    elif opt.predict_depth == 1:
+        myname = geometry_path(opt.checkpoints_dir, opt.name, opt.geom_name)
+        geom_head = load_geometry(myname, opt.geom_nc, opt.num_classes, opt.every_feat == 1, device)
+        checkpoints.append(myname)
 
     # Load state dicts
-    if torch.cuda.is_available():
-        net_G.load_state_dict(torch.load(os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch)))
-    else:
-        net_G.load_state_dict(torch.load(os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch), map_location=device))
+    if torch_G:
+        if torch.cuda.is_available():
+            net_G.load_state_dict(torch.load(os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch)))
+        else:
+            net_G.load_state_dict(torch.load(os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch), map_location=device))
 
-    print('loaded', os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch))
+        print('loaded', os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch))
 
     # Set model's test mode
     net_G.eval()
 
+    # Every image is decoded once and all requested heads run on the same batch.
+    heads = [Head('out', net_G)]
+    if opt.sketch_name != '':
+        heads.append(Head('sketch', net_S))
+    if opt.predict_depth == 1:
+        heads.append(Head('geom', geom_head, opt.geom_source, to_image=channel2width))
+    if opt.reconstruct == 1:
+        heads.append(Head('rec', net_GB, 'out'))
+    # The int8 TorchScript and ONNX Runtime graphs are fixed and not converted or compiled.
+    torch_heads = [h for h in heads if isinstance(h.net, torch.nn.Module) and not isinstance(h.net, torch.jit.ScriptModule)]
+
+    if opt.channels_last == 1:
+        for head in torch_heads:
+            convert_net(head.net)
+
+    if opt.sequence == 1 and (opt.tile_size > 0 or opt.guided_size > 0):
+        print('--sequence runs netG_A on the frames at --size, ignoring --tile_size and --guided_size')
+        opt.tile_size = opt.guided_size = 0
+
+    # Shared tile statistics are injected through InstanceNorm hooks, which compiled graphs do not see.
+    if opt.compile == 1 and opt.tile_size > 0 and opt.tile_global_norm == 1:
+        print('--tile_global_norm runs the networks in eager mode, ignoring --compile')
+        opt.compile = 0
+    if opt.compile == 1 and opt.sequence == 1:
+        print('--sequence runs the networks in eager mode, ignoring --compile')
+        opt.compile = 0
+
+    if opt.compile == 1:
+        set_compile_cache(opt.compile_cache)
+        for head in torch_heads:
+            compile_net(head.net, head.name)
+    else:
+        opt.compile_bucket = 0
+
     
     transforms_r = [transforms.Resize(int(opt.size), Image.BICUBIC),
                    transforms.ToTensor()]
-
+    if opt.tile_size > 0 or opt.guided_size > 0:
+        # Tiles keep the peak memory bounded and the guided filter upsamples to the input, so both keep full resolution.
+        transforms_r = [transforms.ToTensor()]
+        opt.compile_bucket = 0
+    if opt.tile_size > 0:
+        tile_size, tile_batch = opt.tile_size, opt.tile_batch
+        if opt.tile_memory_mb > 0:
+            tile_size, tile_batch = plan_tiles(activation_bytes_per_pixel(net_G, opt.input_nc, device),
+                                               opt.tile_memory_mb, opt.tile_size, opt.tile_overlap, opt.tile_batch)
+        if opt.tile_global_norm == 1 and not is_eager_float(net_G):
+            print('--tile_global_norm needs the InstanceNorm layers of an eager network, disabled for this backend')
+            opt.tile_global_norm = 0
+        print('tiled inference: %dpx tiles, %d per batch' % (tile_size, tile_batch))
+
+    incremental = None
+    if opt.sequence == 1 and not is_eager_float(net_G):
+        # Crops of a scripted network would each be normalised with their own InstanceNorm statistics.
+        print('--sequence needs an eager network to freeze InstanceNorm statistics; running full frames')
+    elif opt.sequence == 1:
+        halo = receptive_radius(net_G, opt.input_nc, device)
+        incremental = IncrementalForward(net_G, tile=opt.sequence_tile, halo=halo,
+                                         threshold=opt.sequence_threshold / 255.0,
+                                         max_changed=opt.sequence_max_changed, keyframe_interval=opt.keyframe_interval)
+        print('sequence mode: %dpx tiles with a %dpx halo' % (incremental.tile, incremental.halo))
+
+    def forward(net, x):
+        if incremental is not None and net is net_G:
+            return incremental(x)
+        if opt.tile_size > 0:
+            return tiled_forward(net, x, tile=tile_size, overlap=opt.tile_overlap, tile_batch=tile_batch,
+                                 global_norm_size=opt.norm_stats_size if opt.tile_global_norm == 1 else 0)
+        return net(x)
+
+    pipeline = InferencePipeline(heads, forward=forward)
 
     test_data = UnpairedDepthDataset(opt.dataroot, '', opt, transform=transforms_r,
                 mode=opt.mode, midas=opt.midas>0, depthroot=opt.depthroot)
 
-    dataloader = DataLoader(test_data, batch_size=opt.batchSize, shuffle=False)
-
-    ###################################
-
-    ###### Testing######
-
     full_output_dir = os.path.join(opt.results_dir, opt.name)
 
     if not os.path.exists(full_output_dir):
         os.makedirs(full_output_dir)
 
-    for i, batch in enumerate(dataloader):
-        if i > opt.how_many:
-            break;
-        img_r  = Variable(batch['r']).to(device)
-        img_depth  = Variable(batch['depth']).to(device)
-        real_A = img_r
-
-        name = batch['name'][0]
-        
-        input_image = real_A
-        image = net_G(input_image)
-        save_image(image.data, full_output_dir+'/%s_out.png' % name)
-
-        if (opt.predict_depth == 1):
-
-            geom_input = image
-            if geom_input.size()[1] == 1:
-                geom_input = geom_input.repeat(1, 3, 1, 1)
-            _, geom_input = net_recog(geom_input)
-            geom = netGeom(geom_input)
-            geom = (geom+1)/2.0 ###[-1, 1] ---> [0, 1]
-
-            input_img_fake = channel2width(geom)
-            save_image(input_img_fake.data, full_output_dir+'/%s_geom.png' % name)
+    # Results are encoded on a worker pool while the next batch is inferred.
+    shards = None
+    if opt.shard_mb > 0:
+        shards = ShardWriter(full_output_dir, max_mb=opt.shard_mb)
+        if opt.cache_dir != '':
+            print('--shard_mb packs the results into shards, ignoring --cache_dir')
+            opt.cache_dir = ''
+    writer = ImageWriter(opt.output_format, png_level=opt.png_level, palette=opt.palette, workers=opt.writer_workers,
+                         processes=opt.writer_processes == 1, shards=shards)
+
+    def result_paths(name):
+        paths = {head: writer.path(full_output_dir+'/%s_%s' % (name, head)) for head in pipeline.names()}
+        if opt.save_input == 1:
+            paths['input'] = writer.path(full_output_dir+'/%s_input' % name)
+        return paths
+
+    # Inputs already converted with the same checkpoints and options are copied from the cache
+    # and dropped from the dataset, so they are neither decoded nor run through the networks.
+    cache = None
+    cache_keys = {}
+    if opt.cache_dir != '':
+        cache = ResultCache(opt.cache_dir, opt.cache_size_mb)
+        context = cache.context_key(checkpoints, {k: getattr(opt, k) for k in CACHE_OPTIONS})
+
+    def drop_cached(dataset):
+        misses = []
+        for index, path in enumerate(dataset.data):
+            name = os.path.basename(path).split('.')[0]
+            cache_keys[name] = cache.key(path, context)
+            if not cache.fetch(cache_keys[name], result_paths(name)):
+                misses.append(index)
+        cache.flush()
+        print('result cache: %d hits, %d to convert' % (len(dataset.data) - len(misses), len(misses)))
+        dataset.subset(misses)
 
-        if opt.reconstruct == 1:
-            rec = net_GB(image)
-            save_image(rec.data, full_output_dir+'/%s_rec.png' % name)
+    ###################################
 
-        if opt.save_input == 1:
-            save_image(img_r, full_output_dir+'/%s_input.png' % name)
+    ###### Testing######
 
-        sys.stdout.write('\rGenerated images %04d of %04d' % (i, opt.how_many))
+    guided_time = full_time = 0.0
+    guided_psnr = []
+    guided_ssim = []
+
+    # Results go into the cache once their files are completely written.
+    pending_puts = []
+
+    def put_written(wait=False):
+        remaining = []
+        for key, paths, futures in pending_puts:
+            if wait or all(f.done() for f in futures):
+                for f in futures:
+                    f.result()
+                cache.put(key, paths)
+            else:
+                remaining.append((key, paths, futures))
+        pending_puts[:] = remaining
+
+    # In watch mode the images that appear in (or change under) --dataroot are converted as they
+    # arrive, and every finished round is journaled so a restarted watcher skips it.
+    def rounds():
+        if opt.watch == 0:
+            # Capped before batching, so a batch never runs past --how_many.
+            test_data.subset(range(min(len(test_data.data), opt.how_many)))
+            yield test_data
+            return
+        journal = ProcessedJournal(opt.journal if opt.journal != '' else os.path.join(full_output_dir, 'processed.journal'))
+        print('watching %s (%d images already processed)' % (opt.dataroot, len(journal)))
+        for paths in DirectoryWatcher(opt.dataroot, journal, interval=opt.watch_interval, settle=opt.watch_settle):
+            # Files that do not decode are journaled with their error and skipped until they change,
+            # instead of failing a loader worker and stopping the watcher.
+            errors = {}
+            for path in paths:
+                facts = inspect_image(path)
+                if not facts['ok']:
+                    print('skipping %s (%s)' % (path, facts['error']))
+                    errors[path] = facts['error']
+            good = [path for path in paths if path not in errors]
+            if len(good) > 0:
+                yield test_data.from_paths(good)
+                writer.flush()
+                if cache is not None:
+                    put_written(wait=True)
+            journal.record(paths, errors)
+            sys.stdout.write('\n')
+
+    processed = 0
+    for round_data in rounds():
+        if cache is not None:
+            drop_cached(round_data)
+
+        # Batches hold images of one size bucket, padded to a multiple of 4, and every output is cropped back.
+        resize_target = 0 if len(transforms_r) == 1 else int(opt.size)
+        batch_sampler = None
+        if opt.sequence == 1:
+            # Frames run one at a time in file name order, each compared with the previous one.
+            round_data.subset(sorted(range(len(round_data.data)), key=lambda k: round_data.data[k]))
+            batch_sampler = [[k] for k in range(len(round_data.data))]
+        dataloader = make_loader(round_data, opt, resize_target, batch_sampler)
+
+        # The channels_last layout is audited on the first batch of the first round.
+        audit = opt.channels_last == 1 and processed == 0
+        for input_image, batch in padded_batches(dataloader, device, opt.compile_bucket, audit=audit):
+            names = batch['name']
+            sizes = batch['size'].tolist()
+
+            if opt.guided_size > 0:
+                start = time.time()
+                image = guided_forward(net_G, input_image, opt.guided_size, r=opt.guided_radius, eps=opt.guided_eps)
+                guided_time += time.time() - start
+                if opt.guided_report == 1:
+                    start = time.time()
+                    full_image = forward(net_G, input_image)
+                    full_time += time.time() - start
+                    for j in range(len(names)):
+                        guided_psnr.append(psnr(crop_to_input(image[j:j + 1], input_image, sizes[j]),
+                                                crop_to_input(full_image[j:j + 1], input_image, sizes[j])))
+                        guided_ssim.append(ssim(crop_to_input(image[j:j + 1], input_image, sizes[j]),
+                                                crop_to_input(full_image[j:j + 1], input_image, sizes[j])))
+            else:
+                image = forward(net_G, input_image)
+
+            outputs = pipeline.run(input_image, given={'out': image})
+
+            for name, (paths, futures) in pipeline.write_batch(writer, outputs, input_image, batch, result_paths).items():
+                if cache is not None:
+                    pending_puts.append((cache_keys[name], paths, futures))
+
+            if cache is not None:
+                put_written()
+
+            processed += len(names)
+            if opt.watch == 1:
+                sys.stdout.write('\rGenerated images %04d' % processed)
+            else:
+                sys.stdout.write('\rGenerated images %04d of %04d' % (processed, len(test_data.data)))
 
     sys.stdout.write('\n')
+    writer.close()
+    if shards is not None:
+        print('packed %d results into %s (%d shard files)' % (shards.count, full_output_dir, shards.number))
+    if cache is not None:
+        put_written(wait=True)
+        cache.close()
+    if opt.guided_size > 0 and opt.guided_report == 1 and len(guided_psnr) > 0:
+        guided_psnr = torch.cat(guided_psnr)
+        guided_ssim = torch.cat(guided_ssim)
+        print('guided %dpx: %.3fs per image vs full resolution %.3fs (%.2fx), PSNR %.2f dB, SSIM %.4f' %
+              (opt.guided_size, guided_time / len(guided_psnr), full_time / len(guided_psnr),
+               full_time / max(guided_time, 1e-9), guided_psnr.mean(), guided_ssim.mean()))
+    if incremental is not None:
+        incremental.report()
     ###################################
 
 
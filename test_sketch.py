@@ -3,55 +3,21 @@ import sys
 import os
 
 import torchvision.transforms as transforms
-from torchvision.utils import save_image
-from torch.utils.data import DataLoader
-from torch.autograd import Variable
 import torch
 
-from models.model import Generator, GlobalGenerator2, InceptionV3
 from data.dataset import UnpairedDepthDataset
 from PIL import Image
 from utils.utils import channel2width
+from utils.compile import compile_net, set_compile_cache
+from utils.memory_format import convert_net
+from utils.image_writer import ImageWriter
+from utils.shards import ShardWriter
+from utils.pipeline import add_inference_options, geometry_path, Head, InferencePipeline, load_generator, \
+    load_geometry, make_loader, padded_batches
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--name', required=True, type=str, help='name of this experiment')
-parser.add_argument('--checkpoints_dir', type=str, default='checkpoints', help='Where the model checkpoints are saved')
-parser.add_argument('--results_dir', type=str, default='results', help='where to save result images')
-parser.add_argument('--geom_name', type=str, default='feats2Geom', help='name of the geometry predictor')
-parser.add_argument('--batchSize', type=int, default=1, help='size of the batches')
-parser.add_argument('--dataroot', type=str, default='', help='root directory of the dataset')
-parser.add_argument('--depthroot', type=str, default='', help='dataset of corresponding ground truth depth maps')
-
-parser.add_argument('--input_nc', type=int, default=3, help='number of channels of input data')
-parser.add_argument('--output_nc', type=int, default=1, help='number of channels of output data')
-parser.add_argument('--geom_nc', type=int, default=3, help='number of channels of geometry data')
-parser.add_argument('--every_feat', type=int, default=1, help='use transfer features for the geometry loss')
-parser.add_argument('--num_classes', type=int, default=55, help='number of classes for inception')
-parser.add_argument('--midas', type=int, default=0, help='use midas depth map')
-
-parser.add_argument('--ngf', type=int, default=64, help='# of gen filters in first conv layer')
-parser.add_argument('--n_blocks', type=int, default=3, help='number of resnet blocks for generator')
-parser.add_argument('--size', type=int, default=256, help='size of the data (squared assumed)')
-parser.add_argument('--cuda', action='store_true', help='use GPU computation', default=True)
-parser.add_argument('--n_cpu', type=int, default=8, help='number of cpu threads to use during batch generation')
-parser.add_argument('--which_epoch', type=str, default='latest', help='which epoch to load from')
-parser.add_argument('--aspect_ratio', type=float, default=1.0,
-                    help='The ratio width/height. The final height of the load image will be crop_size/aspect_ratio')
-
-parser.add_argument('--mode', type=str, default='test', help='train, val, test, etc')
-parser.add_argument('--load_size', type=int, default=256, help='scale images to this size')
-parser.add_argument('--crop_size', type=int, default=256, help='then crop to this size')
-parser.add_argument('--max_dataset_size', type=int, default=float("inf"),
-                    help='Maximum number of samples allowed per dataset. If the dataset directory contains more than max_dataset_size, only a subset is loaded.')
-parser.add_argument('--preprocess', type=str, default='resize_and_crop',
-                    help='scaling and cropping of images at load time [resize_and_crop | crop | scale_width | scale_width_and_crop | none]')
-parser.add_argument('--no_flip', action='store_true', help='if specified, do not flip the images for data augmentation')
-parser.add_argument('--norm', type=str, default='instance', help='instance normalization or batch normalization')
-
-parser.add_argument('--predict_depth', type=int, default=0, help='run geometry prediction on the generated images')
-parser.add_argument('--save_input', type=int, default=0, help='save input image')
-parser.add_argument('--reconstruct', type=int, default=0, help='get reconstruction')
-parser.add_argument('--how_many', type=int, default=10000, help='number of images to test')
+add_inference_options(parser, output_nc=1, how_many=10000)
+parser.add_argument('--output_dir', type=str, default='examples/train/line_drawings', help='where the sketches are written')
 
 opt = parser.parse_args()
 print(opt)
@@ -60,97 +26,75 @@ opt.no_flip = True
 
 if torch.cuda.is_available() and not opt.cuda:
     print("WARNING: You have a CUDA device, so you should probably run with --cuda")
+device = torch.device("cuda") if torch.cuda.is_available() and opt.cuda else torch.device("cpu")
 
 with torch.no_grad():
-    # Networks
+    # Networks: the sketch generator on the inputs, optionally geometry and reconstruction on the sketches.
+    net_G = load_generator(os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch),
+                           opt.input_nc, opt.output_nc, opt.n_blocks, device)
+    heads = [Head('sketch', net_G)]
+    if opt.predict_depth == 1:
+        geom = load_geometry(geometry_path(opt.checkpoints_dir, opt.name, opt.geom_name, 'netGeom_%s.pth' % opt.which_epoch),
+                             opt.geom_nc, opt.num_classes, opt.every_feat == 1, device)
+        heads.append(Head('geom', geom, 'sketch', to_image=channel2width))
+    if opt.reconstruct == 1:
+        net_GB = load_generator(os.path.join(opt.checkpoints_dir, opt.name, 'netG_B_%s.pth' % opt.which_epoch),
+                                opt.output_nc, opt.input_nc, opt.n_blocks, device)
+        heads.append(Head('rec', net_GB, 'sketch'))
 
-    net_G = 0
-    net_G = Generator(opt.input_nc, opt.output_nc, opt.n_blocks)
-    net_G.cuda()
+    if opt.channels_last == 1:
+        for head in heads:
+            convert_net(head.net)
 
-    net_GB = 0
-    if opt.reconstruct == 1:
-        net_GB = Generator(opt.output_nc, opt.input_nc, opt.n_blocks)
-        net_GB.cuda()
-        net_GB.load_state_dict(
-            torch.load(os.path.join(opt.checkpoints_dir, opt.name, 'netG_B_%s.pth' % opt.which_epoch)))
-        net_GB.eval()
+    if opt.compile == 1:
+        set_compile_cache(opt.compile_cache)
+        for head in heads:
+            compile_net(head.net, head.name)
+    else:
+        opt.compile_bucket = 0
 
-    netGeom = 0
-    if opt.predict_depth == 1:
-        usename = opt.name
-        if (len(opt.geom_name) > 0) and (os.path.exists(os.path.join(opt.checkpoints_dir, opt.geom_name))):
-            usename = opt.geom_name
-        myname = os.path.join(opt.checkpoints_dir, usename, 'netGeom_%s.pth' % opt.which_epoch)
-        netGeom = GlobalGenerator2(768, opt.geom_nc, n_downsampling=1, n_UPsampling=3)
-
-        netGeom.load_state_dict(torch.load(myname))
-        netGeom.cuda()
-        netGeom.eval()
-
-        numclasses = opt.num_classes
-        ### load pretrained inception
-        net_recog = InceptionV3(opt.num_classes, False, use_aux=True, pretrain=True, freeze=True,
-                                every_feat=opt.every_feat == 1)
-        net_recog.cuda()
-        net_recog.eval()
-
-    # Load state dicts
-    net_G.load_state_dict(torch.load(os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch)))
-    print('loaded', os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_%s.pth' % opt.which_epoch))
-
-    # Set model's test mode
-    net_G.eval()
+    pipeline = InferencePipeline(heads)
 
     transforms_r = [transforms.Resize(int(opt.size), Image.BICUBIC),
                     transforms.ToTensor()]
 
     test_data = UnpairedDepthDataset(opt.dataroot, '', opt, transform=transforms_r,
                                      mode=opt.mode, midas=opt.midas > 0, depthroot=opt.depthroot)
+    test_data.subset(range(min(len(test_data.data), opt.how_many)))
 
-    dataloader = DataLoader(test_data, batch_size=opt.batchSize, shuffle=False)
+    # Batches hold images of one size bucket, padded to a multiple of 4, and every output is cropped back.
+    dataloader = make_loader(test_data, opt, int(opt.size))
 
     ###################################
 
     ###### Testing######
 
-    full_output_dir = "examples/train/line_drawings"
+    full_output_dir = opt.output_dir
 
     if not os.path.exists(full_output_dir):
         os.makedirs(full_output_dir)
 
-    for i, batch in enumerate(dataloader):
-        if i > opt.how_many:
-            break;
-        img_r = Variable(batch['r']).cuda()
-        img_depth = Variable(batch['depth']).cuda()
-        real_A = img_r
-
-        name = batch['name'][0]
-
-        input_image = real_A
-        image = net_G(input_image)
-        save_image(image.data, full_output_dir + '/%s.png' % name)
-
-        if (opt.predict_depth == 1):
-
-            geom_input = image
-            if geom_input.size()[1] == 1:
-                geom_input = geom_input.repeat(1, 3, 1, 1)
-            _, geom_input = net_recog(geom_input)
-            geom = netGeom(geom_input)
-            geom = (geom + 1) / 2.0  ###[-1, 1] ---> [0, 1]
-
-            input_img_fake = channel2width(geom)
-            save_image(input_img_fake.data, full_output_dir + '/%s_geom.png' % name)
-
-        if opt.reconstruct == 1:
-            rec = net_GB(image)
-            save_image(rec.data, full_output_dir + '/%s_rec.png' % name)
+    shards = None
+    if opt.shard_mb > 0:
+        shards = ShardWriter(full_output_dir, max_mb=opt.shard_mb)
+    writer = ImageWriter('png', workers=opt.writer_workers, shards=shards)
 
+    def result_paths(name):
+        # The sketches keep the bare input name, which is how UnpairedDepthDataset pairs them.
+        paths = {'sketch': full_output_dir + '/%s.png' % name}
+        for head in pipeline.names()[1:]:
+            paths[head] = full_output_dir + '/%s_%s.png' % (name, head)
         if opt.save_input == 1:
-            save_image(img_r, full_output_dir + '/%s_input.png' % name)
+            paths['input'] = full_output_dir + '/%s_input.png' % name
+        return paths
+
+    processed = 0
+    for input_image, batch in padded_batches(dataloader, device, opt.compile_bucket, audit=opt.channels_last == 1):
+        outputs = pipeline.run(input_image)
+        pipeline.write_batch(writer, outputs, input_image, batch, result_paths)
 
-        sys.stdout.write('\rGenerated images %04d of %04d' % (i, opt.how_many))
+        processed += len(batch['name'])
+        sys.stdout.write('\rGenerated images %04d of %04d' % (processed, len(test_data)))
 
-    sys.stdout.write('\n')
\ No newline at end of file
+    sys.stdout.write('\n')
+    writer.close()
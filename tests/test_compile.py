@@ -0,0 +1,32 @@
+"""Bucketed padding lets inputs of different sizes share one torch.compile graph."""
+import pytest
+import torch
+import torch.nn as nn
+
+from utils.compile import CompiledForward, pad_to_bucket
+
+if not hasattr(torch, "compile"):
+    pytest.skip("torch.compile is not available", allow_module_level=True)
+
+
+def test_sizes_in_one_bucket_do_not_recompile():
+    import torch._dynamo
+    torch._dynamo.reset()
+    compiles = []
+
+    def counting_backend(gm, example_inputs):
+        compiles.append([tuple(x.size()) for x in example_inputs if isinstance(x, torch.Tensor)])
+        return gm.forward
+
+    net = nn.Sequential(nn.Conv2d(3, 8, 3, padding=1), nn.InstanceNorm2d(8), nn.ReLU()).eval()
+    net.forward = CompiledForward(net, "test", backend=counting_backend, warmup=0, measure=0)
+    with torch.no_grad():
+        for h, w in [(40, 52), (56, 60), (33, 64)]:
+            out = net(pad_to_bucket(torch.rand(1, 3, h, w), 32))
+            assert tuple(out.size()[2:]) == (64, 64)
+        assert len(compiles) == 1
+
+        # A size in the next bucket is a new static shape and compiles once more.
+        net(pad_to_bucket(torch.rand(1, 3, 70, 64), 32))
+        assert len(compiles) == 2
+    torch._dynamo.reset()
@@ -0,0 +1,42 @@
+"""Which Generator modules the FX int8 quantisation fuses and which kernels it converts them to."""
+import pytest
+import torch
+import torch.nn as nn
+
+from models.model import Generator
+from models.quantize import calibrate, prepare_generator
+
+ENGINE = next((e for e in ("x86", "fbgemm", "qnnpack") if e in torch.backends.quantized.supported_engines), None)
+if ENGINE is None:
+    pytest.skip("no quantized engine available", allow_module_level=True)
+
+import torch.ao.nn.quantized as nnq
+from torch.ao.nn.intrinsic.modules.fused import _FusedModule
+from torch.ao.quantization.quantize_fx import convert_fx
+
+
+def quantize(float_norm=False):
+    torch.manual_seed(0)
+    net = Generator(3, 3, n_residual_blocks=1).eval()
+    images = [torch.rand(1, 3, 32, 32) for _ in range(2)]
+    prepared = calibrate(prepare_generator(net, images[0], engine=ENGINE, float_norm=float_norm), images)
+    return net, convert_fx(prepared)
+
+
+def modules_of(net, types):
+    return [m for m in net.modules() if isinstance(m, types)]
+
+
+def test_no_module_is_fused():
+    net, quantized = quantize()
+    # Every conv is followed by an InstanceNorm, which blocks the conv+relu fusion pattern.
+    assert modules_of(quantized, _FusedModule) == []
+    assert len(modules_of(quantized, nnq.Conv2d)) == len(modules_of(net, nn.Conv2d))
+    assert len(modules_of(quantized, nnq.ConvTranspose2d)) == len(modules_of(net, nn.ConvTranspose2d))
+    assert len(modules_of(quantized, nnq.InstanceNorm2d)) == len(modules_of(net, nn.InstanceNorm2d))
+
+
+def test_float_norm_keeps_instance_norm_in_fp32():
+    net, quantized = quantize(float_norm=True)
+    assert modules_of(quantized, nnq.InstanceNorm2d) == []
+    assert len(modules_of(quantized, nn.InstanceNorm2d)) == len(modules_of(net, nn.InstanceNorm2d))
@@ -0,0 +1,74 @@
+"""MicroBatchServer over loopback: batching, routing of results and error statuses."""
+import asyncio
+import io
+
+import torch
+from PIL import Image
+
+from utils.server import http_request, MicroBatchServer
+
+
+class RecordingNet():
+    """Identity network that remembers the size of every batch it was given."""
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, x):
+        self.batches.append(x.size()[0])
+        return x
+
+
+def png(colour, size=(32, 24)):
+    buf = io.BytesIO()
+    Image.new("RGB", size, colour).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def run_with_server(server, client):
+    """Start server on an ephemeral loopback port, run client(port) against it and stop the server."""
+    async def main():
+        task = asyncio.ensure_future(server.serve("127.0.0.1", 0))
+        while server.address is None:
+            await asyncio.sleep(0.01)
+        try:
+            return await client(server.address[1])
+        finally:
+            task.cancel()
+    return asyncio.run(main())
+
+
+def test_concurrent_requests_are_batched_and_routed_back():
+    net = RecordingNet()
+    server = MicroBatchServer(net, torch.device("cpu"), size=0, max_batch=8, max_wait=0.5, workers=2)
+    colours = [(10 * k, 255 - 20 * k, 7 * k) for k in range(6)]
+
+    async def client(port):
+        return await asyncio.gather(*[http_request("127.0.0.1", port, "POST", "/convert", body=png(c))
+                                      for c in colours])
+
+    results = run_with_server(server, client)
+    assert max(net.batches) > 1
+    assert sum(net.batches) == len(colours)
+    for colour, (status, headers, body) in zip(colours, results):
+        assert status == 200
+        assert headers["content-type"] == "image/png"
+        img = Image.open(io.BytesIO(body)).convert("RGB")
+        assert img.size == (32, 24)
+        assert all(abs(a - b) <= 1 for a, b in zip(img.getpixel((5, 5)), colour))
+
+
+def test_malformed_requests_get_error_statuses():
+    server = MicroBatchServer(RecordingNet(), torch.device("cpu"), size=0, max_wait=0.01, workers=1, max_upload=4096)
+
+    async def client(port):
+        return await asyncio.gather(
+            http_request("127.0.0.1", port, "POST", "/convert", body=b"not an image"),
+            http_request("127.0.0.1", port, "POST", "/convert?format=gif", body=png((1, 2, 3))),
+            http_request("127.0.0.1", port, "POST", "/convert?lineage=a", body=png((1, 2, 3))),
+            http_request("127.0.0.1", port, "GET", "/convert"),
+            http_request("127.0.0.1", port, "GET", "/nowhere"),
+            # Only the announced length matters; no body is sent, so the refused upload leaves nothing unread.
+            http_request("127.0.0.1", port, "POST", "/convert", headers={"Content-Length": "8192"}))
+
+    statuses = [status for status, _, _ in run_with_server(server, client)]
+    assert statuses == [400, 400, 400, 405, 404, 413]
@@ -1,6 +1,9 @@
 import argparse
 from collections import OrderedDict
+import json
 import os
+import subprocess
+import sys
 import time
 
 from PIL import Image
@@ -11,11 +14,17 @@ import torchvision.transforms as transforms
 from tqdm.auto import tqdm
 
 from data.dataset import UnpairedDepthDataset
+from data.image_index import ImageIndex, inspect_image, read_header, sanitize_copies
+from data.multicrop import MultiCropDataset
+from data.sampler import aspect_buckets, AspectBucketBatchSampler
 from models.model import Generator, GlobalGenerator2, InceptionV3
 from models import networks
 import utils.util as util
+from utils.compile import compile_net, set_compile_cache
+from utils.memory_format import channels_last_collate, convert_net, LayoutAudit
 from utils.visualizer2 import Visualizer
-from utils.utils import channel2width, createNRandompatches, LambdaLR, weights_init_normal
+from utils.utils import atomic_save, channel2width, createNRandompatches, gray2clip, LambdaLR, resize_target, TeacherPyramid, \
+    weights_init_normal
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -29,12 +38,22 @@ if __name__ == "__main__":
     parser.add_argument("--cuda", action="store_true", help="use GPU computation", default=True)
     parser.add_argument("--n_cpu", type=int, default=8, help="number of cpu threads to use during batch generation")
     parser.add_argument("--wandb", type=int, default=1, help="log with W&B")
+    parser.add_argument("--compile", type=int, default=0, help="accelerate the networks with torch.compile")
+    parser.add_argument("--compile_cache", type=str, default="checkpoints/compile_cache",
+                        help="persistent torch.compile cache directory")
+    parser.add_argument("--channels_last", type=int, default=0, help="run models and batches in channels_last (NHWC)")
+    parser.add_argument("--layout_audit", type=int, default=1,
+                        help="with --channels_last, number of steps in which ops that convert back to NCHW are reported")
 
     # Loading data
     parser.add_argument("--full_color_dir", type=str, default="datasets/vangogh2photo/",
                         help="photograph directory root directory")
     parser.add_argument("--flat_color_dir", type=str, default="", help="line drawings dataset root directory")
     parser.add_argument("--depth_maps_dir", type=str, default="", help="dataset of corresponding ground truth depth maps")
+    parser.add_argument("--sketch_store", type=str, default="",
+                        help="sketch targets written by make_sketch_targets.py, used instead of examples/train/line_drawings")
+    parser.add_argument("--depth_store", type=str, default="",
+                        help="depth maps packed by ingest_maps.py, used with --midas 1 instead of --depth_maps_dir")
     parser.add_argument("--feats2Geom_path", type=str, default="checkpoints/feats2Geom/feats2depth.pth",
                         help="path to pretrained features to depth map network")
 
@@ -68,6 +87,25 @@ if __name__ == "__main__":
     parser.add_argument("--crop_size", type=int, default=256, help="then crop to this size")
     parser.add_argument("--aspect_ratio", type=float, default=1.0,
                         help="The ratio width/height. The final height of the load image will be crop_size/aspect_ratio")
+    parser.add_argument("--views", type=int, default=1,
+                        help="random crop/flip views taken from every decoded image, 1 for one crop per decode")
+    parser.add_argument("--views_auto", type=int, default=1,
+                        help="with --views > 1, take fewer views from images that decode quickly; epochs then end before the progress bar total")
+    parser.add_argument("--decode_share", type=float, default=0.5,
+                        help="fraction of loader time --views_auto lets decoding take")
+    parser.add_argument("--check_data", type=int, default=1,
+                        help="inspect the datasets before training (cached in --index_dir) and skip unreadable files")
+    parser.add_argument("--fix_data", type=int, default=0,
+                        help="train on sanitised RGB copies of CMYK, 16-bit and transparent images; this changes their pixels "
+                             "(alpha composited onto --data_background), so it is off by default and they load as before")
+    parser.add_argument("--data_background", type=str, default="white",
+                        help="colour --fix_data composites transparent pixels onto: white, random or r,g,b")
+    parser.add_argument("--aspect_buckets", type=int, default=0,
+                        help="group images into this many aspect-ratio buckets and crop them to rectangles, 0 for square crops")
+    parser.add_argument("--max_aspect", type=float, default=3.0, help="widest (and tallest) aspect ratio of the buckets")
+    parser.add_argument("--index_dir", type=str, default="checkpoints/dataset_index",
+                        help="where image sizes and other per-file facts of the datasets are cached")
+    parser.add_argument("--shuffle_buffer", type=int, default=256, help="views shuffled together with --views > 1")
     parser.add_argument("--max_dataset_size", type=int, default=float("inf"),
                         help="Maximum number of samples allowed per dataset. If the dataset directory contains more than max_dataset_size, only a subset is loaded.")
     parser.add_argument("--preprocess", type=str, default="resize_and_crop",
@@ -87,6 +125,13 @@ if __name__ == "__main__":
 
     parser.add_argument("--use_sketch", type=int, default=1, help="include the sketch loss")
 
+    # Teacher input resolutions, taken from one antialiased pyramid of fake_B per step
+    parser.add_argument("--geom_size", type=int, default=0,
+                        help="shorter side of the generator output fed to InceptionV3 for the geometry loss, 0 for full size")
+    parser.add_argument("--sketch_size", type=int, default=0,
+                        help="shorter side of the generator output fed to the sketch network, 0 for full size")
+    parser.add_argument("--clip_size", type=int, default=224, help="square input size of the CLIP semantics loss")
+
     # Semantic loss options
     parser.add_argument("--use_clip", type=int, default=1, help="include the CLIP semantics loss")
     parser.add_argument("--N_patches", type=int, default=1, help="number of patches for clip")
@@ -98,6 +143,10 @@ if __name__ == "__main__":
     parser.add_argument("--save_epoch_freq", type=int, default=1000, help="how often to save the latest model in steps")
     parser.add_argument("--slow", type=int, default=0, help="only frequently save netG_A, netGeom")
     parser.add_argument("--log_int", type=int, default=50, help="display frequency for tensorboard")
+    parser.add_argument("--val_dir", type=str, default="",
+                        help="held-out images validated by a separate validate.py process on every netG_A_latest.pth")
+    parser.add_argument("--val_reference_dir", type=str, default="", help="flat-colour references of --val_dir")
+    parser.add_argument("--val_interval", type=float, default=30.0, help="seconds between the validator's checks")
 
     opt = parser.parse_args()
     print(opt)
@@ -201,6 +250,27 @@ if __name__ == "__main__":
 
     print("Loaded networks!")
 
+    # Convert once before compiling so the compiled graphs are traced for the NHWC strides.
+    if opt.channels_last == 1:
+        for net in [gen_A, gen_B, disc_A, disc_B, net_recog]:
+            convert_net(net)
+        if opt.use_geom == 1:
+            convert_net(net_geom)
+        if opt.use_sketch == 1:
+            convert_net(net_sketch)
+
+    if opt.compile == 1:
+        set_compile_cache(opt.compile_cache)
+        compile_net(gen_A, "gen_A")
+        compile_net(gen_B, "gen_B")
+        compile_net(disc_A, "disc_A")
+        compile_net(disc_B, "disc_B")
+        compile_net(net_recog, "net_recog")
+        if opt.use_geom == 1:
+            compile_net(net_geom, "net_geom")
+        if opt.use_sketch == 1:
+            compile_net(net_sketch, "net_sketch")
+
     # Losses
     criterionGAN = networks.GANLoss(use_lsgan=True, target_real_label=1.0,
                                     target_fake_label=0.0, calculate_mean=True).to(device)
@@ -249,20 +319,98 @@ if __name__ == "__main__":
                  transforms.ToTensor()]
 
     train_ds = UnpairedDepthDataset(opt.full_color_dir, opt.flat_color_dir, opt, transform=transform,
-                                    mode=opt.mode, midas=opt.midas > 0, depthroot=opt.depth_maps_dir, sketchroot="examples/train/line_drawings")
-
-    train_dataloader = DataLoader(train_ds, batch_size=opt.batch_size, shuffle=True, num_workers=opt.n_cpu,
-                                  drop_last=True)
-
+                                    mode=opt.mode, midas=opt.midas > 0, depthroot=opt.depth_maps_dir, sketchroot="examples/train/line_drawings",
+                                    sketch_store=opt.sketch_store, depth_store=opt.depth_store)
     print("Loaded %d images" % len(train_ds))
 
-    # Training
+    # Broken files are found before the first step (and cached) instead of crashing a worker mid-epoch.
+    replace = {}
+    if opt.check_data == 1:
+        bad, jobs = set(), []
+        for root, paths in [(opt.full_color_dir, train_ds.data), (opt.flat_color_dir, train_ds.img2)]:
+            index = ImageIndex(root, opt.index_dir, probe=inspect_image, workers=opt.n_cpu)
+            for path, issues in index.problems(paths).items():
+                if "unreadable" in issues:
+                    print("skipping %s (%s)" % (path, ", ".join(issues)))
+                    bad.add(path)
+                elif opt.fix_data == 0:
+                    print("using %s as it is (%s), see --fix_data" % (path, ", ".join(issues)))
+                else:
+                    out_root = os.path.join(opt.index_dir, "sanitized", os.path.basename(os.path.normpath(root)))
+                    replace[path] = index.sanitized_path(path, out_root)
+                    jobs.append((path, replace[path], opt.data_background))
+        sanitize_copies(jobs, opt.n_cpu)
+        if len(bad) > 0 or len(replace) > 0:
+            train_ds.exclude(bad, replace)
+            print("Skipped %d unusable files, using sanitised copies of %d; %d images left"
+                  % (len(bad), len(replace), len(train_ds)))
+
+    # With --views > 1 every decoded image yields several random crops, shuffled across images.
+    if opt.views > 1:
+        train_ds = MultiCropDataset(train_ds, views=opt.views, shuffle_buffer=opt.shuffle_buffer,
+                                    adaptive=opt.views_auto == 1, decode_share=opt.decode_share)
+
+    collate = channels_last_collate if opt.channels_last == 1 else None
+    if opt.aspect_buckets > 0:
+        # Images are grouped by aspect ratio and cropped to their bucket's rectangle of about crop_size^2 pixels.
+        if opt.views > 1:
+            raise SystemExit("--aspect_buckets and --views cannot be combined")
+        buckets = aspect_buckets(opt.crop_size ** 2, opt.aspect_buckets, opt.max_aspect)
+        # Sizes come from the index the data check already filled, so they cost no extra probing. Sanitised
+        # copies keep the pixel size of their originals and are looked up under them, within the index root.
+        originals = {copy: path for path, copy in replace.items()}
+        probe = inspect_image if opt.check_data == 1 else read_header
+        sizes = ImageIndex(opt.full_color_dir, opt.index_dir, probe=probe, workers=opt.n_cpu).sizes(
+            [originals.get(path, path) for path in train_ds.data])
+        batch_sampler = AspectBucketBatchSampler(sizes, opt.batch_size, buckets)
+        print("Aspect buckets: %s" % ", ".join("%s: %d" % item for item in batch_sampler.counts().items()))
+        train_dataloader = DataLoader(train_ds, batch_sampler=batch_sampler, num_workers=opt.n_cpu, collate_fn=collate)
+    else:
+        train_dataloader = DataLoader(train_ds, batch_size=opt.batch_size, shuffle=opt.views <= 1, num_workers=opt.n_cpu,
+                                      drop_last=True, collate_fn=collate)
+
+    # Validation runs in its own low-priority process on the saved snapshots, so training never waits for it.
+    validator = None
+    if opt.val_dir != "":
+        # Resolved next to this script, so training can be started from any directory.
+        validate_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "validate.py")
+        validator = subprocess.Popen([sys.executable, validate_script, "--name", name, "--checkpoints_dir", checkpoints_dir,
+                                      "--val_dir", opt.val_dir, "--reference_dir", opt.val_reference_dir,
+                                      "--input_nc", str(opt.input_nc), "--output_nc", str(opt.output_nc),
+                                      "--n_blocks", str(opt.n_blocks), "--size", str(opt.size),
+                                      "--interval", str(opt.val_interval), "--parent_pid", str(os.getpid())])
+        print("Started validation worker (pid %d)" % validator.pid)
+
+    layout_audit = None
+    if opt.channels_last == 1 and opt.layout_audit > 0:
+        layout_audit = LayoutAudit()
+        layout_audit.start()
+
+    # Training. Steps are counted rather than derived from len(train_dataloader), which is only an upper bound
+    # when --views_auto takes fewer views from some images; a resumed run continues the count saved with its checkpoint.
+    step = opt.epoch * len(train_dataloader)
+    info_path = os.path.join(opt.checkpoints_dir, opt.name, "netG_A_%s.json" % opt.which_epoch)
+    if opt.continue_train and os.path.exists(info_path):
+        with open(info_path) as f:
+            info = json.load(f)
+        step = info.get("steps", info.get("step", step - 1) + 1)
+        print("Resuming at step %d" % step)
+    first_step = step
+    # An adaptive view count makes the length of an epoch unknown until one has run; the last one is the estimate.
+    epoch_steps = None if opt.views > 1 and opt.views_auto == 1 else len(train_dataloader)
     for epoch in range(opt.epoch, opt.n_epochs):
         start_time = time.time()
+        epoch_start_step = step
 
-        pbar = tqdm(enumerate(train_dataloader), total=len(train_dataloader))
+        pbar = tqdm(enumerate(train_dataloader), total=epoch_steps)
         for i, batch in pbar:
-            total_steps = epoch * len(train_dataloader) + i
+            total_steps = step
+            step += 1
+
+            if layout_audit is not None and total_steps == first_step + opt.layout_audit:
+                layout_audit.stop()
+                layout_audit.report()
+                layout_audit = None
 
             img_r = Variable(batch["r"]).cuda()
             img_depth = Variable(batch["depth"]).cuda()
@@ -287,9 +435,12 @@ if __name__ == "__main__":
             fake_A = gen_B(real_B)  # G_B(B)
             rec_B = gen_A(fake_A)  # G_A(G_B(B))
 
+            # Every teacher reads its input from the same per-step pyramid, so each resolution is computed once.
+            pyramid_B = TeacherPyramid(fake_B)
+
             loss_cycle_Geom = 0
             if opt.use_geom == 1:
-                geom_input = fake_B
+                geom_input = pyramid_B.get(opt.geom_size)
                 if geom_input.size()[1] == 1:
                     geom_input = geom_input.repeat(1, 3, 1, 1)
                 _, geom_input = net_recog(geom_input)
@@ -298,13 +449,13 @@ if __name__ == "__main__":
 
                 pred_geom = (pred_geom + 1) / 2.0  ###[-1, 1] ---> [0, 1]
 
-                loss_cycle_Geom = criterionGeom(pred_geom, recover_geom)
+                loss_cycle_Geom = criterionGeom(pred_geom, resize_target(recover_geom, pred_geom))
 
             if opt.use_sketch == 1:
-                geom_input = fake_B
+                geom_input = pyramid_B.get(opt.sketch_size)
                 if geom_input.size()[1] == 1:
                     geom_input = geom_input.repeat(1, 3, 1, 1)
-                gt_sketch = recover_geom
+                gt_sketch = resize_target(recover_geom, geom_input)
                 from torchvision.utils import save_image
                 save_image(geom_input[0], "test/geom_input.png")
                 save_image(gt_sketch[0], "test/gt_sketch.png")
@@ -339,18 +490,22 @@ if __name__ == "__main__":
             # recog_real = torch.cat([recog_real0, recog_real1, recog_real2], dim=1)
 
             line_input = fake_B
+            clip_size = (opt.clip_size, opt.clip_size)
+            line_patch = pyramid_B.get(clip_size)
             if opt.output_nc == 1:
-                line_input_channel0 = (line_input - 0.48145466) / 0.26862954
-                line_input_channel1 = (line_input - 0.4578275) / 0.26130258
-                line_input_channel2 = (line_input - 0.40821073) / 0.27577711
-                line_input = torch.cat([line_input_channel0, line_input_channel1, line_input_channel2], dim=1)
+                # The normalisation is affine per channel, so it commutes with the antialiased resize.
+                line_input = gray2clip(line_input)
+                line_patch = gray2clip(line_patch)
 
-            patches_r = [torch.nn.functional.interpolate(recog_real, size=224)]  # The resize operation on tensor.
-            patches_l = [torch.nn.functional.interpolate(line_input, size=224)]
+            # Resampled with the same antialiased filter as the fake_B side of the loss.
+            patches_r = [torch.nn.functional.interpolate(recog_real, size=clip_size, mode="bilinear", align_corners=False,
+                                                         antialias=True)]
+            patches_l = [line_patch]
 
             # Patch based clip loss
             if opt.N_patches > 1:
-                patches_r2, patches_l2 = createNRandompatches(recog_real, line_input, opt.N_patches, opt.patch_size)
+                patches_r2, patches_l2 = createNRandompatches(recog_real, line_input, opt.N_patches, opt.patch_size,
+                                                              clipsize=opt.clip_size)
                 patches_r += patches_r2
                 patches_l += patches_l2
 
@@ -482,6 +637,9 @@ if __name__ == "__main__":
 
                     visualizer.display_current_results(visuals, total_steps, epoch)
 
+        if opt.views > 1 and opt.views_auto == 1:
+            epoch_steps = step - epoch_start_step
+
         # Update learning rates
         lr_scheduler_G_A.step()
         lr_scheduler_G_B.step()
@@ -490,8 +648,10 @@ if __name__ == "__main__":
 
         # Save models checkpoints
         # torch.save(netG_A2B.state_dict(), "output/netG_A2B.pth")
+        # "steps" is the number of steps taken so far, which a run resumed from this checkpoint continues from.
+        info = {"epoch": epoch, "step": total_steps, "steps": step}
         if (epoch + 1) % opt.save_epoch_freq == 0:
-            torch.save(gen_A.state_dict(), os.path.join(opt.checkpoints_dir, name, "netG_A_%02d.pth" % (epoch)))
+            atomic_save(gen_A.state_dict(), os.path.join(opt.checkpoints_dir, name, "netG_A_%02d.pth" % (epoch)), info=info)
             if opt.finetune_netGeom == 1:
                 torch.save(net_geom.state_dict(), os.path.join(opt.checkpoints_dir, name, "netGeom_%02d.pth" % (epoch)))
             if opt.slow == 0:
@@ -499,7 +659,7 @@ if __name__ == "__main__":
                 torch.save(disc_A.state_dict(), os.path.join(opt.checkpoints_dir, name, "netD_A_%02d.pth" % (epoch)))
                 torch.save(disc_B.state_dict(), os.path.join(opt.checkpoints_dir, name, "netD_B_%02d.pth" % (epoch)))
 
-        torch.save(gen_A.state_dict(), os.path.join(opt.checkpoints_dir, name, "netG_A_latest.pth"))
+        atomic_save(gen_A.state_dict(), os.path.join(opt.checkpoints_dir, name, "netG_A_latest.pth"), info=info)
         torch.save(gen_B.state_dict(), os.path.join(opt.checkpoints_dir, name, "netG_B_latest.pth"))
         torch.save(disc_B.state_dict(), os.path.join(opt.checkpoints_dir, name, "netD_B_latest.pth"))
         torch.save(disc_A.state_dict(), os.path.join(opt.checkpoints_dir, name, "netD_A_latest.pth"))
@@ -530,6 +690,15 @@ if __name__ == "__main__":
         end_time = time.time()
         elapsed_time = round(end_time - start_time, 1)
 
+        # The worker only exits on its own once training is over, so an exit now is a crash.
+        if validator is not None and validator.poll() is not None:
+            print("WARNING: validation worker (pid %d) exited with code %d; no further snapshots are validated"
+                  % (validator.pid, validator.returncode))
+            validator = None
+
+    if validator is not None:
+        print("Validation worker (pid %d) exits after validating the final snapshot" % validator.pid)
+
     """
 python train.py --name exp11 --full_color_dir examples/train/full_color --flat_color_dir examples/train/flat_color --no_flip --cuda --n_epochs 150 --decay_epoch 75 --batch_size 6 --wandb 0 --save_epoch_freq 1 --use_geom 0 --midas 0 --lr 0.0002 --use_clip 0 --cond_cycle 10.0 --use_sketch 1
     python train.py --name exp8 --dataroot examples/train/full_color --root2 examples/train/flat_color --no_flip --cuda --n_epochs 150 --decay_epoch 75 --batchSize 4 --wandb 1 --save_epoch_freq 1 --use_geom 0 --midas 0 --lr 6.5e-4 --use_clip 0 --cond_cycle 10.0 --use_sketch 1
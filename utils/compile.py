@@ -0,0 +1,126 @@
+"""Optional torch.compile acceleration for the networks used by train.py, test.py and test_sketch.py.
+
+Networks are compiled in place by replacing their forward, so parameters, state dicts and checkpoint
+files are exactly the same as in eager mode.
+"""
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+
+def set_compile_cache(cache_dir):
+    """Keep the inductor kernels and FX graphs in cache_dir so later runs skip most of the compile time."""
+    if cache_dir == "":
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+    try:
+        import torch._inductor.config as inductor_config
+        if hasattr(inductor_config, "fx_graph_cache"):
+            inductor_config.fx_graph_cache = True
+    except ImportError:
+        pass
+
+
+def _sync(x):
+    if isinstance(x, torch.Tensor) and x.is_cuda:
+        torch.cuda.synchronize()
+
+
+class CompiledForward():
+    """Replacement forward that runs a torch.compile graph and falls back to eager mode on failure.
+
+    The first `warmup` calls for every input shape run eagerly and give the eager reference time, the
+    next call compiles, and the following `measure` calls give the steady-state time that is logged
+    as the speedup. No extra forward passes are run for the measurement.
+
+    Parameters:
+        net (nn.Module)  -- network to accelerate
+        name (str)       -- label used in the log messages
+        backend (str)    -- torch.compile backend; inductor generates C++/OpenMP kernels on CPU
+    """
+    def __init__(self, net, name, backend="inductor", warmup=2, measure=3):
+        self.eager = net.forward
+        self.name = name
+        self.warmup = warmup
+        self.measure = measure
+        self.compiled = torch.compile(self.eager, backend=backend, dynamic=False)
+        self.failed = False
+        self.stats = {}
+
+    def __call__(self, x, *args, **kwargs):
+        if self.failed:
+            return self.eager(x, *args, **kwargs)
+
+        shape = tuple(x.size())
+        stats = self.stats.setdefault(shape, {"calls": 0, "eager": 0.0, "steady": []})
+        stats["calls"] += 1
+        if stats["calls"] > self.warmup + 1 + self.measure:
+            return self.compiled(x, *args, **kwargs)
+
+        start = time.time()
+        if stats["calls"] <= self.warmup:
+            out = self.eager(x, *args, **kwargs)
+            _sync(x)
+            stats["eager"] = time.time() - start
+            return out
+
+        try:
+            out = self.compiled(x, *args, **kwargs)
+        except Exception as e:
+            print("torch.compile failed for %s (%s: %s), falling back to eager mode" % (self.name, type(e).__name__, e))
+            self.failed = True
+            return self.eager(x, *args, **kwargs)
+        _sync(x)
+        elapsed = time.time() - start
+
+        if stats["calls"] == self.warmup + 1:
+            print("Compiled %s for input %s: startup %.2fs (eager forward %.3fs)" %
+                  (self.name, list(shape), elapsed, stats["eager"]))
+        else:
+            stats["steady"].append(elapsed)
+            if len(stats["steady"]) == self.measure:
+                steady = sum(stats["steady"]) / len(stats["steady"])
+                print("Compiled %s for input %s: steady forward %.3fs, speedup %.2fx over eager" %
+                      (self.name, list(shape), steady, stats["eager"] / max(steady, 1e-9)))
+        return out
+
+
+def compile_net(net, name, backend="inductor"):
+    """Compile net in place, leaving it in eager mode when torch.compile is not available."""
+    if not hasattr(torch, "compile"):
+        print("torch.compile is not available in torch %s, running %s in eager mode" % (torch.__version__, name))
+        return net
+    # Every image-size bucket is a separate graph, so allow more of them than the default limit.
+    import torch._dynamo
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+    net.forward = CompiledForward(net, name, backend=backend)
+    return net
+
+
+def pad_to_bucket(x, bucket):
+    """Replicate-pad H and W up to a multiple of bucket so varying image sizes share compiled graphs.
+
+    Graphs are compiled with static shapes, so every distinct padded size costs a compile; a bucket
+    of 32 bounds them to one per 32 x 32 step of image size. The padded pixels take part in every
+    InstanceNorm's statistics, so a bucket larger than the multiple of 4 that pad_collate already
+    pads to trades exact agreement with eager mode for fewer recompiles.
+    """
+    if bucket <= 0:
+        return x
+    h, w = x.size()[2:]
+    pad_h = (-h) % bucket
+    pad_w = (-w) % bucket
+    if pad_h == 0 and pad_w == 0:
+        return x
+    return F.pad(x, (0, pad_w, 0, pad_h), mode="replicate")
+
+
+def crop_to_input(out, padded, size):
+    """Crop an output computed on a padded input back to the region of the original (h, w) input."""
+    scale = float(out.size()[2]) / padded.size()[2]
+    h, w = size
+    return out[:, :, :int(round(h * scale)), :int(round(w * scale))]
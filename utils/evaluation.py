@@ -0,0 +1,140 @@
+"""Evaluate generator checkpoints on a test set that is decoded only once.
+
+`TestSet` decodes and resizes the test images (and their flat-colour references when given) once
+and keeps them in memory as ready-made size-bucketed batches, so `run_checkpoint` can run any number
+of checkpoints over the same tensors. `CheckpointPrefetcher` loads the state dict of the next checkpoint on
+a background thread while the current one is being evaluated.
+"""
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+from data.dataset import make_dataset
+from data.sampler import pad_collate, SizeBucketBatchSampler
+from utils.compile import crop_to_input
+from utils.metrics import psnr, ssim
+
+
+def checkpoint_label(path):
+    """'netG_A_12.pth' -> '12', 'netG_A_latest.pth' -> 'latest'."""
+    match = re.match(r"netG_A_(.+)\.pth$", os.path.basename(path))
+    return match.group(1) if match else os.path.splitext(os.path.basename(path))[0]
+
+
+def _epoch_key(path):
+    label = checkpoint_label(path)
+    return (0, int(label), "") if label.isdigit() else (1, 0, label)
+
+
+def sort_checkpoints(paths):
+    """Numbered epochs in numeric order, then named checkpoints such as 'latest'."""
+    return sorted(set(paths), key=_epoch_key)
+
+
+class TestSet():
+    """Decoded test images as pre-collated batches.
+
+    Parameters:
+        root (str)          -- directory of input images
+        size (int)          -- shorter side the inputs are resized to, 0 keeps them as they are
+        input_nc (int)      -- 1 for grayscale input, 3 for RGB
+        reference_dir (str) -- optional directory of flat-colour references, matched by file name
+        output_nc (int)     -- channels of the references
+        batch_size (int)    -- images per batch; batches hold images of one size bucket
+        max_images (int)    -- use at most this many inputs
+    """
+    def __init__(self, root, size=256, input_nc=3, reference_dir="", output_nc=3, batch_size=8,
+                 max_images=float("inf")):
+        transform = [transforms.ToTensor()]
+        if size > 0:
+            transform = [transforms.Resize(int(size), Image.BICUBIC)] + transform
+        transform = transforms.Compose(transform)
+        references = {}
+        if reference_dir != "":
+            references = {os.path.basename(p).split(".")[0]: p for p in make_dataset(reference_dir, stop=float("inf"))}
+
+        items = []
+        for path in sorted(make_dataset(root, stop=max_images)):
+            name = os.path.basename(path).split(".")[0]
+            item = {"r": transform(Image.open(path).convert("L" if input_nc == 1 else "RGB")), "name": name}
+            if name in references:
+                ref = Image.open(references[name]).convert("L" if output_nc == 1 else "RGB")
+                item["ref"] = transforms.ToTensor()(ref.resize((item["r"].size()[2], item["r"].size()[1]),
+                                                               Image.BICUBIC))
+            items.append(item)
+        self.count = len(items)
+        self.with_reference = sum(1 for item in items if "ref" in item)
+
+        sampler = SizeBucketBatchSampler([tuple(item["r"].size()[1:]) for item in items], batch_size)
+        self.batches = []
+        for indices in sampler.batches():
+            batch = pad_collate([{"r": items[k]["r"], "name": items[k]["name"]} for k in indices])
+            batch["ref"] = [items[k].get("ref") for k in indices]
+            self.batches.append(batch)
+
+    def __len__(self):
+        return self.count
+
+
+def run_checkpoint(net, test_set, device, writer=None, out_dir="", on_output=None):
+    """Run net over every batch of test_set and return its metrics.
+
+    Outputs are written with `writer` (utils.image_writer.ImageWriter) to out_dir when both are
+    given, and passed batch by batch to on_output(outputs) as a list of cropped C x H x W tensors.
+    """
+    psnrs = []
+    ssims = []
+    elapsed = 0.0
+    for batch in test_set.batches:
+        img = batch["r"].to(device)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.time()
+        with torch.no_grad():
+            out = net(img)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed += time.time() - start
+
+        outputs = []
+        for j, (h, w) in enumerate(batch["size"].tolist()):
+            output = crop_to_input(out[j:j + 1], img, (h, w))
+            outputs.append(output[0])
+            ref = batch["ref"][j]
+            if ref is not None:
+                ref = ref.unsqueeze(0).to(output.device)
+                psnrs.append(psnr(output, ref))
+                ssims.append(ssim(output, ref))
+            if writer is not None and out_dir != "":
+                writer.write(output, writer.path(os.path.join(out_dir, "%s_out" % batch["name"][j])))
+        if on_output is not None:
+            on_output(outputs)
+
+    metrics = {"images": len(test_set), "seconds_per_image": elapsed / max(len(test_set), 1)}
+    if len(psnrs) > 0:
+        metrics["psnr"] = torch.cat(psnrs).mean().item()
+        metrics["ssim"] = torch.cat(ssims).mean().item()
+    return metrics
+
+
+class CheckpointPrefetcher():
+    """Iterate over (path, state_dict) pairs, loading the next checkpoint while the caller works on the current one."""
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.pool = ThreadPoolExecutor(max_workers=1)
+
+    def __iter__(self):
+        future = None
+        if len(self.paths) > 0:
+            future = self.pool.submit(torch.load, self.paths[0], map_location="cpu")
+        for k, path in enumerate(self.paths):
+            state = future.result()
+            if k + 1 < len(self.paths):
+                future = self.pool.submit(torch.load, self.paths[k + 1], map_location="cpu")
+            yield path, state
+        self.pool.shutdown()
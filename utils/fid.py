@@ -0,0 +1,141 @@
+"""Fréchet and kernel Inception distances between generated images and a flat-colour reference set.
+
+Features are the 2048-d pool activations of the ImageNet InceptionV3 in models.model. Scores are
+comparable between runs of this code, but not with numbers computed with the TensorFlow FID
+weights.
+
+Reference features and their mean/covariance are extracted once and cached as an .npz under
+`cache_dir`, keyed by the manifest of the reference directory (relative path, size and mtime of
+every file) and the preprocessing, so scoring a new checkpoint only extracts features of its own
+outputs.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from PIL import Image
+
+from data.dataset import make_dataset
+from models.model import InceptionV3
+
+# Bump when the feature extraction changes, so cached reference statistics are recomputed.
+PREPROCESS_VERSION = 1
+
+
+def manifest_key(root, paths, **options):
+    """Hash of the files under root (relative path, size, mtime) and the options describing their use."""
+    h = hashlib.sha256()
+    for path in sorted(paths):
+        st = os.stat(path)
+        h.update(("%s\t%d\t%d\n" % (os.path.relpath(path, root), st.st_size, int(st.st_mtime))).encode())
+    h.update(json.dumps(dict(options, version=PREPROCESS_VERSION), sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class InceptionFeatures():
+    """Pool features of batches of C x H x W images in [0, 1] of any size, extracted in large batches."""
+    def __init__(self, device, batch_size=64, num_classes=55):
+        self.device = device
+        self.batch_size = batch_size
+        self.net = InceptionV3(num_classes, False, use_aux=False, pretrain=True, freeze=True)
+        self.net.to(device)
+        self.net.eval()
+        self.queue = []
+        self.features = []
+
+    def extract(self, images):
+        batch = torch.stack([F.interpolate(img.unsqueeze(0).float(), size=(299, 299), mode="bilinear",
+                                           align_corners=False, antialias=True)[0] for img in images])
+        if batch.size()[1] == 1:
+            batch = batch.repeat(1, 3, 1, 1)
+        # The ported ImageNet weights expect inputs scaled to [-1, 1].
+        with torch.no_grad():
+            return self.net.pool_features(batch.to(self.device) * 2 - 1).double().cpu()
+
+    def add(self, images):
+        self.queue.extend(img.detach() for img in images)
+        while len(self.queue) >= self.batch_size:
+            self.features.append(self.extract(self.queue[:self.batch_size]))
+            self.queue = self.queue[self.batch_size:]
+
+    def finish(self):
+        """Features of everything added since the last call, N x 2048 float64."""
+        if len(self.queue) > 0:
+            self.features.append(self.extract(self.queue))
+            self.queue = []
+        feats = torch.cat(self.features).numpy() if len(self.features) > 0 else np.zeros((0, 2048))
+        self.features = []
+        return feats
+
+
+def statistics(feats):
+    return feats.mean(axis=0), np.cov(feats, rowvar=False)
+
+
+def frechet_distance(mu1, sigma1, mu2, sigma2):
+    """||mu1 - mu2||^2 + Tr(S1 + S2 - 2 (S1 S2)^1/2).
+
+    Tr((S1 S2)^1/2) is the sum of the square roots of the eigenvalues of S1^1/2 S2 S1^1/2, which
+    is symmetric, so two symmetric eigendecompositions replace a general matrix square root.
+    """
+    values, vectors = np.linalg.eigh(sigma1)
+    sqrt1 = (vectors * np.sqrt(np.clip(values, 0, None))) @ vectors.T
+    inner = np.linalg.eigvalsh(sqrt1 @ sigma2 @ sqrt1)
+    trace_sqrt = np.sqrt(np.clip(inner, 0, None)).sum()
+    diff = mu1 - mu2
+    return float(diff @ diff + np.trace(sigma1) + np.trace(sigma2) - 2 * trace_sqrt)
+
+
+def kernel_distance(feats1, feats2, subsets=100, subset_size=1000, seed=0):
+    """Unbiased MMD^2 with the cubic polynomial kernel, averaged over random subsets; returns (mean, std)."""
+    rng = np.random.RandomState(seed)
+    n = min(len(feats1), len(feats2), subset_size)
+    if n < 2:
+        return float("nan"), float("nan")
+    d = feats1.shape[1]
+    scores = []
+    for _ in range(subsets):
+        x = feats1[rng.choice(len(feats1), n, replace=False)]
+        y = feats2[rng.choice(len(feats2), n, replace=False)]
+        kxx = (x @ x.T / d + 1) ** 3
+        kyy = (y @ y.T / d + 1) ** 3
+        kxy = (x @ y.T / d + 1) ** 3
+        scores.append((kxx.sum() - np.trace(kxx)) / (n * (n - 1)) + (kyy.sum() - np.trace(kyy)) / (n * (n - 1))
+                      - 2 * kxy.mean())
+    return float(np.mean(scores)), float(np.std(scores))
+
+
+def reference_statistics(extractor, root, cache_dir, size=256, output_nc=3, max_images=float("inf")):
+    """Features, mean and covariance of the images under root, loaded from cache_dir when unchanged."""
+    paths = make_dataset(root, stop=max_images)
+    key = manifest_key(root, paths, size=size, output_nc=output_nc, features="inception_v3_pool")
+    cache_path = os.path.join(cache_dir, "%s.npz" % key)
+    if os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        return {"feats": cached["feats"], "mu": cached["mu"], "sigma": cached["sigma"]}
+
+    transform = [transforms.ToTensor()]
+    if size > 0:
+        transform = [transforms.Resize(int(size), Image.BICUBIC)] + transform
+    transform = transforms.Compose(transform)
+    for path in paths:
+        extractor.add([transform(Image.open(path).convert("L" if output_nc == 1 else "RGB"))])
+    feats = extractor.finish()
+    mu, sigma = statistics(feats)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = cache_path + ".tmp.npz"
+    np.savez(tmp, feats=feats, mu=mu, sigma=sigma)
+    os.replace(tmp, cache_path)
+    print("cached reference statistics of %d images in %s" % (len(feats), cache_path))
+    return {"feats": feats, "mu": mu, "sigma": sigma}
+
+
+def score(feats, reference, kid_subsets=100, kid_subset_size=1000):
+    """FID and KID of generated features against reference statistics."""
+    mu, sigma = statistics(feats)
+    kid, kid_std = kernel_distance(feats, reference["feats"], kid_subsets, kid_subset_size)
+    return {"fid": frechet_distance(mu, sigma, reference["mu"], reference["sigma"]), "kid": kid, "kid_std": kid_std}
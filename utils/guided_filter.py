@@ -0,0 +1,71 @@
+"""Fast guided filter upsampling (He and Sun, 2015) for low-resolution generator outputs.
+
+The generator runs on a downscaled copy of the input. At that resolution the output is explained
+locally as an affine function of the input colours, out ~ A * input + b. The coefficients are
+smooth, so they are upsampled bilinearly and applied to the full-resolution input, which puts the
+sharp edges of the original image back. Flat-colour outputs are locally almost constant, which is
+where this works best. Everything is vectorised box filters plus one batched 3x3 solve per pixel.
+"""
+import torch
+import torch.nn.functional as F
+
+
+def box_filter(x, r):
+    """Mean over a (2r+1) x (2r+1) window, averaging only the pixels inside the image at the borders."""
+    return F.avg_pool2d(x, kernel_size=2 * r + 1, stride=1, padding=r, count_include_pad=False)
+
+
+def _round4(n):
+    return max(4, int(round(n / 4.0)) * 4)
+
+
+def guided_coefficients(guide, src, r, eps):
+    """Per-pixel affine coefficients A (N x Cg x Cs x H x W) and b (N x Cs x H x W) with src ~ A . guide + b."""
+    n, cg, h, w = guide.size()
+    cs = src.size()[1]
+    mean_I = box_filter(guide, r)
+    mean_p = box_filter(src, r)
+
+    if cg == 1:
+        cov_Ip = box_filter(guide * src, r) - mean_I * mean_p
+        var_I = box_filter(guide * guide, r) - mean_I * mean_I
+        A = (cov_Ip / (var_I + eps)).unsqueeze(1)
+        b = mean_p - A[:, 0] * mean_I
+        return A, b
+
+    # Cross-covariance between the guide channels and each output channel: N x Cg x Cs x H x W.
+    cov_Ip = box_filter((guide.unsqueeze(2) * src.unsqueeze(1)).view(n, cg * cs, h, w), r).view(n, cg, cs, h, w)
+    cov_Ip = cov_Ip - mean_I.unsqueeze(2) * mean_p.unsqueeze(1)
+    # Covariance of the guide channels: N x Cg x Cg x H x W, regularised by eps on the diagonal.
+    var_I = box_filter((guide.unsqueeze(2) * guide.unsqueeze(1)).view(n, cg * cg, h, w), r).view(n, cg, cg, h, w)
+    var_I = var_I - mean_I.unsqueeze(2) * mean_I.unsqueeze(1)
+    var_I = var_I + eps * torch.eye(cg, device=guide.device, dtype=guide.dtype).view(1, cg, cg, 1, 1)
+
+    A = torch.linalg.solve(var_I.permute(0, 3, 4, 1, 2), cov_Ip.permute(0, 3, 4, 1, 2))
+    A = A.permute(0, 3, 4, 1, 2)
+    b = mean_p - (A * mean_I.unsqueeze(2)).sum(dim=1)
+    return A, b
+
+
+def guided_upsample(low_out, low_guide, high_guide, r=4, eps=1e-3):
+    """Upsample low_out to the size of high_guide, following the edges of high_guide."""
+    A, b = guided_coefficients(low_guide, low_out, r, eps)
+    n, cg, cs, h, w = A.size()
+    size = high_guide.size()[2:]
+    mean_A = F.interpolate(box_filter(A.reshape(n, cg * cs, h, w), r), size=size, mode="bilinear",
+                           align_corners=False).view(n, cg, cs, size[0], size[1])
+    mean_b = F.interpolate(box_filter(b, r), size=size, mode="bilinear", align_corners=False)
+    out = (mean_A * high_guide.unsqueeze(2)).sum(dim=1) + mean_b
+    return torch.clamp(out, 0.0, 1.0)
+
+
+def guided_forward(net, img, size, r=4, eps=1e-3):
+    """Run net with the shorter side of img reduced to `size` and guided-upsample the result back."""
+    h, w = img.size()[2:]
+    scale = min(1.0, float(size) / min(h, w))
+    low_size = (_round4(h * scale), _round4(w * scale))
+    low_img = F.interpolate(img, size=low_size, mode="bilinear", align_corners=False, antialias=True)
+    low_out = net(low_img).to(img.device)
+    if tuple(low_out.size()[2:]) != low_size:
+        low_out = F.interpolate(low_out, size=low_size, mode="bilinear", align_corners=False)
+    return guided_upsample(low_out.float(), low_img.float(), img.float(), r=r, eps=eps)
@@ -0,0 +1,153 @@
+"""Asynchronous result writing with configurable output formats.
+
+Encoding a PNG at the default zlib level often costs more than the generator forward on a CPU, so
+the writer hands images to a pool of workers and returns immediately; the next batch is inferred
+while the previous one is being compressed. Formats:
+
+    png   -- lossless, zlib level set by png_level (0-9, 1 is much faster than the default 6)
+    webp  -- lossless WebP, usually smaller than PNG for flat colours
+    npy   -- the raw float output of the network, no encoding at all
+
+With palette > 0, PNGs are written as palette images of at most that many colours. Flat-colour
+outputs only have a handful of colours, so this shrinks files and speeds up compression, but it is
+lossy whenever an image has more colours than the palette.
+
+Given a ShardWriter, results are not written as files: the workers only encode to bytes and the
+calling thread appends them to the shards in submission order (see utils/shards.py).
+"""
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+EXTENSIONS = {"png": ".png", "webp": ".webp", "npy": ".npy"}
+
+
+def to_array(tensor, fmt):
+    """C x H x W (or 1 x C x H x W) tensor in [0, 1] to the array the encoder needs, on the calling thread."""
+    tensor = tensor.detach()
+    if tensor.dim() == 4:
+        tensor = tensor[0]
+    if fmt == "npy":
+        return tensor.float().cpu().contiguous().numpy()
+    # Same rounding as torchvision.utils.save_image.
+    array = tensor.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8).cpu()
+    return array.permute(1, 2, 0).contiguous().numpy()
+
+
+def encode(array, path, fmt, png_level=6, palette=0):
+    """Encode array to path, which may also be a binary file object."""
+    if fmt == "npy":
+        np.save(path, array)
+        return path
+    if array.shape[2] == 1:
+        img = Image.fromarray(array[:, :, 0], mode="L")
+    else:
+        img = Image.fromarray(array[:, :, :3], mode="RGB")
+    if fmt == "webp":
+        img.save(path, format="WEBP", lossless=True)
+    else:
+        if palette > 0 and img.mode == "RGB":
+            img = img.quantize(colors=palette, method=Image.FASTOCTREE)
+        img.save(path, format="PNG", compress_level=png_level)
+    return path
+
+
+def encode_bytes(array, fmt, png_level=6, palette=0):
+    buf = io.BytesIO()
+    encode(array, buf, fmt, png_level, palette)
+    return buf.getvalue()
+
+
+class ImageWriter():
+    """Write result images on a thread or process pool.
+
+    Parameters:
+        fmt (str)         -- png, webp or npy
+        png_level (int)   -- zlib compression level for png
+        palette (int)     -- if > 0, write png as palette images with at most this many colours
+        workers (int)     -- pool size; 0 writes synchronously on the calling thread
+        processes (bool)  -- use processes instead of threads
+        max_pending (int) -- images allowed in flight before write() blocks, bounding memory
+        shards            -- ShardWriter to append the results to instead of writing files; the
+                             member name is the base name of the path given to write()
+    """
+    def __init__(self, fmt="png", png_level=6, palette=0, workers=4, processes=False, max_pending=64, shards=None):
+        if fmt not in EXTENSIONS:
+            raise ValueError("output format [%s] is not supported, use one of [%s]" % (fmt, " | ".join(EXTENSIONS)))
+        self.fmt = fmt
+        self.ext = EXTENSIONS[fmt]
+        self.png_level = png_level
+        self.palette = palette
+        self.max_pending = max_pending
+        self.pending = []
+        self.shards = shards
+        self.shard_queue = deque()
+        self.pool = None
+        if workers > 0:
+            self.pool = ProcessPoolExecutor(workers) if processes else ThreadPoolExecutor(workers)
+
+    def path(self, stem):
+        return stem + self.ext
+
+    def write(self, tensor, path):
+        """Queue tensor to be written at path; returns a future (already resolved without a pool)."""
+        array = to_array(tensor, self.fmt)
+        if self.shards is not None:
+            return self._write_shard(array, os.path.basename(path))
+        if self.pool is None:
+            return _Done(encode(array, path, self.fmt, self.png_level, self.palette))
+        self.pending = [f for f in self.pending if not f.done()]
+        while len(self.pending) >= self.max_pending:
+            self.pending.pop(0).result()
+        future = self.pool.submit(encode, array, path, self.fmt, self.png_level, self.palette)
+        self.pending.append(future)
+        return future
+
+    def _write_shard(self, array, name):
+        if self.pool is None:
+            future = _Done(encode_bytes(array, self.fmt, self.png_level, self.palette))
+        else:
+            future = self.pool.submit(encode_bytes, array, self.fmt, self.png_level, self.palette)
+        self.shard_queue.append((name, future))
+        self._drain_shards(block=len(self.shard_queue) > self.max_pending)
+        return future
+
+    def _drain_shards(self, block=False):
+        # Appending in submission order keeps the shards deterministic for a given input order.
+        while len(self.shard_queue) > 0 and (block or self.shard_queue[0][1].done()):
+            name, future = self.shard_queue.popleft()
+            self.shards.write(name, future.result())
+            block = block and len(self.shard_queue) > self.max_pending
+
+    def flush(self):
+        """Wait until everything written so far is on disk (or appended to the shards)."""
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        if self.shards is not None:
+            while len(self.shard_queue) > 0:
+                self._drain_shards(block=True)
+
+    def close(self):
+        self.flush()
+        if self.shards is not None:
+            self.shards.close()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+
+class _Done():
+    """Resolved future for synchronous writes."""
+    def __init__(self, result):
+        self._result = result
+
+    def done(self):
+        return True
+
+    def result(self):
+        return self._result
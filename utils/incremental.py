@@ -0,0 +1,190 @@
+"""Re-run a network only on the parts of an image that changed.
+
+Consecutive animation frames are often identical or differ only locally (holds, static
+backgrounds, a moving character). `IncrementalForward` keeps the last input and output, compares a
+new image with them tile by tile with one vectorised max-pool over the absolute difference, and
+runs the network only on the tiles whose output a change can reach: the changed tiles grown by the
+network's receptive field radius. Every such tile is cropped together with a halo of that radius,
+so the recomputed centre matches a full pass over the image, and is composited over the previous
+output. Unchanged tiles are copied bit for bit, which also keeps still regions temporally stable.
+
+InstanceNorm would normalise every crop with its own statistics, so the statistics of the last
+full pass (a keyframe) are frozen with `GlobalInstanceNorm` and used for all crops until the next
+keyframe.
+
+`LineageCache` keeps one such state per image lineage (successive submissions of the same
+artwork), so a resubmitted image with local edits only pays for the tiles around the edits.
+"""
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+from utils.tiling import GlobalInstanceNorm, is_eager_float
+
+
+def changed_tiles(reference, img, tile, threshold):
+    """Boolean tile grid (N x rows x cols) marking tiles where any pixel differs by more than threshold."""
+    diff = (img - reference).abs().amax(dim=1, keepdim=True)
+    return F.max_pool2d(diff, kernel_size=tile, stride=tile, ceil_mode=True)[:, 0] > threshold
+
+
+def receptive_radius(net, channels, device, probe=256, default=64):
+    """Distance in input pixels beyond which a change cannot affect an output pixel, rounded up to a multiple of 4.
+
+    Measured from the gradient of one output pixel with respect to the input. InstanceNorm
+    statistics are frozen during the probe, since they would otherwise spread the gradient over the
+    whole image. Networks that are not eager float modules (TorchScript, int8, ONNX) get `default`.
+    Only the input receives a gradient; the parameters of net are left untouched.
+    """
+    if not is_eager_float(net):
+        return default
+    x = torch.rand(1, channels, probe, probe, device=device)
+    norm = GlobalInstanceNorm(net)
+    params = list(net.parameters())
+    requires_grad = [p.requires_grad for p in params]
+    try:
+        for p in params:
+            p.requires_grad_(False)
+        with torch.enable_grad():
+            norm.record(x)
+            x.requires_grad_(True)
+            with norm:
+                out = net(x)
+            out[:, :, probe // 2, probe // 2].sum().backward()
+    finally:
+        for p, flag in zip(params, requires_grad):
+            p.requires_grad_(flag)
+    rows, cols = torch.nonzero(x.grad.abs().sum(dim=(0, 1)), as_tuple=True)
+    if len(rows) == 0:
+        return 4
+    radius = max((rows - probe // 2).abs().max().item(), (cols - probe // 2).abs().max().item()) + 1
+    return -(-radius // 4) * 4
+
+
+class IncrementalForward():
+    """Callable that runs net on the tiles of an image that changed since the previous call.
+
+    Parameters:
+        net                -- image-to-image network
+        tile (int)         -- side of the tiles that are compared and recomputed, multiple of 4
+        halo (int)         -- context around every tile, normally receptive_radius(net, ...)
+        threshold (float)  -- largest per-pixel difference (in [0, 1] units) treated as unchanged
+        max_changed (float)-- run a full keyframe pass when more than this fraction of tiles changed
+        keyframe_interval (int) -- also run a keyframe every this many calls, 0 to disable
+        tile_batch (int)   -- number of crops per forward pass
+    """
+    def __init__(self, net, tile=128, halo=64, threshold=2.0 / 255, max_changed=0.5, keyframe_interval=0,
+                 tile_batch=8):
+        self.net = net
+        self.tile = max(4, tile // 4 * 4)
+        self.halo = -(-halo // 4) * 4
+        self.threshold = threshold
+        self.max_changed = max_changed
+        self.keyframe_interval = keyframe_interval
+        self.tile_batch = tile_batch
+        self.norm = GlobalInstanceNorm(net)
+        self.reset()
+        self.counts = {"calls": 0, "keyframes": 0, "reused": 0, "tiles": 0, "recomputed": 0}
+
+    def reset(self):
+        self.reference = None
+        self.output = None
+        self.since_keyframe = 0
+
+    def keyframe(self, img):
+        if len(self.norm.norms) > 0:
+            self.output = self.norm.record(img)
+        else:
+            with torch.no_grad():
+                self.output = self.net(img)
+        self.reference = img.clone()
+        self.since_keyframe = 0
+        self.counts["keyframes"] += 1
+        return self.output
+
+    def __call__(self, img):
+        """img is a 1 x C x H x W batch with H and W multiples of 4; returns the network output for it."""
+        self.counts["calls"] += 1
+        self.since_keyframe += 1
+        h, w = img.size()[2:]
+        if self.reference is None or self.reference.size() != img.size() or \
+                (self.keyframe_interval > 0 and self.since_keyframe >= self.keyframe_interval) or \
+                h < self.tile or w < self.tile:
+            return self.keyframe(img)
+
+        dirty = changed_tiles(self.reference, img, self.tile, self.threshold)[0]
+        # A changed pixel influences outputs up to halo pixels away, i.e. in neighbouring tiles too.
+        reach = -(-self.halo // self.tile)
+        dirty = F.max_pool2d(dirty[None].float(), kernel_size=2 * reach + 1, stride=1, padding=reach)[0] > 0
+        self.counts["tiles"] += dirty.numel()
+        if dirty.float().mean().item() > self.max_changed:
+            return self.keyframe(img)
+        boxes = [(r * self.tile, c * self.tile) for r, c in torch.nonzero(dirty).tolist()]
+        if len(boxes) == 0:
+            self.counts["reused"] += 1
+            return self.output
+        self.counts["recomputed"] += len(boxes)
+        self.update(img, boxes)
+        return self.output
+
+    def update(self, img, boxes):
+        """Recompute the output of the tiles with top-left corners boxes and composite them in place."""
+        h, w = img.size()[2:]
+        crop_h = min(self.tile + 2 * self.halo, h)
+        crop_w = min(self.tile + 2 * self.halo, w)
+        # Crops are shifted to stay inside the image, so borders see the same padding as a full pass.
+        # All offsets stay multiples of 4, keeping the stride-2 sampling grid of the full pass.
+        origins = [(min(max(y - self.halo, 0), h - crop_h), min(max(x - self.halo, 0), w - crop_w)) for y, x in boxes]
+        output = self.output.clone()
+        for k in range(0, len(boxes), self.tile_batch):
+            chunk = list(zip(boxes[k:k + self.tile_batch], origins[k:k + self.tile_batch]))
+            crops = torch.cat([img[:, :, oy:oy + crop_h, ox:ox + crop_w] for _, (oy, ox) in chunk])
+            if len(self.norm.stats) > 0:
+                with self.norm:
+                    res = self.net(crops)
+            else:
+                res = self.net(crops)
+            res = res.to(output.device)
+            for j, ((y, x), (oy, ox)) in enumerate(chunk):
+                th, tw = min(self.tile, h - y), min(self.tile, w - x)
+                output[:, :, y:y + th, x:x + tw] = res[j:j + 1, :, y - oy:y - oy + th, x - ox:x - ox + tw]
+                self.reference[:, :, y:y + th, x:x + tw] = img[:, :, y:y + th, x:x + tw]
+        self.output = output
+
+    def report(self):
+        c = self.counts
+        print("incremental inference: %d images, %d keyframes, %d reused unchanged, %d of %d compared tiles recomputed"
+              % (c["calls"], c["keyframes"], c["reused"], c["recomputed"], c["tiles"]))
+
+
+class LineageCache():
+    """Per-lineage IncrementalForward states, the least recently used dropped beyond max_lineages.
+
+    All lineages share net; the keyword arguments are passed on to every IncrementalForward.
+    """
+    def __init__(self, net, max_lineages=16, **kwargs):
+        self.net = net
+        self.max_lineages = max_lineages
+        self.kwargs = kwargs
+        self.states = OrderedDict()
+
+    def __call__(self, lineage, img):
+        state = self.states.pop(lineage, None)
+        if state is None:
+            state = IncrementalForward(self.net, **self.kwargs)
+        self.states[lineage] = state
+        while len(self.states) > self.max_lineages:
+            self.states.popitem(last=False)
+        return state(img)
+
+    def drop(self, lineage):
+        self.states.pop(lineage, None)
+
+    def counts(self):
+        """Counters summed over the lineages currently cached."""
+        totals = {"lineages": len(self.states)}
+        for state in self.states.values():
+            for key, value in state.counts.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
@@ -0,0 +1,86 @@
+"""channels_last (NHWC) memory format support.
+
+Models and batches are converted once: networks with `convert_net` and batches inside the DataLoader
+workers with `channels_last_collate`, so the main process never re-lays out the input. `LayoutAudit`
+watches every torch op for a few steps and reports the ones that silently return NCHW tensors from
+NHWC inputs, i.e. the places where the graph leaves the channels_last layout.
+"""
+from collections import Counter
+
+import torch
+from torch.overrides import TorchFunctionMode
+from torch.utils.data import default_collate
+
+
+def to_channels_last(data):
+    """Convert every 4D tensor in a (nested) batch to channels_last."""
+    if isinstance(data, torch.Tensor):
+        if data.dim() == 4:
+            return data.contiguous(memory_format=torch.channels_last)
+        return data
+    if isinstance(data, dict):
+        return {k: to_channels_last(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(to_channels_last(v) for v in data)
+    return data
+
+
+def channels_last_collate(batch, collate_fn=default_collate):
+    return to_channels_last(collate_fn(batch))
+
+
+def convert_net(net):
+    return net.to(memory_format=torch.channels_last)
+
+
+def _is_nhwc(t):
+    # Tensors with one channel or a 1x1 plane are contiguous in both layouts and tell us nothing.
+    return t.dim() == 4 and t.is_contiguous(memory_format=torch.channels_last) and not t.is_contiguous()
+
+
+def _is_nchw(t):
+    return t.dim() == 4 and t.is_contiguous() and not t.is_contiguous(memory_format=torch.channels_last)
+
+
+def _tensors(data):
+    if isinstance(data, torch.Tensor):
+        yield data
+    elif isinstance(data, dict):
+        for v in data.values():
+            yield from _tensors(v)
+    elif isinstance(data, (list, tuple)):
+        for v in data:
+            yield from _tensors(v)
+
+
+class LayoutAudit(TorchFunctionMode):
+    """Count the torch ops that take a channels_last tensor and return a contiguous NCHW one."""
+    def __init__(self):
+        super().__init__()
+        self.reverted = Counter()
+        self.active = False
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        out = func(*args, **kwargs)
+        if any(_is_nhwc(t) for t in _tensors((args, kwargs))) and any(_is_nchw(t) for t in _tensors(out)):
+            self.reverted[getattr(func, "__qualname__", getattr(func, "__name__", str(func)))] += 1
+        return out
+
+    def start(self):
+        if not self.active:
+            self.__enter__()
+            self.active = True
+
+    def stop(self):
+        if self.active:
+            self.__exit__(None, None, None)
+            self.active = False
+
+    def report(self):
+        if len(self.reverted) == 0:
+            print("channels_last: no op converted back to NCHW")
+            return
+        print("channels_last: ops that converted back to NCHW (calls):")
+        for name, count in self.reverted.most_common():
+            print("    %s: %d" % (name, count))
@@ -0,0 +1,39 @@
+"""Full-reference image metrics for comparing two renderings of the same input (values in [0, 1])."""
+import torch
+import torch.nn.functional as F
+
+
+def psnr(img1, img2, max_val=1.0):
+    """Peak signal-to-noise ratio in dB, one value per image of the batch."""
+    mse = torch.mean((img1.float() - img2.float()) ** 2, dim=[1, 2, 3])
+    return 10.0 * torch.log10(max_val ** 2 / torch.clamp(mse, min=1e-10))
+
+
+def _gaussian_window(size, sigma, channels, device):
+    coords = torch.arange(size, dtype=torch.float32, device=device) - size // 2
+    g = torch.exp(-(coords ** 2) / (2 * sigma ** 2))
+    g = g / g.sum()
+    window = torch.outer(g, g)
+    return window.expand(channels, 1, size, size).contiguous()
+
+
+def ssim(img1, img2, window_size=11, sigma=1.5, max_val=1.0):
+    """Structural similarity with a Gaussian window, one value per image of the batch."""
+    img1 = img1.float()
+    img2 = img2.float()
+    channels = img1.size()[1]
+    window = _gaussian_window(window_size, sigma, channels, img1.device)
+    c1 = (0.01 * max_val) ** 2
+    c2 = (0.03 * max_val) ** 2
+
+    mu1 = F.conv2d(img1, window, groups=channels)
+    mu2 = F.conv2d(img2, window, groups=channels)
+    mu1_sq = mu1 ** 2
+    mu2_sq = mu2 ** 2
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = F.conv2d(img1 * img1, window, groups=channels) - mu1_sq
+    sigma2_sq = F.conv2d(img2 * img2, window, groups=channels) - mu2_sq
+    sigma12 = F.conv2d(img1 * img2, window, groups=channels) - mu1_mu2
+
+    ssim_map = ((2 * mu1_mu2 + c1) * (2 * sigma12 + c2)) / ((mu1_sq + mu2_sq + c1) * (sigma1_sq + sigma2_sq + c2))
+    return ssim_map.mean(dim=[1, 2, 3])
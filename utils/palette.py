@@ -0,0 +1,114 @@
+"""Vectorised palette reduction and alpha compositing for flat-colour images.
+
+Everything works on H x W x C uint8 NumPy arrays. A palette is built from (a sample of) the
+distinct colours of an image, weighted by how often they occur, by median cut and optionally
+refined with k-means; pixels are then mapped to their nearest palette colour. Flat-colour art
+has few distinct colours compared with its pixel count, so both steps run on the distinct
+colours rather than on every pixel.
+"""
+import numpy as np
+
+
+def parse_background(background, rng=None):
+    """'white', 'random' or 'r,g,b' to an RGB uint8 array."""
+    if background == "white":
+        return np.array([255, 255, 255], np.uint8)
+    if background == "random":
+        rng = rng if rng is not None else np.random
+        return rng.randint(0, 256, 3).astype(np.uint8)
+    return np.array([int(c) for c in background.split(",")], np.uint8)
+
+
+def composite_alpha(rgba, background):
+    """H x W x 4 uint8 over a background colour, as H x W x 3 uint8."""
+    alpha = rgba[:, :, 3:4].astype(np.float32) / 255
+    rgb = rgba[:, :, :3].astype(np.float32) * alpha + background.astype(np.float32) * (1 - alpha)
+    return (rgb + 0.5).astype(np.uint8)
+
+
+def distinct_colours(rgb):
+    """Distinct colours of an H x W x 3 image, their counts and the index of every pixel's colour."""
+    packed = (rgb[:, :, 0].astype(np.uint32) << 16) | (rgb[:, :, 1].astype(np.uint32) << 8) | rgb[:, :, 2]
+    keys, inverse, counts = np.unique(packed.ravel(), return_inverse=True, return_counts=True)
+    colours = np.stack([(keys >> 16) & 255, (keys >> 8) & 255, keys & 255], axis=1).astype(np.float32)
+    return colours, counts.astype(np.float64), inverse
+
+
+def median_cut(colours, weights, n):
+    """Palette of at most n colours: repeatedly split the box with the largest weighted spread at its weighted median."""
+    def spread(box):
+        if len(box) < 2:
+            return -1.0
+        c = colours[box]
+        return float((c.max(axis=0) - c.min(axis=0)).max() * weights[box].sum())
+
+    boxes = [np.arange(len(colours))]
+    spreads = [spread(boxes[0])]
+    while len(boxes) < n:
+        k = int(np.argmax(spreads))
+        if spreads[k] <= 0:
+            break
+        box = boxes.pop(k)
+        spreads.pop(k)
+        c = colours[box]
+        channel = int(np.argmax(c.max(axis=0) - c.min(axis=0)))
+        order = box[np.argsort(c[:, channel], kind="stable")]
+        cumulative = np.cumsum(weights[order])
+        split = int(np.searchsorted(cumulative, cumulative[-1] / 2))
+        split = min(max(split, 1), len(order) - 1)
+        for half in (order[:split], order[split:]):
+            boxes.append(half)
+            spreads.append(spread(half))
+    return np.stack([np.average(colours[box], axis=0, weights=weights[box]) for box in boxes])
+
+
+def nearest(colours, palette, chunk=65536):
+    """Index of the nearest palette entry of every colour, in chunks of squared-distance matrices."""
+    p2 = (palette ** 2).sum(axis=1)
+    out = np.empty(len(colours), np.int64)
+    for start in range(0, len(colours), chunk):
+        c = colours[start:start + chunk]
+        out[start:start + chunk] = np.argmin(p2[None, :] - 2 * c @ palette.T, axis=1)
+    return out
+
+
+def kmeans(colours, weights, palette, iterations=8):
+    """Weighted k-means (Lloyd) over the distinct colours, starting from palette."""
+    palette = palette.copy()
+    for _ in range(iterations):
+        labels = nearest(colours, palette)
+        totals = np.bincount(labels, weights=weights, minlength=len(palette))
+        sums = np.stack([np.bincount(labels, weights=weights * colours[:, ch], minlength=len(palette))
+                         for ch in range(3)], axis=1)
+        used = totals > 0
+        moved = sums[used] / totals[used, None]
+        if np.allclose(moved, palette[used], atol=0.25):
+            palette[used] = moved
+            break
+        palette[used] = moved
+    return palette
+
+
+def reduce_palette(rgb, n=250, method="median_cut", iterations=8, sample=1 << 16):
+    """H x W x 3 uint8 image with at most n colours.
+
+    Parameters:
+        n (int)          -- palette size
+        method (str)     -- 'median_cut', or 'kmeans' to refine the median-cut palette
+        iterations (int) -- k-means iterations
+        sample (int)     -- most distinct colours the palette is built from (the most frequent ones)
+    """
+    colours, counts, inverse = distinct_colours(rgb)
+    if len(colours) <= n:
+        return rgb
+    fit, weights = colours, counts
+    if len(colours) > sample:
+        picked = np.argpartition(counts, -sample)[-sample:]
+        fit, weights = colours[picked], counts[picked]
+    palette = median_cut(fit, weights, n)
+    if method == "kmeans":
+        palette = kmeans(fit, weights, palette, iterations)
+    palette = np.clip(palette + 0.5, 0, 255).astype(np.uint8)
+    # Every distinct colour is mapped once, then the mapping is gathered for all pixels.
+    mapped = palette[nearest(colours, palette.astype(np.float32))]
+    return mapped[inverse].reshape(rgb.shape)
@@ -0,0 +1,196 @@
+"""Multi-head inference shared by test.py and test_sketch.py.
+
+A pipeline is a list of heads. Each head applies a network either to the input batch or to the
+output of an earlier head: the flat-colour generator on the input, the geometry predictor or the
+netG_B reconstruction on its output, a sketch generator on the input. Every image is decoded once
+and all requested heads run on the same batch, on the same device, and are written by the same
+writer.
+
+Both scripts also share their common options (add_inference_options), the size-bucketed loader
+(make_loader) and the loop that brings each batch to the device (padded_batches).
+"""
+import functools
+import os
+from collections import OrderedDict
+
+import torch
+from torch.autograd import Variable
+from torch.utils.data import DataLoader
+
+from data.sampler import load_sizes, pad_collate, SizeBucketBatchSampler
+from models.model import Generator, GeometryPredictor, GlobalGenerator2, InceptionV3
+from utils.compile import crop_to_input, pad_to_bucket
+from utils.memory_format import channels_last_collate, LayoutAudit
+
+
+def add_inference_options(parser, output_nc=3, how_many=100):
+    """Add the options test.py and test_sketch.py share: experiment, dataset, networks, batching and output."""
+    parser.add_argument('--name', required=True, type=str, help='name of this experiment')
+    parser.add_argument('--checkpoints_dir', type=str, default='checkpoints', help='Where the model checkpoints are saved')
+    parser.add_argument('--results_dir', type=str, default='results', help='where to save result images')
+    parser.add_argument('--geom_name', type=str, default='feats2Geom', help='name of the geometry predictor')
+    parser.add_argument('--batchSize', type=int, default=1, help='size of the batches')
+    parser.add_argument('--dataroot', type=str, default='', help='root directory of the dataset')
+    parser.add_argument('--depthroot', type=str, default='', help='dataset of corresponding ground truth depth maps')
+
+    parser.add_argument('--input_nc', type=int, default=3, help='number of channels of input data')
+    parser.add_argument('--output_nc', type=int, default=output_nc, help='number of channels of output data')
+    parser.add_argument('--geom_nc', type=int, default=3, help='number of channels of geometry data')
+    parser.add_argument('--every_feat', type=int, default=1, help='use transfer features for the geometry loss')
+    parser.add_argument('--num_classes', type=int, default=55, help='number of classes for inception')
+    parser.add_argument('--midas', type=int, default=0, help='use midas depth map')
+
+    parser.add_argument('--ngf', type=int, default=64, help='# of gen filters in first conv layer')
+    parser.add_argument('--n_blocks', type=int, default=3, help='number of resnet blocks for generator')
+    parser.add_argument('--size', type=int, default=256, help='size of the data (squared assumed)')
+    parser.add_argument('--cuda', action='store_true', help='use GPU computation', default=True)
+    parser.add_argument('--n_cpu', type=int, default=8, help='number of cpu threads to use during batch generation')
+    parser.add_argument('--which_epoch', type=str, default='latest', help='which epoch to load from')
+    parser.add_argument('--aspect_ratio', type=float, default=1.0, help='The ratio width/height. The final height of the load image will be crop_size/aspect_ratio')
+
+    parser.add_argument('--mode', type=str, default='test', help='train, val, test, etc')
+    parser.add_argument('--load_size', type=int, default=256, help='scale images to this size')
+    parser.add_argument('--crop_size', type=int, default=256, help='then crop to this size')
+    parser.add_argument('--max_dataset_size', type=int, default=float("inf"), help='Maximum number of samples allowed per dataset. If the dataset directory contains more than max_dataset_size, only a subset is loaded.')
+    parser.add_argument('--preprocess', type=str, default='resize_and_crop', help='scaling and cropping of images at load time [resize_and_crop | crop | scale_width | scale_width_and_crop | none]')
+    parser.add_argument('--no_flip', action='store_true', help='if specified, do not flip the images for data augmentation')
+    parser.add_argument('--norm', type=str, default='instance', help='instance normalization or batch normalization')
+
+    parser.add_argument('--predict_depth', type=int, default=0, help='run geometry prediction on the generated images')
+    parser.add_argument('--save_input', type=int, default=0, help='save input image')
+    parser.add_argument('--reconstruct', type=int, default=0, help='get reconstruction')
+    parser.add_argument('--how_many', type=int, default=how_many, help='number of images to test')
+    parser.add_argument('--compile', type=int, default=0, help='accelerate the networks with torch.compile')
+    parser.add_argument('--compile_cache', type=str, default='checkpoints/compile_cache', help='persistent torch.compile cache directory')
+    parser.add_argument('--channels_last', type=int, default=0, help='run models and batches in channels_last (NHWC)')
+    parser.add_argument('--compile_bucket', type=int, default=32, help='with --compile, pad image sides to a multiple of this so images whose sizes round up to the same multiple reuse one compiled graph instead of recompiling; the padding enters the InstanceNorm statistics, so outputs differ slightly from eager mode (4, the multiple every batch is padded to anyway, keeps them exact but recompiles for every size)')
+    parser.add_argument('--bucket_step', type=int, default=4, help='batch images whose sizes round up to the same multiple of this (at least 4)')
+    parser.add_argument('--writer_workers', type=int, default=4, help='threads (or processes) encoding the results while the next batch runs, 0 to write synchronously')
+    parser.add_argument('--shard_mb', type=int, default=0, help='pack the results into tar shards of about this size (read them with python -m utils.shards) instead of one file each, 0 to disable')
+    return parser
+
+
+def make_loader(dataset, opt, resize, batch_sampler=None):
+    """DataLoader over dataset in size-bucketed batches padded to a multiple of 4 (NHWC with --channels_last).
+
+    resize is the shorter side the dataset resizes to, 0 if it keeps the image sizes; batch_sampler
+    replaces the size buckets, e.g. with one frame per batch.
+    """
+    if batch_sampler is None:
+        batch_sampler = SizeBucketBatchSampler(load_sizes(dataset.data, resize), opt.batchSize, step=opt.bucket_step)
+    collate = pad_collate
+    if opt.channels_last == 1:
+        collate = functools.partial(channels_last_collate, collate_fn=pad_collate)
+    return DataLoader(dataset, batch_sampler=batch_sampler, num_workers=opt.n_cpu, collate_fn=collate)
+
+
+def padded_batches(dataloader, device, compile_bucket=0, audit=False):
+    """Yield (input_image, batch): the batch's images on device, padded to compile_bucket, and the batch itself.
+
+    With audit, the ops that leave the channels_last layout while the first batch is processed are reported.
+    """
+    layout_audit = None
+    if audit:
+        layout_audit = LayoutAudit()
+        layout_audit.start()
+    try:
+        for i, batch in enumerate(dataloader):
+            if layout_audit is not None and i == 1:
+                layout_audit.stop()
+                layout_audit.report()
+                layout_audit = None
+            yield pad_to_bucket(Variable(batch['r']).to(device), compile_bucket), batch
+    finally:
+        if layout_audit is not None:
+            layout_audit.stop()
+            layout_audit.report()
+
+
+def load_generator(path, input_nc, output_nc, n_blocks, device):
+    net = Generator(input_nc, output_nc, n_blocks)
+    net.load_state_dict(torch.load(path, map_location=device))
+    net.to(device)
+    net.eval()
+    print('loaded', path)
+    return net
+
+
+def geometry_path(checkpoints_dir, name, geom_name, filename="feats2depth.pth"):
+    """The geometry checkpoint of experiment geom_name if that exists, else the one of name."""
+    if len(geom_name) > 0 and os.path.exists(os.path.join(checkpoints_dir, geom_name)):
+        name = geom_name
+    return os.path.join(checkpoints_dir, name, filename)
+
+
+def load_geometry(path, geom_nc, num_classes, every_feat, device):
+    """InceptionV3 features followed by the feats2depth network, as one GeometryPredictor."""
+    net_geom = GlobalGenerator2(768, geom_nc, n_downsampling=1, n_UPsampling=3)
+    net_geom.load_state_dict(torch.load(path, map_location=device))
+    net_recog = InceptionV3(num_classes, False, use_aux=True, pretrain=True, freeze=True, every_feat=every_feat)
+    net = GeometryPredictor(net_recog, net_geom)
+    net.to(device)
+    net.eval()
+    print('loaded', path)
+    return net
+
+
+class Head():
+    """One output of the pipeline.
+
+    Parameters:
+        name (str)   -- key of the output, also the suffix of the written file
+        net          -- network (or any callable) producing it
+        source (str) -- 'input' or the name of an earlier head whose output is fed to net
+        to_image     -- optional function applied to a cropped output before it is written
+    """
+    def __init__(self, name, net, source="input", to_image=None):
+        self.name = name
+        self.net = net
+        self.source = source
+        self.to_image = to_image
+
+
+class InferencePipeline():
+    """Run heads in order on a batch; forward(net, x) runs one network (plain call by default)."""
+    def __init__(self, heads, forward=None):
+        known = {"input"}
+        for head in heads:
+            if head.source not in known:
+                raise ValueError("head [%s] reads [%s], which is not computed before it" % (head.name, head.source))
+            known.add(head.name)
+        self.heads = heads
+        self.forward = forward if forward is not None else (lambda net, x: net(x))
+
+    def names(self):
+        return [head.name for head in self.heads]
+
+    def nets(self):
+        return OrderedDict((head.name, head.net) for head in self.heads)
+
+    def run(self, x, given=None):
+        """Outputs of every head for the batch x; heads already in `given` are not recomputed."""
+        outputs = {"input": x}
+        outputs.update(given or {})
+        for head in self.heads:
+            if head.name not in outputs:
+                outputs[head.name] = self.forward(head.net, outputs[head.source])
+        return outputs
+
+    def write_batch(self, writer, outputs, padded, batch, result_paths):
+        """Write every item of batch; returns {name: (paths, futures)}, with result_paths(name) -> {output: path}."""
+        written = OrderedDict()
+        for j, (name, size) in enumerate(zip(batch['name'], batch['size'].tolist())):
+            paths = result_paths(name)
+            written[name] = (paths, self.write(writer, outputs, padded, j, size, paths))
+        return written
+
+    def write(self, writer, outputs, padded, j, size, paths):
+        """Write item j of every output named in paths ({name: path}); returns the writer futures."""
+        to_image = {head.name: head.to_image for head in self.heads}
+        futures = []
+        for name, path in paths.items():
+            img = crop_to_input(outputs[name][j:j + 1], padded, size)
+            if to_image.get(name) is not None:
+                img = to_image[name](img)
+            futures.append(writer.write(img.data, path))
+        return futures
@@ -0,0 +1,109 @@
+"""Content-addressed on-disk cache of conversion results.
+
+An entry is keyed by the hash of the input file bytes, the hashes of the checkpoints that produced
+it and the inference options, so a hit is exactly the output the run would have computed. Entries
+hold every file written for an input (`_out`, `_geom`, ...) and are evicted least recently used once
+the cache grows past its size cap. File digests are memoised by (path, size, mtime), so unchanged
+inputs are not even re-read on later runs.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+
+def file_digest(path, chunk=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ResultCache():
+    """LRU store of result files under `root`, capped at `max_mb` megabytes."""
+    def __init__(self, root, max_mb=10240):
+        self.root = root
+        self.max_bytes = int(max_mb * 2 ** 20)
+        os.makedirs(root, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, "index.sqlite"))
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, files TEXT, size INTEGER, used REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, digest TEXT)")
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, path):
+        """sha256 of a file, reusing the stored digest while its size and mtime are unchanged."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        row = self.db.execute("SELECT size, mtime, digest FROM digests WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime:
+            return row[2]
+        digest = file_digest(path)
+        self.db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)", (path, st.st_size, st.st_mtime, digest))
+        return digest
+
+    def context_key(self, checkpoints, options):
+        """Hash of the checkpoint contents and the options that influence the output."""
+        h = hashlib.sha256()
+        for path in checkpoints:
+            h.update(self.digest(path).encode())
+        h.update(json.dumps(options, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def key(self, input_path, context):
+        return hashlib.sha256((self.digest(input_path) + context).encode()).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def fetch(self, key, targets):
+        """Copy a cached entry to targets ({suffix: path}); returns False on a miss."""
+        row = self.db.execute("SELECT files FROM entries WHERE key = ?", (key,)).fetchone()
+        files = json.loads(row[0]) if row is not None else {}
+        entry_dir = self._entry_dir(key)
+        if not all(suffix in files and os.path.exists(os.path.join(entry_dir, files[suffix])) for suffix in targets):
+            self.misses += 1
+            return False
+        for suffix, target in targets.items():
+            shutil.copyfile(os.path.join(entry_dir, files[suffix]), target)
+        self.db.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        return True
+
+    def put(self, key, sources):
+        """Store the result files sources ({suffix: path}) under key and evict old entries if over the cap."""
+        entry_dir = self._entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        files = {}
+        size = 0
+        for suffix, source in sources.items():
+            name = suffix + os.path.splitext(source)[1]
+            shutil.copyfile(source, os.path.join(entry_dir, name))
+            files[suffix] = name
+            size += os.path.getsize(source)
+        self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (key, json.dumps(files), size, time.time()))
+        self.evict()
+
+    def evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            self.db.commit()
+            return
+        for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY used ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+        self.db.commit()
+
+    def flush(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
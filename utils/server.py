@@ -0,0 +1,271 @@
+"""A small asyncio HTTP server that runs an image-to-image network with dynamic micro-batching.
+
+Concurrent requests are queued, and the batcher collects them until either `max_batch` images are
+waiting or the oldest has waited `max_wait` seconds. Images of one micro-batch are grouped by
+size, padded to a common multiple of 4 and run together. Decoding, encoding and the forward pass
+run in worker threads, so the event loop keeps accepting connections while a batch runs.
+
+Endpoints:
+    POST /convert[?format=png|webp]  -- image bytes in the body, converted image bytes back
+    POST /convert?lineage=<id>       -- incremental conversion of a resubmitted image: only the tiles
+                                        that differ from the last submission of that lineage are
+                                        recomputed (needs a LineageCache, bypasses micro-batching)
+    GET  /health                     -- liveness and model information
+    GET  /metrics                    -- queue depth, batch sizes and latency percentiles
+
+Only the standard library is used for HTTP. `http_request` is a matching loopback client.
+"""
+import asyncio
+import io
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+import torch
+import torchvision.transforms as transforms
+import torchvision.transforms.functional as TF
+from PIL import Image
+
+from data.sampler import pad_collate
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+           500: "Internal Server Error"}
+FORMATS = ("png", "webp")
+
+
+def encode_image(tensor, fmt="png"):
+    """Encode a C x H x W tensor in [0, 1] as PNG or lossless WebP bytes."""
+    img = TF.to_pil_image(torch.clamp(tensor.cpu().float(), 0, 1))
+    if fmt not in FORMATS:
+        raise ValueError("unsupported format %s, use one of %s" % (fmt, ", ".join(FORMATS)))
+    buf = io.BytesIO()
+    if fmt == "webp":
+        img.save(buf, format="WEBP", lossless=True)
+    else:
+        img.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+class MicroBatchServer():
+    """Serve `net` over HTTP with micro-batching.
+
+    Parameters:
+        net                -- callable mapping an N x C x H x W batch to N x C' x H x W outputs
+        device             -- device the batches are moved to
+        size (int)         -- shorter side images are resized to, 0 keeps the uploaded size
+        input_nc (int)     -- 1 for grayscale input, 3 for RGB
+        max_batch (int)    -- largest micro-batch
+        max_wait (float)   -- seconds the first queued request may wait for the batch to fill
+        workers (int)      -- threads for image decoding and encoding
+        lineages           -- optional utils.incremental.LineageCache for ?lineage= requests
+        max_upload (int)   -- largest accepted request body in bytes, larger uploads get 413
+    """
+    def __init__(self, net, device, size=256, input_nc=3, max_batch=8, max_wait=0.01, workers=4, info=None,
+                 lineages=None, max_upload=32 * 2 ** 20):
+        self.net = net
+        self.device = device
+        self.size = size
+        self.mode = "L" if input_nc == 1 else "RGB"
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.info = info or {}
+        self.lineages = lineages
+        self.max_upload = max_upload
+        self.codec_pool = ThreadPoolExecutor(max_workers=workers)
+        self.model_pool = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.address = None
+        self.started = time.time()
+        self.latencies = deque(maxlen=2000)
+        self.counts = {"requests": 0, "errors": 0, "batches": 0, "images": 0}
+
+        transform = [transforms.ToTensor()]
+        if size > 0:
+            transform = [transforms.Resize(int(size), Image.BICUBIC)] + transform
+        self.transform = transforms.Compose(transform)
+
+    def decode(self, data):
+        return self.transform(Image.open(io.BytesIO(data)).convert(self.mode))
+
+    def run_batch(self, tensors):
+        batch = pad_collate([{"r": t} for t in tensors])
+        with torch.no_grad():
+            out = self.net(batch["r"].to(self.device))
+        return [out[j, :, :h, :w].cpu() for j, (h, w) in enumerate(batch["size"].tolist())]
+
+    def run_lineage(self, lineage, tensor):
+        batch = pad_collate([{"r": tensor}])
+        with torch.no_grad():
+            out = self.lineages(lineage, batch["r"].to(self.device))
+        h, w = batch["size"][0].tolist()
+        return out[0, :, :h, :w].cpu()
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(items) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Group by size so a micro-batch of mixed uploads is not padded to its largest image.
+            groups = {}
+            for tensor, future in items:
+                key = (-(-tensor.size()[1] // 4) * 4, -(-tensor.size()[2] // 4) * 4)
+                groups.setdefault(key, []).append((tensor, future))
+            for group in groups.values():
+                try:
+                    outputs = await loop.run_in_executor(self.model_pool, self.run_batch, [t for t, _ in group])
+                    for (_, future), output in zip(group, outputs):
+                        if not future.done():
+                            future.set_result(output)
+                except Exception as e:
+                    for _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+                self.counts["batches"] += 1
+                self.counts["images"] += len(group)
+
+    async def convert(self, data, fmt, lineage=None):
+        loop = asyncio.get_running_loop()
+        tensor = await loop.run_in_executor(self.codec_pool, self.decode, data)
+        if lineage is not None:
+            # Runs on the model thread, so it never overlaps a micro-batch.
+            output = await loop.run_in_executor(self.model_pool, self.run_lineage, lineage, tensor)
+        else:
+            future = loop.create_future()
+            await self.queue.put((tensor, future))
+            output = await future
+        return await loop.run_in_executor(self.codec_pool, encode_image, output, fmt)
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if len(latencies) == 0:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))]
+
+        extra = {}
+        if self.lineages is not None:
+            extra["incremental"] = self.lineages.counts()
+        return dict(self.counts, **extra, queue_depth=self.queue.qsize() if self.queue is not None else 0,
+                    mean_batch=self.counts["images"] / max(self.counts["batches"], 1),
+                    latency_p50=percentile(50), latency_p95=percentile(95), latency_p99=percentile(99),
+                    uptime=time.time() - self.started)
+
+    async def respond(self, writer, status, body, content_type="application/json", keep_alive=True):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        head = "HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % (
+            status, REASONS.get(status, ""), content_type, len(body), "keep-alive" if keep_alive else "close")
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > self.max_upload:
+                    # The body is not read, so the connection cannot be reused.
+                    await self.respond(writer, 413, {"error": "upload of %d bytes exceeds the limit of %d"
+                                                     % (length, self.max_upload)}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length)
+                keep_alive = headers.get("connection", "keep-alive").lower() != "close"
+                await self.route(writer, method, target, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, writer, method, target, body, keep_alive):
+        url = urlparse(target)
+        if url.path == "/health":
+            await self.respond(writer, 200, dict(self.info, status="ok"), keep_alive=keep_alive)
+        elif url.path == "/metrics":
+            await self.respond(writer, 200, self.metrics(), keep_alive=keep_alive)
+        elif url.path == "/convert":
+            if method != "POST":
+                await self.respond(writer, 405, {"error": "use POST"}, keep_alive=keep_alive)
+                return
+            query = parse_qs(url.query)
+            fmt = query.get("format", ["png"])[0]
+            if fmt not in FORMATS:
+                await self.respond(writer, 400, {"error": "unsupported format %s, use one of %s"
+                                                 % (fmt, ", ".join(FORMATS))}, keep_alive=keep_alive)
+                return
+            lineage = query.get("lineage", [None])[0]
+            if lineage is not None and self.lineages is None:
+                await self.respond(writer, 400, {"error": "incremental conversion is disabled"}, keep_alive=keep_alive)
+                return
+            self.counts["requests"] += 1
+            start = time.time()
+            try:
+                data = await self.convert(body, fmt, lineage)
+            except Exception as e:
+                self.counts["errors"] += 1
+                status = 400 if isinstance(e, (OSError, ValueError)) else 500
+                await self.respond(writer, status, {"error": "%s: %s" % (type(e).__name__, e)}, keep_alive=keep_alive)
+                return
+            self.latencies.append(time.time() - start)
+            await self.respond(writer, 200, data, content_type="image/%s" % fmt, keep_alive=keep_alive)
+        else:
+            await self.respond(writer, 404, {"error": "unknown path %s" % url.path}, keep_alive=keep_alive)
+
+    async def serve(self, host="127.0.0.1", port=8008):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        # The bound address, which tells callers the port when port 0 asked for an ephemeral one.
+        self.address = server.sockets[0].getsockname()[:2]
+        print("Serving on http://%s:%d (max batch %d, max wait %.0fms)" % (self.address + (self.max_batch,
+                                                                                           self.max_wait * 1000)))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+async def http_request(host, port, method, path, body=b"", headers=None):
+    """Minimal HTTP/1.1 client for talking to the server over loopback; returns (status, headers, body)."""
+    reader, writer = await asyncio.open_connection(host, port)
+    head = "%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\nConnection: close\r\n" % (method, path, host, len(body))
+    for key, value in (headers or {}).items():
+        head += "%s: %s\r\n" % (key, value)
+    writer.write((head + "\r\n").encode() + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).decode("latin-1").split(" ")[1])
+    response_headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        response_headers[key.strip().lower()] = value.strip()
+    data = await reader.readexactly(int(response_headers.get("content-length", 0)))
+    writer.close()
+    return status, response_headers, data
@@ -0,0 +1,146 @@
+"""Packed output shards for large conversion jobs.
+
+Writing one file per result turns a job over millions of frames into millions of file creations.
+A ShardWriter instead appends the encoded results as members of a few large tar files
+(`<prefix>-00000.tar`, `<prefix>-00001.tar`, ...), starting a new shard once the current one passes
+`max_mb`. Plain tar keeps the shards readable by standard tools and streamable in order; next to
+every shard, a JSON index maps each member name to the offset and size of its data, so ShardReader
+can fetch a single result with one seek.
+
+    python -m utils.shards list results/exp8
+    python -m utils.shards extract results/exp8 out_dir [name ...]
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import tarfile
+import time
+
+
+def shard_paths(root, prefix="shard"):
+    return sorted(glob.glob(os.path.join(root, "%s-*.tar" % prefix)))
+
+
+def index_path(shard):
+    return os.path.splitext(shard)[0] + ".idx.json"
+
+
+class ShardWriter():
+    """Append named byte strings to rotating tar shards under `root`.
+
+    Existing shards are never reopened: a restarted job continues with the next shard number, so
+    the results of an interrupted run stay readable.
+    """
+    def __init__(self, root, prefix="shard", max_mb=1024):
+        self.root = root
+        self.prefix = prefix
+        self.max_bytes = int(max_mb * 2 ** 20)
+        os.makedirs(root, exist_ok=True)
+        self.number = len(shard_paths(root, prefix))
+        self.tar = None
+        self.index = {}
+        self.count = 0
+
+    def _open(self):
+        self.path = os.path.join(self.root, "%s-%05d.tar" % (self.prefix, self.number))
+        self.tar = tarfile.open(self.path, "w")
+        self.index = {}
+        self.number += 1
+
+    def _close_shard(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        with open(index_path(self.path), "w") as f:
+            json.dump(self.index, f)
+        self.tar = None
+
+    def write(self, name, data):
+        if self.tar is None:
+            self._open()
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.tar.addfile(info, io.BytesIO(data))
+        # addfile stores a copy of info, so locate the data from the end of the padded member instead.
+        self.index[name] = [self.tar.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE, info.size]
+        self.count += 1
+        if self.tar.offset >= self.max_bytes:
+            self._close_shard()
+
+    def close(self):
+        self._close_shard()
+
+
+class ShardReader():
+    """Random and sequential access to the shards under `root`."""
+    def __init__(self, root, prefix="shard"):
+        self.shards = shard_paths(root, prefix)
+        self.index = {}
+        for shard in self.shards:
+            if not os.path.exists(index_path(shard)):
+                print("%s has no index (interrupted run?), scanning it" % shard)
+                with tarfile.open(shard, "r") as tar:
+                    entries = {m.name: [m.offset_data, m.size] for m in tar}
+            else:
+                with open(index_path(shard)) as f:
+                    entries = json.load(f)
+            for name, (offset, size) in entries.items():
+                self.index[name] = (shard, offset, size)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self):
+        return list(self.index)
+
+    def read(self, name):
+        shard, offset, size = self.index[name]
+        with open(shard, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def __iter__(self):
+        """Stream (name, bytes) pairs shard by shard in the order they were written."""
+        for shard in self.shards:
+            with tarfile.open(shard, "r|") as tar:
+                for member in tar:
+                    if member.isfile():
+                        yield member.name, tar.extractfile(member).read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="list or extract packed output shards")
+    parser.add_argument("command", choices=["list", "extract"])
+    parser.add_argument("root", type=str, help="directory holding the shards")
+    parser.add_argument("out_dir", type=str, nargs="?", default="", help="where extract writes the files")
+    parser.add_argument("names", type=str, nargs="*", help="members to extract, all of them if omitted")
+    parser.add_argument("--prefix", type=str, default="shard", help="shard file name prefix")
+    opt = parser.parse_args()
+
+    reader = ShardReader(opt.root, opt.prefix)
+    if opt.command == "list":
+        for name, (shard, offset, size) in reader.index.items():
+            print("%s\t%s\t%d\t%d" % (name, os.path.basename(shard), offset, size))
+        print("%d results in %d shards" % (len(reader), len(reader.shards)))
+        return
+
+    if opt.out_dir == "":
+        parser.error("extract needs an out_dir")
+    os.makedirs(opt.out_dir, exist_ok=True)
+    if len(opt.names) == 0:
+        items = iter(reader)
+    else:
+        items = ((name, reader.read(name)) for name in opt.names)
+    for name, data in items:
+        with open(os.path.join(opt.out_dir, os.path.basename(name)), "wb") as f:
+            f.write(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Tiled full-resolution inference for the fully convolutional image-to-image networks.
+
+The image is cut into overlapping tiles, the tiles are run through the network in batches and the
+outputs are blended back with a separable window that ramps down over the overlap, so seams vanish.
+Because every InstanceNorm2d normalises each tile with that tile's own statistics, neighbouring tiles
+can drift in colour; `GlobalInstanceNorm` records the statistics of a low-resolution pass over the
+whole image and makes every tile use them instead.
+"""
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def _round4(n):
+    return max(4, int(n) // 4 * 4)
+
+
+def _starts(length, tile, stride):
+    if length <= tile:
+        return [0]
+    return list(range(0, length - tile, stride)) + [length - tile]
+
+
+def blend_window(h, w, overlap, device):
+    """Separable weights that ramp from ~0 to 1 over `overlap` pixels at each tile edge (never exactly 0)."""
+    def ramp(n):
+        r = torch.ones(n)
+        k = min(overlap, n // 2)
+        if k > 0:
+            edge = (torch.arange(k, dtype=torch.float32) + 0.5) / k
+            r[:k] = edge
+            r[n - k:] = edge.flip(0)
+        return r
+    return torch.outer(ramp(h), ramp(w)).to(device)
+
+
+def is_eager_float(net):
+    """Whether net is an eager nn.Module with floating-point weights, which hooks and autograd probes need.
+
+    TorchScript (e.g. the int8 artifact of load_quantized), quantized modules and ONNX wrappers are not.
+    """
+    if not isinstance(net, nn.Module) or isinstance(net, torch.jit.ScriptModule):
+        return False
+    if any(type(m).__module__.startswith(("torch.ao.nn.quantized", "torch.nn.quantized")) for m in net.modules()):
+        return False
+    return all(p.is_floating_point() for p in net.parameters())
+
+
+def activation_bytes_per_pixel(net, channels, device, probe=64):
+    """Estimate the peak inference memory of net per input pixel from one small probe forward.
+
+    Three copies of the largest activation are assumed to be alive at once (input, output and
+    the residual branch). Networks that are not eager float modules (ONNX, TorchScript, int8)
+    cannot take forward hooks and get a conservative default.
+    """
+    if not is_eager_float(net):
+        return 2048.0
+    peak = [0]
+
+    def hook(module, inputs, output):
+        if isinstance(output, torch.Tensor):
+            peak[0] = max(peak[0], output.numel() * output.element_size())
+
+    hooks = [m.register_forward_hook(hook) for m in net.modules() if len(list(m.children())) == 0]
+    try:
+        with torch.no_grad():
+            net(torch.zeros(1, channels, probe, probe, device=device))
+    finally:
+        for h in hooks:
+            h.remove()
+    return 3.0 * peak[0] / (probe * probe)
+
+
+def plan_tiles(bytes_per_pixel, budget_mb, tile, overlap, tile_batch):
+    """Largest tile batch (and if needed a smaller tile) whose activations fit in budget_mb."""
+    if budget_mb <= 0:
+        return tile, tile_batch
+    budget = budget_mb * 2 ** 20
+    tile_batch = int(budget // (bytes_per_pixel * tile * tile))
+    if tile_batch < 1:
+        tile = _round4(max(math.sqrt(budget / bytes_per_pixel), 2 * overlap + 4))
+        tile_batch = 1
+    return tile, tile_batch
+
+
+class GlobalInstanceNorm():
+    """Freeze the InstanceNorm2d layers of net to the statistics of a reference image.
+
+    Use `record(reference)` with a low-resolution version of the whole image, then run the tiles
+    inside `with` so all of them are normalised identically. Only eager networks expose their
+    InstanceNorm2d layers; for TorchScript and ONNX networks `norms` is empty and nothing is frozen.
+    """
+    def __init__(self, net):
+        self.net = net
+        self.norms = []
+        if is_eager_float(net):
+            self.norms = [m for m in net.modules() if isinstance(m, nn.InstanceNorm2d)]
+        self.stats = {}
+
+    def record(self, reference):
+        """Run net on reference, keep its InstanceNorm statistics and return its output."""
+        def make_hook(module):
+            def hook(module, inputs):
+                x = inputs[0]
+                var, mean = torch.var_mean(x, dim=[2, 3], keepdim=True, unbiased=False)
+                self.stats[module] = (mean, var)
+            return hook
+
+        hooks = [m.register_forward_pre_hook(make_hook(m)) for m in self.norms]
+        try:
+            with torch.no_grad():
+                return self.net(reference)
+        finally:
+            for h in hooks:
+                h.remove()
+
+    def _frozen(self, module, x):
+        mean, var = self.stats[module]
+        out = (x - mean) * torch.rsqrt(var + module.eps)
+        if module.affine:
+            out = out * module.weight.view(1, -1, 1, 1) + module.bias.view(1, -1, 1, 1)
+        return out
+
+    def __enter__(self):
+        for m in self.norms:
+            m.forward = lambda x, m=m: self._frozen(m, x)
+        return self
+
+    def __exit__(self, *args):
+        for m in self.norms:
+            del m.forward
+
+
+def tiled_forward(net, img, tile=512, overlap=32, tile_batch=4, global_norm_size=0):
+    """Run net over img tile by tile and blend the tile outputs into a full-resolution result.
+
+    Parameters:
+        net              -- image-to-image network (nn.Module, TorchScript or ONNX backend)
+        img (tensor)     -- N x C x H x W input, each image is tiled separately
+        tile (int)       -- tile side, rounded down to a multiple of 4 for the stride-2 layers
+        overlap (int)    -- overlap between neighbouring tiles, blended with a linear ramp
+        tile_batch (int) -- number of tiles per forward pass
+        global_norm_size (int) -- if > 0, shorter side of the low-resolution pass that provides
+                                  shared InstanceNorm statistics for all tiles of an image
+    """
+    n, _, h, w = img.size()
+    tile = _round4(tile)
+    overlap = min(overlap, tile // 4)
+    tile_h = min(tile, -(-h // 4) * 4)
+    tile_w = min(tile, -(-w // 4) * 4)
+    pad_h = max(0, tile_h - h)
+    pad_w = max(0, tile_w - w)
+    if pad_h > 0 or pad_w > 0:
+        img = F.pad(img, (0, pad_w, 0, pad_h), mode="replicate")
+    H, W = img.size()[2:]
+
+    boxes = [(y, x) for y in _starts(H, tile_h, tile_h - overlap) for x in _starts(W, tile_w, tile_w - overlap)]
+    window = blend_window(tile_h, tile_w, overlap, img.device)
+    weight = torch.zeros(1, 1, H, W, device=img.device)
+    for y, x in boxes:
+        weight[:, :, y:y + tile_h, x:x + tile_w] += window
+
+    norm = GlobalInstanceNorm(net)
+    out = None
+    for b in range(n):
+        if global_norm_size > 0 and len(norm.norms) > 0:
+            scale = min(1.0, float(global_norm_size) / min(h, w))
+            size = (_round4(h * scale), _round4(w * scale))
+            norm.record(F.interpolate(img[b:b + 1, :, :h, :w], size=size, mode="bilinear", align_corners=False,
+                                      antialias=True))
+        for k in range(0, len(boxes), tile_batch):
+            chunk = boxes[k:k + tile_batch]
+            tiles = torch.cat([img[b:b + 1, :, y:y + tile_h, x:x + tile_w] for y, x in chunk])
+            if len(norm.stats) > 0:
+                with norm:
+                    res = net(tiles)
+            else:
+                res = net(tiles)
+            res = res.to(img.device)
+            if tuple(res.size()[2:]) != (tile_h, tile_w):
+                res = F.interpolate(res, size=(tile_h, tile_w), mode="bilinear", align_corners=False)
+            if out is None:
+                out = torch.zeros(n, res.size()[1], H, W, device=img.device, dtype=res.dtype)
+            for j, (y, x) in enumerate(chunk):
+                out[b, :, y:y + tile_h, x:x + tile_w] += res[j] * window
+        norm.stats = {}
+
+    out = out / weight
+    return out[:, :, :h, :w]
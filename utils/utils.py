@@ -1,3 +1,5 @@
+import json
+import os
 import random
 import time
 import datetime
@@ -25,6 +27,70 @@ def createNRandompatches(img1, img2, N, patch_size, clipsize=224):
 
     return patches1, patches2
 
+class TeacherPyramid():
+    """Antialiased downsampled copies of an image batch, shared by the teacher losses of one step.
+
+    A level is computed the first time it is asked for, from the smallest level already held that
+    is at least as large, so the sketch, geometry and CLIP teachers never resample the same input twice.
+    A (h, w) larger than the image along either side is resampled from the full resolution with the
+    same antialiased bilinear filter; antialiasing only changes the sides that shrink.
+    """
+    def __init__(self, img):
+        self.levels = {tuple(img.size()[2:]): img}
+        self.full_size = tuple(img.size()[2:])
+
+    def level_size(self, size):
+        # 0 keeps the full resolution, an int is the length of the shorter side and a (h, w) pair is used as is.
+        if isinstance(size, (tuple, list)):
+            return tuple(int(s) for s in size)
+        h, w = self.full_size
+        if size <= 0 or size >= min(h, w):
+            return self.full_size
+        scale = float(size) / min(h, w)
+        return max(1, int(round(h * scale))), max(1, int(round(w * scale)))
+
+    def get(self, size):
+        target = self.level_size(size)
+        if target not in self.levels:
+            larger = [s for s in self.levels if s[0] >= target[0] and s[1] >= target[1]]
+            source = self.levels[min(larger, key=lambda s: s[0] * s[1])] if len(larger) > 0 else self.levels[self.full_size]
+            self.levels[target] = torch.nn.functional.interpolate(source, size=target, mode="bilinear",
+                                                                  align_corners=False, antialias=True)
+        return self.levels[target]
+
+
+def gray2clip(line_input):
+    """Expand a single channel image to three CLIP-normalised channels."""
+    line_input_channel0 = (line_input - 0.48145466) / 0.26862954
+    line_input_channel1 = (line_input - 0.4578275) / 0.26130258
+    line_input_channel2 = (line_input - 0.40821073) / 0.27577711
+    return torch.cat([line_input_channel0, line_input_channel1, line_input_channel2], dim=1)
+
+
+def resize_target(target, pred):
+    """Resample a teacher target to the spatial size of the teacher prediction."""
+    if target.size()[2:] == pred.size()[2:]:
+        return target
+    return torch.nn.functional.interpolate(target, size=pred.size()[2:], mode="bilinear", align_corners=False,
+                                           antialias=True)
+
+
+def atomic_save(obj, path, info=None):
+    """torch.save to a temporary file renamed over path, so readers never see a half-written checkpoint.
+
+    info, if given, is written next to it as <path without .pth>.json (e.g. the training step). It is
+    replaced before the checkpoint, so a reader that loads the checkpoint and then reads the info
+    never gets the info of an older checkpoint.
+    """
+    tmp = path + ".tmp"
+    if info is not None:
+        with open(tmp, "w") as f:
+            json.dump(info, f)
+        os.replace(tmp, os.path.splitext(path)[0] + ".json")
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
 def tensor2image(tensor):
     image = 127.5 * (tensor[0].cpu().float().numpy() + 1.0)
     if image.shape[0] == 1:
@@ -0,0 +1,148 @@
+"""Watch a directory for new or modified images and journal the ones that were processed.
+
+`DirectoryWatcher` rescans the directory every `interval` seconds, or as soon as inotify reports a
+finished write when the optional `inotify_simple` package is installed, and yields the images that
+are not in the journal with their current size and modification time. Files modified less than
+`settle` seconds ago are left for the next scan, so half-copied images are not picked up.
+
+`ProcessedJournal` is an append-only file of JSON lines, so recording a batch costs one small
+write and a crash loses at most the batch in flight. Files that failed are journaled with their
+error, so they are skipped until they change instead of failing every round.
+"""
+import json
+import os
+import time
+
+from data.dataset import make_dataset
+
+try:
+    from inotify_simple import flags, INotify
+except ImportError:
+    INotify = None
+
+
+def _signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+class ProcessedJournal():
+    """Set of processed files, each remembered with the size and mtime it had when processed."""
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self.errors = {}
+        lines = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line of an interrupted write
+                    self.done[entry[0]] = entry[1:3]
+                    if len(entry) > 3:
+                        self.errors[entry[0]] = entry[3]
+                    else:
+                        self.errors.pop(entry[0], None)
+                    lines += 1
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        if lines > 2 * len(self.done) + 1000:
+            self.compact()
+
+    def __len__(self):
+        return len(self.done)
+
+    def pending(self, paths):
+        """The paths that were never processed or changed since."""
+        pending = []
+        for path in paths:
+            try:
+                if self.done.get(os.path.abspath(path)) != _signature(path):
+                    pending.append(path)
+            except FileNotFoundError:
+                pass
+        return pending
+
+    def record(self, paths, errors=None):
+        """Journal paths as processed; errors maps the ones that failed to their error message."""
+        errors = errors or {}
+        with open(self.path, "a") as f:
+            for path in paths:
+                try:
+                    entry = [os.path.abspath(path)] + _signature(path)
+                except FileNotFoundError:
+                    continue
+                self.done[entry[0]] = entry[1:3]
+                if path in errors:
+                    self.errors[entry[0]] = errors[path]
+                    entry.append(errors[path])
+                else:
+                    self.errors.pop(entry[0], None)
+                f.write(json.dumps(entry) + "\n")
+
+    def compact(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for path, signature in self.done.items():
+                entry = [path] + signature
+                if path in self.errors:
+                    entry.append(self.errors[path])
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp, self.path)
+
+
+class DirectoryWatcher():
+    """Iterate forever over lists of new or modified images under root (at most max_batch per list)."""
+    def __init__(self, root, journal, interval=2.0, settle=1.0, max_batch=256):
+        self.root = root
+        self.journal = journal
+        self.interval = interval
+        self.settle = settle
+        self.max_batch = max_batch
+        self.inotify = None
+        self.watches = {}
+        if INotify is not None:
+            self.inotify = INotify()
+            self.watch_tree(root)
+
+    def watch_tree(self, top):
+        """Add inotify watches for top and every directory below it."""
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        for directory, _, _ in os.walk(top):
+            try:
+                self.watches[self.inotify.add_watch(directory, mask)] = directory
+            except OSError:
+                pass  # removed again before it could be watched
+
+    def scan(self):
+        now = time.time()
+        paths = []
+        for path in self.journal.pending(make_dataset(self.root, stop=float("inf"))):
+            try:
+                if now - os.path.getmtime(path) >= self.settle:
+                    paths.append(path)
+            except FileNotFoundError:
+                pass
+        return sorted(paths)
+
+    def wait(self):
+        if self.inotify is not None:
+            # Events only cut the wait short; the next scan decides what is new. Directories created
+            # or moved in are watched as well, so files arriving in them also wake the watcher.
+            for event in self.inotify.read(timeout=int(self.interval * 1000), read_delay=int(self.settle * 1000)):
+                if event.mask & flags.ISDIR and event.wd in self.watches:
+                    self.watch_tree(os.path.join(self.watches[event.wd], event.name))
+        else:
+            time.sleep(self.interval)
+
+    def __iter__(self):
+        while True:
+            paths = self.scan()
+            if len(paths) == 0:
+                self.wait()
+                continue
+            for k in range(0, len(paths), self.max_batch):
+                yield paths[k:k + self.max_batch]
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import time
+
+import torch
+import torchvision
+from torch.utils.tensorboard import SummaryWriter
+
+from models.model import Generator
+from utils.evaluation import run_checkpoint, TestSet
+from utils.fid import InceptionFeatures, reference_statistics, score
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--name', required=True, type=str, help='name of the experiment being trained')
+parser.add_argument('--checkpoints_dir', type=str, default='checkpoints', help='Where the model checkpoints are saved')
+parser.add_argument('--val_dir', required=True, type=str, help='held-out directory of input images')
+parser.add_argument('--reference_dir', type=str, default='', help='flat-colour references matched to the validation images by file name, for PSNR/SSIM')
+parser.add_argument('--fid_reference_dir', type=str, default='', help='flat-colour reference set for FID/KID, disabled if empty')
+parser.add_argument('--stats_cache', type=str, default='checkpoints/fid_stats', help='where reference features and statistics are cached')
+parser.add_argument('--input_nc', type=int, default=3, help='number of channels of input data')
+parser.add_argument('--output_nc', type=int, default=3, help='number of channels of output data')
+parser.add_argument('--n_blocks', type=int, default=3, help='number of resnet blocks for generator')
+parser.add_argument('--size', type=int, default=256, help='shorter side the validation images are resized to')
+parser.add_argument('--batchSize', type=int, default=8, help='size of the batches')
+parser.add_argument('--how_many', type=int, default=200, help='number of validation images')
+parser.add_argument('--device', type=str, default='cpu', help='device of the validation worker, cpu keeps the GPU to the trainer')
+parser.add_argument('--threads', type=int, default=4, help='CPU threads of the validation worker')
+parser.add_argument('--interval', type=float, default=30.0, help='seconds between checks for a new snapshot')
+parser.add_argument('--num_images', type=int, default=8, help='validation outputs logged as an image grid')
+parser.add_argument('--parent_pid', type=int, default=0, help='exit once this process (the trainer) has exited')
+parser.add_argument('--once', type=int, default=0, help='validate the current snapshot once and exit')
+
+opt = parser.parse_args()
+print(opt)
+
+# The worker only uses spare cycles: lowest useful priority and a bounded number of threads.
+if hasattr(os, 'nice'):
+    os.nice(10)
+torch.set_num_threads(opt.threads)
+device = torch.device(opt.device)
+
+snapshot = os.path.join(opt.checkpoints_dir, opt.name, 'netG_A_latest.pth')
+info_path = os.path.splitext(snapshot)[0] + '.json'
+
+test_set = TestSet(opt.val_dir, size=opt.size, input_nc=opt.input_nc, reference_dir=opt.reference_dir,
+                   output_nc=opt.output_nc, batch_size=opt.batchSize, max_images=opt.how_many)
+print('%d validation images (%d with references)' % (len(test_set), test_set.with_reference))
+
+extractor = None
+reference = None
+if opt.fid_reference_dir != '':
+    extractor = InceptionFeatures(device, batch_size=opt.batchSize)
+    reference = reference_statistics(extractor, opt.fid_reference_dir, opt.stats_cache, size=opt.size,
+                                     output_nc=opt.output_nc)
+
+# Same directory as the trainer's Visualizer, so the curves show up next to the training losses.
+writer = SummaryWriter(os.path.join(opt.checkpoints_dir, opt.name, 'logs'))
+
+net_G = Generator(opt.input_nc, opt.output_nc, opt.n_blocks)
+net_G.to(device)
+net_G.eval()
+
+
+def parent_alive():
+    if opt.parent_pid == 0:
+        return True
+    try:
+        os.kill(opt.parent_pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def validate(step):
+    shown = []
+
+    def keep(outputs):
+        shown.extend(o.cpu() for o in outputs[:max(opt.num_images - len(shown), 0)])
+        if extractor is not None:
+            extractor.add(outputs)
+
+    metrics = run_checkpoint(net_G, test_set, device, on_output=keep)
+    if extractor is not None:
+        metrics.update(score(extractor.finish(), reference))
+    for key in ['psnr', 'ssim', 'fid', 'kid']:
+        if key in metrics:
+            writer.add_scalar('val/%s' % key, metrics[key], step)
+    writer.add_scalar('val/seconds_per_image', metrics['seconds_per_image'], step)
+    if len(shown) > 0:
+        # Outputs of different sizes are brought to the size of the first one for the grid.
+        size = shown[0].size()[1:]
+        shown = [torch.nn.functional.interpolate(o.unsqueeze(0), size=size, mode='bilinear', align_corners=False)[0]
+                 for o in shown]
+        writer.add_image('val/outputs', torchvision.utils.make_grid(shown, nrow=4), step)
+    writer.flush()
+    return metrics
+
+
+last_mtime = None
+validations = 0
+while True:
+    # Checked before looking for a snapshot, so the trainer's final snapshot is still validated.
+    alive = parent_alive()
+    mtime = os.path.getmtime(snapshot) if os.path.exists(snapshot) else None
+    if mtime is None or mtime == last_mtime:
+        if opt.once == 1 and mtime is None:
+            raise SystemExit('%s does not exist' % snapshot)
+        if not alive or opt.once == 1:
+            break
+        time.sleep(opt.interval)
+        continue
+    try:
+        net_G.load_state_dict(torch.load(snapshot, map_location='cpu'))
+    except Exception as e:
+        # Snapshots saved without atomic_save may be caught mid-write; try again on the next check.
+        print('could not load %s (%s), retrying' % (snapshot, e))
+        if not alive:
+            break
+        time.sleep(opt.interval)
+        continue
+    # The info is written before the snapshot, so read after loading it is at least as new. A snapshot
+    # replaced in the meantime is picked up by the next check.
+    step = validations
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            step = json.load(f).get('step', step)
+    if os.path.getmtime(snapshot) != mtime:
+        continue
+    last_mtime = mtime
+    start = time.time()
+    metrics = validate(step)
+    validations += 1
+    print('step %d: %s (%.1fs)' % (step, ', '.join('%s %.4f' % (k, v) for k, v in sorted(metrics.items())),
+                                   time.time() - start))
+    if opt.once == 1:
+        break
+
+writer.close()
+
+"""
+python validate.py --name exp8 --val_dir examples/val --reference_dir examples/val_flat
+python train.py --name exp8 ... --val_dir examples/val --val_reference_dir examples/val_flat
+"""